@@ -0,0 +1,102 @@
+# Logging sin bloquear el event loop: los handlers del proceso sólo encolan el
+# registro y un thread (QueueListener) lo formatea como JSON y lo escribe
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Iterable
+
+# Id del pedido en curso; se propaga a los logs y a la respuesta (X-Request-ID)
+correlation_id: ContextVar[str] = ContextVar("correlation_id", default="-")
+
+# Campos estándar de LogRecord que no se repiten en la salida JSON
+RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+def new_correlation_id(incoming: str = None) -> str:
+    # Se respeta el id que manda un proxy si es razonable, para seguir el pedido de punta a punta
+    if incoming and len(incoming) <= 64 and incoming.isprintable():
+        return incoming
+    return uuid.uuid4().hex
+
+class CorrelationFilter(logging.Filter):
+    # Corre en el thread que emite el log, donde todavía se ve el contextvar del pedido
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    # Deja pasar sólo una fracción de los INFO/DEBUG de loggers muy ruidosos;
+    # los WARNING o más graves se conservan siempre
+    def __init__(self, rate: float, logger_names: Iterable[str]):
+        super().__init__()
+        self.rate = rate
+        self.logger_names = set(logger_names)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or record.name not in self.logger_names:
+            return True
+        return random.random() < self.rate
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "correlation_id": getattr(record, "correlation_id", "-")
+        }
+        # Campos pasados con extra={...}
+        for key, value in vars(record).items():
+            if key not in RECORD_FIELDS and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # El QueueHandler estándar formatea el registro en el thread que lo emite (el event
+    # loop) y descarta exc_info. Acá solo se resuelven los argumentos del mensaje, para que
+    # un objeto que cambie después no altere el log, y el formato (JSON, traceback) queda
+    # para el thread del listener
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def configure_logging(level: str = "INFO", json_output: bool = True, sample_rate: float = 1.0,
+                      sampled_loggers: Iterable[str] = (), stream=None) -> logging.handlers.QueueListener:
+    # Devuelve el listener ya iniciado; hay que detenerlo al apagar para vaciar la cola
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(CorrelationFilter())
+    if sample_rate < 1.0:
+        queue_handler.addFilter(SamplingFilter(sample_rate, sampled_loggers))
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    if json_output:
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - [%(correlation_id)s] %(message)s'
+        ))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+    # uvicorn instala sus propios handlers sincrónicos antes de importar la app
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    return listener
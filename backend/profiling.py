@@ -0,0 +1,91 @@
+# Medición por pedido: comandos de Mongo emitidos (con su duración), perfil de
+# Python opcional y registro estructurado de operaciones lentas
+import cProfile
+import io
+import logging
+import pstats
+from contextvars import ContextVar
+from typing import Optional
+
+from pymongo import monitoring
+
+slow_log = logging.getLogger("turnitos.slow")
+
+# Traza del pedido en curso. Motor ejecuta los comandos en su pool de threads con
+# una copia del contexto, así que el listener ve la traza del pedido que los emitió
+request_trace: ContextVar[Optional[dict]] = ContextVar("request_trace", default=None)
+
+def new_trace(method: str, path: str) -> dict:
+    return {"method": method, "path": path, "db_calls": [], "db_ms": 0.0}
+
+def log_slow_operation(kind: str, **fields):
+    # Los campos viajan como extra: JsonFormatter los serializa una sola vez como claves propias
+    slow_log.warning("Operación lenta: %s", kind, extra={"type": kind, **fields})
+
+class CommandTimingListener(monitoring.CommandListener):
+    # Siempre activo: anota cada comando en la traza del pedido y registra los que
+    # superan slow_query_ms
+    def __init__(self, slow_query_ms: float):
+        self.slow_query_ms = slow_query_ms
+        self.pending = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self.pending[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else None
+        )
+
+    def succeeded(self, event):
+        self.finish(event, False)
+
+    def failed(self, event):
+        self.finish(event, True)
+
+    def finish(self, event, failed: bool):
+        collection = self.pending.pop((event.connection_id, event.request_id), None)
+        duration_ms = event.duration_micros / 1000
+        trace = request_trace.get()
+        if trace is not None:
+            trace["db_calls"].append({
+                "command": event.command_name,
+                "collection": collection,
+                "duration_ms": round(duration_ms, 2),
+                "failed": failed
+            })
+            trace["db_ms"] += duration_ms
+        if duration_ms >= self.slow_query_ms:
+            log_slow_operation(
+                "db",
+                command=event.command_name,
+                collection=collection,
+                duration_ms=round(duration_ms, 2),
+                failed=failed,
+                path=trace["path"] if trace else None
+            )
+
+# Perfil en curso del worker. Python admite un solo profiler activo por thread
+# (desde 3.12 enable() falla si ya hay otro), y todos los pedidos comparten el del event loop
+active_profiler: Optional[cProfile.Profile] = None
+
+def profiler_active() -> bool:
+    return active_profiler is not None
+
+def start_profiler() -> Optional[cProfile.Profile]:
+    # cProfile mide el thread del event loop completo: si hay otros pedidos en curso
+    # también aparecen, por eso conviene perfilar con poco tráfico o varias muestras.
+    # Devuelve None si otro pedido ya está perfilando
+    global active_profiler
+    if active_profiler is not None:
+        return None
+    active_profiler = cProfile.Profile()
+    active_profiler.enable()
+    return active_profiler
+
+def profile_hot_spots(profiler: cProfile.Profile, limit: int = 30) -> str:
+    global active_profiler
+    profiler.disable()
+    if active_profiler is profiler:
+        active_profiler = None
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(limit)
+    return output.getvalue()
@@ -0,0 +1,293 @@
+# Acceso a los datos que necesita la lógica de agenda. La implementación con Motor
+# es la que usa el servidor; la de memoria permite correr la agenda sin MongoDB
+# (pruebas de carga, benchmarks de los algoritmos de scheduling.py)
+import logging
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne, monitoring
+
+from scheduling import ACTIVE_STATUSES, Interval, collect_busy_intervals
+
+logger = logging.getLogger(__name__)
+
+# Colecciones particionadas por negocio: todas sus consultas deben fijar user_id, el
+# prefijo de su shard key, para que el cluster las dirija solo a los shards del negocio
+TENANT_COLLECTIONS = {
+    "appointments", "appointments_archive", "appointment_series", "services", "resources",
+    "business_hours", "business_hours_overrides", "closed_dates", "clients", "daily_stats",
+    "waitlist", "booking_locks"
+}
+# Shard keys documentadas en README_TURNITOS.md; las demás colecciones de negocio usan
+# {user_id: 1}. Los turnos se particionan por appointment_id y no por fecha porque
+# reprogramar cambia la fecha y las escrituras puntuales solo conocen el id
+SHARD_KEYS = {
+    "appointments": ("user_id", "appointment_id"),
+    "appointments_archive": ("user_id", "appointment_id"),
+    "daily_stats": ("user_id", "date"),
+    "clients": ("user_id", "client_key"),
+}
+# Comentario con el que los jobs de mantenimiento marcan sus recorridos entre negocios
+CROSS_TENANT_COMMENT = "cross-tenant"
+
+APPOINTMENT_BUSY_FIELDS = {"_id": 0, "appointment_id": 1, "service_id": 1, "service_duration": 1,
+                           "resource_id": 1, "date": 1, "time": 1}
+
+class SchedulingRepository(ABC):
+    @abstractmethod
+    async def find_active_appointments(self, user_id: str, dates: List[str], session=None) -> List[dict]:
+        ...
+
+    @abstractmethod
+    async def get_service_durations(self, user_id: str, service_ids: Iterable[str], session=None) -> Dict[str, int]:
+        ...
+
+    @abstractmethod
+    async def find_series_in_window(self, user_id: str, window_start: str, window_end: str, weekdays=None,
+                                    session=None) -> List[dict]:
+        ...
+
+    @abstractmethod
+    async def get_service(self, user_id: str, service_id: str, session=None) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def find_business_hours(self, user_id: str) -> List[dict]:
+        ...
+
+    @abstractmethod
+    async def find_hours_overrides(self, user_id: str, from_date: str) -> List[dict]:
+        ...
+
+    @abstractmethod
+    async def get_active_resource_ids(self, user_id: str, resource_ids: List[str], session=None) -> List[str]:
+        ...
+
+    @abstractmethod
+    async def find_closures(self, user_id: str) -> List[dict]:
+        ...
+
+    @abstractmethod
+    async def lock_booking_days(self, user_id: str, dates: Iterable[str], session=None):
+        ...
+
+    @abstractmethod
+    async def insert_appointment(self, appointment: dict, session=None):
+        ...
+
+    @abstractmethod
+    async def insert_series(self, series: dict, session=None):
+        ...
+
+    async def find_busy_intervals(self, user_id: str, dates, exclude_ids=(), session=None) -> Dict[str, List[Interval]]:
+        # Turnos no cancelados de varias fechas en una sola consulta, con la duración
+        # guardada en el turno o, para turnos antiguos, resuelta con una consulta por lote
+        dates = list(set(dates))
+        if not dates:
+            return {}
+        
+        appointments = await self.find_active_appointments(user_id, dates, session=session)
+        missing = [a['service_id'] for a in appointments if 'service_duration' not in a]
+        durations = await self.get_service_durations(user_id, missing, session=session) if missing else {}
+        
+        weekdays = {datetime.strptime(d, "%Y-%m-%d").weekday() for d in dates}
+        series_list = await self.find_series_in_window(user_id, min(dates), max(dates), weekdays, session=session)
+        return collect_busy_intervals(dates, appointments, durations, series_list, exclude_ids)
+
+    async def lock_booking_window(self, user_id: str, dates: List[str], resource_ids: Optional[List[str]],
+                                  session=None) -> Tuple[Dict[str, List[Interval]], List[str]]:
+        # Camino de escritura de una reserva: primero el candado de cada fecha, para que dos
+        # reservas concurrentes del mismo día (públicas, del dueño o series) entren en
+        # conflicto y una se reintente; recién después los turnos y recursos que se validan
+        await self.lock_booking_days(user_id, dates, session=session)
+        busy = await self.find_busy_intervals(user_id, dates, session=session)
+        active = await self.get_active_resource_ids(user_id, resource_ids, session=session) if resource_ids else []
+        return busy, active
+
+class MotorSchedulingRepository(SchedulingRepository):
+    def __init__(self, db):
+        self.db = db
+
+    async def find_active_appointments(self, user_id: str, dates: List[str], session=None) -> List[dict]:
+        return await self.db.appointments.find({
+            "user_id": user_id,
+            "date": {"$in": list(dates)},
+            "status": {"$in": ACTIVE_STATUSES}
+        }, APPOINTMENT_BUSY_FIELDS, session=session).to_list(None)
+
+    async def get_service_durations(self, user_id: str, service_ids: Iterable[str], session=None) -> Dict[str, int]:
+        services = await self.db.services.find(
+            {"user_id": user_id, "service_id": {"$in": list(set(service_ids))}},
+            {"_id": 0, "service_id": 1, "duration_minutes": 1},
+            session=session
+        ).to_list(None)
+        return {s['service_id']: s.get('duration_minutes', 30) for s in services}
+
+    async def find_series_in_window(self, user_id: str, window_start: str, window_end: str, weekdays=None,
+                                    session=None) -> List[dict]:
+        query = {
+            "user_id": user_id,
+            "active": True,
+            "start_date": {"$lte": window_end},
+            "$or": [{"until": None}, {"until": {"$gte": window_start}}]
+        }
+        if weekdays is not None:
+            query["weekday"] = {"$in": list(weekdays)}
+        return await self.db.appointment_series.find(query, {"_id": 0}, session=session).to_list(None)
+
+    async def get_service(self, user_id: str, service_id: str, session=None) -> Optional[dict]:
+        return await self.db.services.find_one(
+            {"service_id": service_id, "user_id": user_id}, {"_id": 0}, session=session
+        )
+
+    async def find_business_hours(self, user_id: str) -> List[dict]:
+        return await self.db.business_hours.find({"user_id": user_id}, {"_id": 0}).to_list(7)
+
+    async def find_hours_overrides(self, user_id: str, from_date: str) -> List[dict]:
+        return await self.db.business_hours_overrides.find(
+            {"user_id": user_id, "date": {"$gte": from_date}}, {"_id": 0}
+        ).to_list(None)
+
+    async def get_active_resource_ids(self, user_id: str, resource_ids: List[str], session=None) -> List[str]:
+        active = await self.db.resources.find(
+            {"user_id": user_id, "resource_id": {"$in": resource_ids}, "active": True},
+            {"_id": 0, "resource_id": 1},
+            session=session
+        ).to_list(None)
+        active_ids = {r['resource_id'] for r in active}
+        return [r for r in resource_ids if r in active_ids]
+
+    async def find_closures(self, user_id: str) -> List[dict]:
+        return await self.db.closed_dates.find({"user_id": user_id}, {"_id": 0}).to_list(None)
+
+    async def lock_booking_days(self, user_id: str, dates: Iterable[str], session=None):
+        await self.db.booking_locks.bulk_write([
+            UpdateOne({"user_id": user_id, "date": date}, {"$inc": {"version": 1}}, upsert=True)
+            for date in sorted(set(dates))
+        ], ordered=False, session=session)
+
+    async def insert_appointment(self, appointment: dict, session=None):
+        await self.db.appointments.insert_one(appointment, session=session)
+
+    async def insert_series(self, series: dict, session=None):
+        await self.db.appointment_series.insert_one(series, session=session)
+
+class InMemorySchedulingRepository(SchedulingRepository):
+    # Mismas consultas sobre listas de documentos; la sesión se ignora
+    def __init__(self, appointments=None, services=None, series=None, business_hours=None,
+                 resources=None, closed_dates=None, hours_overrides=None):
+        self.appointments: List[dict] = list(appointments or [])
+        self.services: List[dict] = list(services or [])
+        self.series: List[dict] = list(series or [])
+        self.business_hours: List[dict] = list(business_hours or [])
+        self.resources: List[dict] = list(resources or [])
+        self.closed_dates: List[dict] = list(closed_dates or [])
+        self.hours_overrides: List[dict] = list(hours_overrides or [])
+        self.booking_locks: Dict[Tuple[str, str], int] = {}
+
+    async def find_active_appointments(self, user_id: str, dates: List[str], session=None) -> List[dict]:
+        dates = set(dates)
+        return [
+            {k: a[k] for k in APPOINTMENT_BUSY_FIELDS if k in a}
+            for a in self.appointments
+            if a['user_id'] == user_id and a['date'] in dates and a.get('status') in ACTIVE_STATUSES
+        ]
+
+    async def get_service_durations(self, user_id: str, service_ids: Iterable[str], session=None) -> Dict[str, int]:
+        service_ids = set(service_ids)
+        return {
+            s['service_id']: s.get('duration_minutes', 30)
+            for s in self.services
+            if s['user_id'] == user_id and s['service_id'] in service_ids
+        }
+
+    async def find_series_in_window(self, user_id: str, window_start: str, window_end: str, weekdays=None,
+                                    session=None) -> List[dict]:
+        return [
+            s for s in self.series
+            if s['user_id'] == user_id and s.get('active') and s['start_date'] <= window_end
+            and (s.get('until') is None or s['until'] >= window_start)
+            and (weekdays is None or s['weekday'] in weekdays)
+        ]
+
+    async def get_service(self, user_id: str, service_id: str, session=None) -> Optional[dict]:
+        return next((s for s in self.services
+                     if s['user_id'] == user_id and s['service_id'] == service_id), None)
+
+    async def find_business_hours(self, user_id: str) -> List[dict]:
+        return [h for h in self.business_hours if h['user_id'] == user_id]
+
+    async def find_hours_overrides(self, user_id: str, from_date: str) -> List[dict]:
+        return [o for o in self.hours_overrides if o['user_id'] == user_id and o['date'] >= from_date]
+
+    async def get_active_resource_ids(self, user_id: str, resource_ids: List[str], session=None) -> List[str]:
+        active_ids = {r['resource_id'] for r in self.resources if r['user_id'] == user_id and r.get('active')}
+        return [r for r in resource_ids if r in active_ids]
+
+    async def find_closures(self, user_id: str) -> List[dict]:
+        return [c for c in self.closed_dates if c['user_id'] == user_id]
+
+    async def lock_booking_days(self, user_id: str, dates: Iterable[str], session=None):
+        for date in set(dates):
+            key = (user_id, date)
+            self.booking_locks[key] = self.booking_locks.get(key, 0) + 1
+
+    async def insert_appointment(self, appointment: dict, session=None):
+        self.appointments.append(dict(appointment))
+
+    async def insert_series(self, series: dict, session=None):
+        self.series.append(dict(series))
+
+def command_filters(command_name: str, command: dict) -> List[Tuple[dict, bool]]:
+    # (filtro o documento insertado, si el comando afecta un solo documento) tal como lo ve
+    # el monitoreo de pymongo. Las escrituras de un documento necesitan la shard key completa
+    if command_name in ("find", "count", "distinct"):
+        return [(command.get("filter") or command.get("query") or {}, False)]
+    if command_name == "findAndModify":
+        return [(command.get("query") or {}, True)]
+    if command_name == "update":
+        return [(u.get("q") or {}, not u.get("multi") or bool(u.get("upsert"))) for u in command.get("updates", [])]
+    if command_name == "delete":
+        return [(d.get("q") or {}, d.get("limit") == 1) for d in command.get("deletes", [])]
+    if command_name == "insert":
+        return [(document, True) for document in command.get("documents", [])]
+    if command_name == "aggregate":
+        pipeline = command.get("pipeline") or [{}]
+        return [(pipeline[0].get("$match") or {}, False)]
+    return []
+
+def fixes_field(query: dict, field: str) -> bool:
+    # Igualdad sobre el campo: un valor literal o {"$eq": valor}
+    if field not in query:
+        return False
+    value = query[field]
+    return not isinstance(value, dict) or set(value) == {"$eq"}
+
+def unscoped_filters(command_name: str, command: dict) -> List[dict]:
+    # Filtros de un comando sobre una colección de negocio que el cluster no puede dirigir:
+    # los que no fijan user_id y las escrituras puntuales sin la shard key completa
+    collection = command.get(command_name)
+    if collection not in TENANT_COLLECTIONS or command.get("comment") == CROSS_TENANT_COMMENT:
+        return []
+    key = SHARD_KEYS.get(collection, ("user_id",))
+    return [
+        query for query, single in command_filters(command_name, command)
+        if not all(fixes_field(query, field) for field in (key if single else key[:1]))
+    ]
+
+class TenantScopeListener(monitoring.CommandListener):
+    # Se registra con TENANT_SCOPE_CHECK=1 (staging, pruebas de carga) y reporta cada
+    # consulta que tendría que recorrer todos los shards
+    def started(self, event):
+        for query in unscoped_filters(event.command_name, event.command):
+            logger.error(
+                "Consulta fuera de la shard key: %s.%s campos=%s",
+                event.command.get(event.command_name), event.command_name, sorted(query)
+            )
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
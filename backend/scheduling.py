@@ -0,0 +1,349 @@
+# Lógica de agenda sin dependencias de HTTP ni de la base de datos: todo trabaja
+# sobre minutos desde medianoche y fechas "YYYY-MM-DD"
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+def time_to_minutes(value: str) -> int:
+    parsed = datetime.strptime(value, "%H:%M")
+    return parsed.hour * 60 + parsed.minute
+
+def minutes_to_time(value: int) -> str:
+    return f"{value // 60:02d}:{value % 60:02d}"
+
+# Estados que ocupan un horario; los turnos cancelados se excluyen con $in en vez
+# de $ne para que las consultas usen los índices
+ACTIVE_STATUSES = ["pending", "confirmed"]
+# Turnos que no se cancelaron: los activos más los ya atendidos o a los que el cliente faltó
+BOOKED_STATUSES = ACTIVE_STATUSES + ["completed", "no_show"]
+# Ciclo de vida: estado destino -> estados desde los que se puede llegar
+# pending -> confirmed -> completed / no_show, y cancelled desde cualquier estado activo
+STATUS_TRANSITIONS = {
+    "confirmed": ["pending"],
+    "completed": ["confirmed"],
+    "no_show": ["confirmed"],
+    "cancelled": ACTIVE_STATUSES
+}
+
+# (inicio, fin, appointment_id, resource_id) en minutos desde medianoche
+Interval = Tuple[int, int, str, Optional[str]]
+
+def find_conflicts_single(intervals: List[Interval]) -> List[Tuple[str, str]]:
+    # Una sola pasada sobre los intervalos ordenados por inicio: cada intervalo se
+    # compara contra el que termina más tarde entre los anteriores
+    conflicts = []
+    max_end = None
+    max_key = None
+    for start, end, key, *_ in sorted(intervals):
+        if max_end is not None and start < max_end:
+            conflicts.append((max_key, key))
+        if max_end is None or end > max_end:
+            max_end = end
+            max_key = key
+    return conflicts
+
+def find_conflicts(intervals: List[Interval]) -> List[Tuple[str, str]]:
+    # Los turnos sin recurso asignado ocupan todos los recursos; los asignados
+    # solo compiten con los de su mismo recurso
+    unassigned = [i for i in intervals if i[3] is None]
+    by_resource: Dict[str, List[Interval]] = {}
+    for interval in intervals:
+        if interval[3] is not None:
+            by_resource.setdefault(interval[3], []).append(interval)
+    if not by_resource:
+        return find_conflicts_single(unassigned)
+    conflicts = set()
+    for assigned in by_resource.values():
+        conflicts.update(find_conflicts_single(unassigned + assigned))
+    return sorted(conflicts)
+
+def overlaps_any(intervals: List[Interval], start: int, end: int) -> bool:
+    return any(busy_start < end and start < busy_end for busy_start, busy_end, *_ in intervals)
+
+def resource_intervals(busy: List[Interval], resource_id: str) -> List[Interval]:
+    return [i for i in busy if i[3] is None or i[3] == resource_id]
+
+def assign_resource(busy: List[Interval], resource_ids: List[str], requested: Optional[str],
+                    start: int, end: int) -> Tuple[bool, Optional[str]]:
+    # Devuelve (disponible, recurso asignado); sin recursos se mantiene la capacidad única
+    if not resource_ids:
+        return not overlaps_any(busy, start, end), None
+    if requested:
+        if requested not in resource_ids:
+            return False, None
+        resource_ids = [requested]
+    resource_id = pick_resource(busy, resource_ids, start, end)
+    return resource_id is not None, resource_id
+
+def pick_resource(busy: List[Interval], resource_ids: List[str], start: int, end: int) -> Optional[str]:
+    # Primer recurso libre en el orden configurado en el servicio
+    for resource_id in resource_ids:
+        if not overlaps_any(resource_intervals(busy, resource_id), start, end):
+            return resource_id
+    return None
+
+def expand_series(series: dict, window_start: str, window_end: str) -> List[str]:
+    # Fechas de la serie dentro de [window_start, window_end] sin generar las anteriores
+    start = datetime.strptime(series['start_date'], "%Y-%m-%d")
+    first = datetime.strptime(window_start, "%Y-%m-%d")
+    last = datetime.strptime(window_end, "%Y-%m-%d")
+    if series.get('until'):
+        last = min(last, datetime.strptime(series['until'], "%Y-%m-%d"))
+    step = 7 * series.get('interval_weeks', 1)
+    
+    skip = max(0, -(-(first - start).days // step))
+    current = start + timedelta(days=skip * step)
+    exceptions = set(series.get('exceptions', []))
+    dates = []
+    while current <= last:
+        occurrence = current.strftime("%Y-%m-%d")
+        if occurrence not in exceptions:
+            dates.append(occurrence)
+        current += timedelta(days=step)
+    return dates
+
+def series_occurrence_id(series_id: str, date: str) -> str:
+    return f"{series_id}:{date}"
+
+SERIES_OCCURRENCE_FIELDS = ("user_id", "series_id", "service_id", "service_name", "service_duration",
+                            "resource_id", "client_name", "client_phone", "client_email", "time")
+
+def series_occurrences(series: dict, window_start: str, window_end: str) -> List[dict]:
+    # Ocurrencias de la serie con la misma forma que un documento de appointments,
+    # para listados, exportaciones y feeds
+    base = {field: series.get(field) for field in SERIES_OCCURRENCE_FIELDS}
+    return [
+        {**base, "appointment_id": series_occurrence_id(series['series_id'], date), "date": date,
+         "status": "confirmed"}
+        for date in expand_series(series, window_start, window_end)
+    ]
+
+def build_slot_grid(open_intervals: List[Tuple[int, int]], duration: int, interval: int) -> List[int]:
+    # Cada franja de atención arranca su propia grilla (turno mañana, turno tarde)
+    grid = []
+    for start, end in open_intervals:
+        grid.extend(range(start, end - duration + 1, interval))
+    return grid
+
+def merge_intervals(intervals, padding: int = 0) -> List[Tuple[int, int]]:
+    merged = []
+    for start, end, *_ in sorted(intervals):
+        start, end = start - padding, end + padding
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def filter_grid(grid: List[int], duration: int, busy, buffer: int = 0, not_before: int = 0) -> List[int]:
+    # Recorrido conjunto de la grilla y los intervalos ocupados (ambos ordenados)
+    merged = merge_intervals(busy, buffer)
+    free = []
+    i = 0
+    for start in grid:
+        if start < not_before:
+            continue
+        while i < len(merged) and merged[i][1] <= start:
+            i += 1
+        if i == len(merged) or merged[i][0] >= start + duration:
+            free.append(start)
+    return free
+
+def waitlist_fits(entry: dict, start: int, freed_start: int, freed_end: int) -> bool:
+    end = start + entry['service_duration']
+    if not (start < freed_end and end > freed_start):
+        return False
+    if entry.get('earliest_time') and start < time_to_minutes(entry['earliest_time']):
+        return False
+    if entry.get('latest_time') and end > time_to_minutes(entry['latest_time']):
+        return False
+    return True
+
+def collect_busy_intervals(dates, appointments: List[dict], durations: Dict[str, int],
+                           series_list: List[dict], exclude_ids=()) -> Dict[str, List[Interval]]:
+    # Arma los intervalos ocupados por fecha a partir de los turnos activos y de las
+    # series recurrentes, que se expanden solo sobre las fechas pedidas
+    busy = {date: [] for date in dates}
+    if not busy:
+        return busy
+    
+    for appt in appointments:
+        if appt['appointment_id'] in exclude_ids or appt['date'] not in busy:
+            continue
+        duration = appt.get('service_duration') or durations.get(appt['service_id'])
+        if not duration:
+            continue
+        start = time_to_minutes(appt['time'])
+        busy[appt['date']].append((start, start + duration, appt['appointment_id'], appt.get('resource_id')))
+    
+    first, last = min(busy), max(busy)
+    for series in series_list:
+        start = time_to_minutes(series['time'])
+        end = start + series['service_duration']
+        for occurrence in expand_series(series, first, last):
+            if occurrence in busy:
+                busy[occurrence].append((start, end, series_occurrence_id(series['series_id'], occurrence),
+                                         series.get('resource_id')))
+    return busy
+
+def sweep_free_starts(grid: List[int], duration: int, busy: List[Interval], resource_ids: List[str],
+                      buffer: int = 0, not_before: int = 0) -> Iterator[Tuple[int, Dict[str, int]]]:
+    # Un solo barrido sobre la grilla ordenada: cada intervalo (con su buffer) bloquea los
+    # inicios en (inicio - duración, fin). Se cuentan los bloqueos activos por recurso al
+    # entrar y salir de esas ventanas; los intervalos sin recurso bloquean a todos.
+    # Devuelve (inicio, bloqueos por recurso) para los inicios con algún recurso libre
+    counts = dict.fromkeys(resource_ids, 0)
+    relevant = [(start - buffer, end + buffer, r) for start, end, _, r in busy if r is None or r in counts]
+    blocks = sorted(((start - duration, r) for start, _, r in relevant), key=lambda e: e[0])
+    releases = sorted(((end, r) for _, end, r in relevant), key=lambda e: e[0])
+    shared = blocked = 0
+    b = e = 0
+    for start in grid:
+        while b < len(blocks) and blocks[b][0] < start:
+            resource_id = blocks[b][1]
+            if resource_id is None:
+                shared += 1
+            else:
+                counts[resource_id] += 1
+                blocked += counts[resource_id] == 1
+            b += 1
+        while e < len(releases) and releases[e][0] <= start:
+            resource_id = releases[e][1]
+            if resource_id is None:
+                shared -= 1
+            else:
+                counts[resource_id] -= 1
+                blocked -= counts[resource_id] == 0
+            e += 1
+        if start >= not_before and not shared and blocked < len(counts):
+            yield start, counts
+
+def available_starts(grid: List[int], duration: int, busy: List[Interval], resource_ids: Iterable[str],
+                     buffer: int = 0, not_before: int = 0) -> List[int]:
+    # Con recursos, un horario está libre si al menos un recurso del servicio lo está
+    resource_ids = list(dict.fromkeys(resource_ids))
+    if not resource_ids:
+        return filter_grid(grid, duration, busy, buffer, not_before)
+    return [start for start, _ in sweep_free_starts(grid, duration, busy, resource_ids, buffer, not_before)]
+
+def free_resources_by_start(grid: List[int], duration: int, busy: List[Interval], resource_ids: Iterable[str],
+                            buffer: int = 0, not_before: int = 0) -> Dict[int, List[str]]:
+    # Recursos libres en cada inicio disponible, en el orden configurado en el servicio
+    resource_ids = list(dict.fromkeys(resource_ids))
+    return {
+        start: [r for r in resource_ids if not counts[r]]
+        for start, counts in sweep_free_starts(grid, duration, busy, resource_ids, buffer, not_before)
+    }
+
+def date_range(start_date: str, end_date: str) -> List[str]:
+    current = datetime.strptime(start_date, "%Y-%m-%d")
+    last = datetime.strptime(end_date, "%Y-%m-%d")
+    dates = []
+    while current <= last:
+        dates.append(current.strftime("%Y-%m-%d"))
+        current += timedelta(days=1)
+    return dates
+
+def build_closure_index(closures: List[dict]) -> dict:
+    # Los cierres de días completos se fusionan en rangos disjuntos ordenados para
+    # resolver cada fecha con una búsqueda binaria; los cierres parciales se
+    # expanden por fecha con sus ventanas en minutos
+    full: List[Tuple[str, str]] = []
+    partial: Dict[str, List[Tuple[int, int]]] = {}
+    normalized = []
+    for closure in closures:
+        start_date = closure.get('start_date') or closure['date']
+        normalized.append((start_date, closure.get('end_date') or start_date, closure))
+    for start_date, end_date, closure in sorted(normalized, key=lambda c: c[:2]):
+        if closure.get('start_time') and closure.get('end_time'):
+            window = (time_to_minutes(closure['start_time']), time_to_minutes(closure['end_time']))
+            for date in date_range(start_date, end_date):
+                partial.setdefault(date, []).append(window)
+        elif full and start_date <= full[-1][1]:
+            full[-1] = (full[-1][0], max(full[-1][1], end_date))
+        else:
+            full.append((start_date, end_date))
+    return {"starts": [r[0] for r in full], "ends": [r[1] for r in full], "partial": partial}
+
+def closure_on(index: dict, date: str) -> Tuple[bool, List[Tuple[int, int]]]:
+    # (cerrado todo el día, ventanas cerradas) para una fecha
+    i = bisect_right(index['starts'], date) - 1
+    if i >= 0 and index['ends'][i] >= date:
+        return True, []
+    return False, index['partial'].get(date, [])
+
+def hours_intervals(hours: Optional[dict]) -> List[Tuple[int, int]]:
+    # Franjas de atención de un día, de la plantilla semanal o de una excepción por
+    # fecha; los horarios anteriores a las franjas solo tienen open_time/close_time
+    if not hours or not hours.get('is_open'):
+        return []
+    if hours.get('intervals'):
+        raw = [(time_to_minutes(i['open_time']), time_to_minutes(i['close_time'])) for i in hours['intervals']]
+    elif hours.get('open_time') and hours.get('close_time'):
+        raw = [(time_to_minutes(hours['open_time']), time_to_minutes(hours['close_time']))]
+    else:
+        return []
+    return merge_intervals([(start, end) for start, end in raw if start < end])
+
+def build_hours_template(weekly: List[dict], overrides: List[dict]) -> dict:
+    return {
+        "weekly": {h['day_of_week']: tuple(hours_intervals(h)) for h in weekly},
+        "overrides": {o['date']: tuple(hours_intervals(o)) for o in overrides}
+    }
+
+def open_intervals_on(template: dict, date: str) -> Tuple[Tuple[int, int], ...]:
+    if date in template['overrides']:
+        return template['overrides'][date]
+    return template['weekly'].get(datetime.strptime(date, "%Y-%m-%d").weekday(), ())
+
+def within_open(open_intervals, start: int, end: int) -> bool:
+    return any(open_start <= start and end <= open_end for open_start, open_end in open_intervals)
+
+@lru_cache(maxsize=None)
+def get_zone(name: str) -> ZoneInfo:
+    return ZoneInfo(name)
+
+@lru_cache(maxsize=65536)
+def day_offsets(zone_name: str, date: str) -> Tuple[int, int]:
+    # Offsets UTC (en minutos) al inicio y al final del día local; solo difieren en
+    # los días con cambio de horario, el resto se convierte con una suma
+    day = datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=get_zone(zone_name))
+    first = day.utcoffset()
+    last = (day + timedelta(hours=23, minutes=59)).utcoffset()
+    return int(first.total_seconds()) // 60, int(last.total_seconds()) // 60
+
+def local_to_utc(zone_name: str, date: str, minutes: int) -> datetime:
+    # Fecha y minutos desde medianoche en la hora local del negocio, llevados a UTC
+    start_offset, end_offset = day_offsets(zone_name, date)
+    midnight = datetime.strptime(date, "%Y-%m-%d")
+    if start_offset == end_offset:
+        return (midnight + timedelta(minutes=minutes - start_offset)).replace(tzinfo=timezone.utc)
+    local = (midnight + timedelta(minutes=minutes)).replace(tzinfo=get_zone(zone_name))
+    return local.astimezone(timezone.utc)
+
+def local_now(zone_name: str, now: Optional[datetime] = None) -> Tuple[str, int]:
+    # (fecha, minutos desde medianoche) actuales en la hora local del negocio
+    local = (now or datetime.now(timezone.utc)).astimezone(get_zone(zone_name))
+    return local.strftime("%Y-%m-%d"), local.hour * 60 + local.minute
+
+# Desfasajes extremos de los husos horarios respecto de UTC (UTC-12 a UTC+14)
+MIN_UTC_OFFSET = timedelta(hours=-12)
+MAX_UTC_OFFSET = timedelta(hours=14)
+
+def local_weekday_time_ranges(start: datetime, end: datetime) -> List[Tuple[int, str, str]]:
+    # (día de la semana, hora desde, hora hasta) que puede marcar un reloj local durante
+    # [start, end] en UTC, sea cual sea el huso horario del negocio
+    first = start + MIN_UTC_OFFSET
+    last = end + MAX_UTC_OFFSET
+    ranges = []
+    day = first.date()
+    while day <= last.date():
+        ranges.append((
+            day.weekday(),
+            first.strftime("%H:%M") if day == first.date() else "00:00",
+            last.strftime("%H:%M") if day == last.date() else "23:59"
+        ))
+        day += timedelta(days=1)
+    return ranges
@@ -1,49 +1,195 @@
-from fastapi import FastAPI, APIRouter, Depends, HTTPException, status, Request
+from fastapi import FastAPI, APIRouter, Depends, HTTPException, Request, UploadFile, File, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from fastapi.responses import StreamingResponse, Response
+from pymongo import UpdateOne, InsertOne, ReplaceOne, DeleteOne, DESCENDING, CursorType
+from pymongo.errors import CollectionInvalid, OperationFailure
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, EmailStr, Field, ConfigDict
-from typing import List, Optional
+from pydantic import BaseModel, EmailStr, Field, field_validator
+from typing import Dict, List, Literal, Optional, Tuple
 import uuid
+import hashlib
+import time
+import secrets
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
-from passlib.context import CryptContext
 from jose import jwt, JWTError
-import resend
 import asyncio
-import mercadopago
+import csv
+import io
+import zlib
+import json
+import re
+import unicodedata
+
+from scheduling import (
+    Interval, time_to_minutes, minutes_to_time, find_conflicts, overlaps_any, resource_intervals,
+    assign_resource, expand_series, series_occurrences,
+    build_slot_grid, merge_intervals, available_starts, free_resources_by_start, waitlist_fits, build_closure_index,
+    ACTIVE_STATUSES, BOOKED_STATUSES, STATUS_TRANSITIONS, closure_on, build_hours_template, open_intervals_on, within_open, get_zone, local_to_utc, local_now,
+    local_weekday_time_ranges
+)
+from repository import MotorSchedulingRepository, TenantScopeListener, CROSS_TENANT_COMMENT
+from profiling import (
+    CommandTimingListener, request_trace, new_trace, log_slow_operation, profiler_active, start_profiler,
+    profile_hot_spots
+)
+from log_pipeline import configure_logging, correlation_id, new_correlation_id
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+logger = logging.getLogger(__name__)
+webhook_logger = logging.getLogger("turnitos.webhooks")
+
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
 
-app = FastAPI(title="Turnitos API")
+# Umbrales del registro de operaciones lentas (milisegundos)
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', '1000'))
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+
+# Los clientes externos se crean en el primer uso para que importar el módulo
+# (y levantar un worker nuevo) no pague su costo de inicialización
+_lazy_clients: dict = {}
+
+def get_mongo_client():
+    if "mongo" not in _lazy_clients:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        listeners = [CommandTimingListener(SLOW_QUERY_MS)]
+        if os.environ.get('TENANT_SCOPE_CHECK') == '1':
+            listeners.append(TenantScopeListener())
+        _lazy_clients["mongo"] = AsyncIOMotorClient(mongo_url, tz_aware=True, event_listeners=listeners)
+    return _lazy_clients["mongo"]
+
+class LazyDatabase:
+    def __getattr__(self, name):
+        return getattr(get_mongo_client()[os.environ['DB_NAME']], name)
+
+    def __getitem__(self, name):
+        return get_mongo_client()[os.environ['DB_NAME']][name]
+
+db = LazyDatabase()
+# Reemplazable por InMemorySchedulingRepository para pruebas de carga sin MongoDB
+scheduling_repo = MotorSchedulingRepository(db)
+
 api_router = APIRouter(prefix="/api")
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
+def get_pwd_context():
+    if "pwd" not in _lazy_clients:
+        from passlib.context import CryptContext
+        _lazy_clients["pwd"] = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    return _lazy_clients["pwd"]
+
 SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'your-secret-key-change-in-production')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', '10000'))
+# Tiempo máximo que un worker tarda en notar una revocación hecha en otro worker
+TOKEN_VERSION_TTL_SECONDS = int(os.environ.get('TOKEN_VERSION_TTL_SECONDS', '30'))
 
 RESEND_API_KEY = os.environ.get('RESEND_API_KEY', '')
-if RESEND_API_KEY:
-    resend.api_key = RESEND_API_KEY
 
 MERCADOPAGO_ACCESS_TOKEN = os.environ.get('MERCADOPAGO_ACCESS_TOKEN', '')
 SUBSCRIPTION_PRICE = float(os.environ.get('SUBSCRIPTION_PRICE', '11999'))
 
-if MERCADOPAGO_ACCESS_TOKEN:
-    sdk = mercadopago.SDK(MERCADOPAGO_ACCESS_TOKEN)
-else:
-    sdk = None
+def get_resend():
+    if "resend" not in _lazy_clients:
+        import resend
+        resend.api_key = RESEND_API_KEY
+        _lazy_clients["resend"] = resend
+    return _lazy_clients["resend"]
+
+def get_mercadopago_sdk():
+    if not MERCADOPAGO_ACCESS_TOKEN:
+        return None
+    if "mercadopago" not in _lazy_clients:
+        import mercadopago
+        _lazy_clients["mercadopago"] = mercadopago.SDK(MERCADOPAGO_ACCESS_TOKEN)
+    return _lazy_clients["mercadopago"]
+
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', '5000'))
+EXPORT_BATCH_SIZE = 500
+# Ventana máxima en la que se expanden las series al exportar o listar ocurrencias
+SERIES_EXPAND_MAX_DAYS = 731
+EXPORT_CHUNK_BYTES = 64 * 1024
+CALENDAR_FEED_CACHE_SIZE = int(os.environ.get('CALENDAR_FEED_CACHE_SIZE', '1000'))
+# Margen para tolerar diferencias de reloj entre workers al leer cambios incrementales
+CALENDAR_FEED_SYNC_MARGIN = timedelta(seconds=5)
+SLOT_GRID_CACHE_SIZE = int(os.environ.get('SLOT_GRID_CACHE_SIZE', '5000'))
+CLOSURE_CACHE_SIZE = int(os.environ.get('CLOSURE_CACHE_SIZE', '5000'))
+HOURS_CACHE_SIZE = int(os.environ.get('HOURS_CACHE_SIZE', '5000'))
+CLOSURE_MAX_DAYS = 366
+CLOSURE_IMPORT_MAX_ITEMS = 1000
+DEFAULT_SLOT_INTERVAL = 15
+# Zona horaria IANA de los negocios que no configuraron una propia
+DEFAULT_TIMEZONE = os.environ.get('DEFAULT_TIMEZONE', 'America/Argentina/Buenos_Aires')
+# Las series sin fecha de fin se validan contra este horizonte
+SERIES_HORIZON_DAYS = int(os.environ.get('SERIES_HORIZON_DAYS', '365'))
+# Días hacia adelante en los que se expanden las series para listados, exportaciones y el feed
+SERIES_LIST_DAYS = int(os.environ.get('SERIES_LIST_DAYS', '60'))
+WAITLIST_MATCH_BATCH = int(os.environ.get('WAITLIST_MATCH_BATCH', '50'))
+SLOT_STREAM_QUEUE_SIZE = int(os.environ.get('SLOT_STREAM_QUEUE_SIZE', '32'))
+SLOT_STREAM_KEEPALIVE_SECONDS = 15
+# Colección capped que comparte los cambios de disponibilidad entre workers
+SLOT_EVENTS_CAP_BYTES = 16 * 1024 * 1024
+# Identifica los eventos publicados por este proceso para no reenviarlos dos veces
+WORKER_ID = uuid.uuid4().hex
+SEARCH_MAX_LIMIT = 100
+ROLLUP_BACKFILL_DAYS = int(os.environ.get('ROLLUP_BACKFILL_DAYS', '7'))
+ROLLUP_BACKFILL_INTERVAL_SECONDS = 24 * 60 * 60
+ANALYTICS_MAX_DAYS = 366
+OUTBOX_POLL_SECONDS = float(os.environ.get('OUTBOX_POLL_SECONDS', '5'))
+OUTBOX_LEASE_SECONDS = 60
+OUTBOX_MAX_ATTEMPTS = 5
+# Índices parciales por estado activo: (nombre, claves). Los pendientes se ordenan por
+# llegada (cola a confirmar) y los confirmados por fecha (agenda)
+STATUS_INDEXES = {
+    "pending": ("user_pending_by_created", [("user_id", 1), ("status", 1), ("created_at", 1)]),
+    "confirmed": ("user_confirmed_by_date", [("user_id", 1), ("status", 1), ("date", 1), ("time", 1)])
+}
+# Los turnos cancelados pasan al archivo cuando su fecha quedó atrás; el resto,
+# ARCHIVE_AFTER_DAYS días después
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '90'))
+ARCHIVE_BATCH_SIZE = 1000
+ARCHIVE_INTERVAL_SECONDS = int(os.environ.get('ARCHIVE_INTERVAL_SECONDS', '3600'))
+ARCHIVE_MAX_LIMIT = 200
+# Emails con acceso a las rutas /admin (perfilado)
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()}
+PROFILING_POLL_SECONDS = 5
+PROFILING_MAX_REQUESTS = 100
+PROFILE_RETENTION_SECONDS = 7 * 24 * 60 * 60
+SUBSCRIPTION_SWEEP_INTERVAL_SECONDS = int(os.environ.get('SUBSCRIPTION_SWEEP_INTERVAL_SECONDS', '300'))
+# Horas de anticipación del recordatorio por email; 0 desactiva los recordatorios
+REMINDER_HOURS_BEFORE = int(os.environ.get('REMINDER_HOURS_BEFORE', '24'))
+REMINDER_BATCH_SIZE = int(os.environ.get('REMINDER_BATCH_SIZE', '200'))
+REMINDER_POLL_SECONDS = float(os.environ.get('REMINDER_POLL_SECONDS', '60'))
+REMINDER_LEASE_SECONDS = 300
+
+background_tasks: List[asyncio.Task] = []
+# Referencias a las tareas sueltas en curso (matchers, eventos) para que el recolector no las descarte
+detached_tasks: set = set()
+calendar_feed_cache: "OrderedDict[str, dict]" = OrderedDict()
+slot_grid_cache: "OrderedDict[tuple, Optional[dict]]" = OrderedDict()
+closure_cache: "OrderedDict[tuple, dict]" = OrderedDict()
+hours_cache: "OrderedDict[tuple, dict]" = OrderedDict()
+verified_token_cache: "OrderedDict[str, dict]" = OrderedDict()
+token_version_cache: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+# Copia local del pedido de perfilado activo, releída cada PROFILING_POLL_SECONDS
+profiling_state = {"config": None, "expires": 0.0}
+# Se detecta al iniciar: las transacciones requieren replica set o cluster
+mongo_features = {"transactions": False, "slot_channel": False}
+outbox_wakeup = asyncio.Event()
+
+def run_detached(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    detached_tasks.add(task)
+    task.add_done_callback(detached_tasks.discard)
+    return task
 
 class UserRegister(BaseModel):
     email: EmailStr
@@ -68,6 +214,11 @@ class ServiceCreate(BaseModel):
     description: str
     duration_minutes: int
     price: float
+    # Si no se indican se usan los valores del negocio
+    slot_interval: Optional[int] = Field(default=None, ge=5, le=240)
+    buffer_minutes: Optional[int] = Field(default=None, ge=0, le=240)
+    # Recursos (profesionales, sillones) que pueden atender el servicio
+    resource_ids: List[str] = []
 
 class Service(BaseModel):
     service_id: str
@@ -76,21 +227,75 @@ class Service(BaseModel):
     description: str
     duration_minutes: int
     price: float
+    slot_interval: Optional[int] = None
+    buffer_minutes: Optional[int] = None
+    resource_ids: List[str] = []
+    active: bool = True
+
+class ResourceCreate(BaseModel):
+    name: str
+    kind: str = "staff"
+
+class Resource(BaseModel):
+    resource_id: str
+    user_id: str
+    name: str
+    kind: str
     active: bool = True
 
+class SchedulingSettings(BaseModel):
+    slot_interval: int = Field(default=15, ge=5, le=240)
+    buffer_minutes: int = Field(default=0, ge=0, le=240)
+    min_lead_minutes: int = Field(default=0, ge=0)
+    max_advance_days: Optional[int] = Field(default=None, ge=1)
+    timezone: str = DEFAULT_TIMEZONE
+
+    @field_validator('timezone')
+    @classmethod
+    def validate_timezone(cls, value: str) -> str:
+        try:
+            get_zone(value)
+        except (ValueError, KeyError):
+            raise ValueError("Zona horaria inválida")
+        return value
+
+class OpenInterval(BaseModel):
+    open_time: str
+    close_time: str
+
 class BusinessHoursUpdate(BaseModel):
     day_of_week: int
     is_open: bool
     open_time: Optional[str] = None
     close_time: Optional[str] = None
+    # Varias franjas por día (horario cortado); si falta se usa open_time/close_time
+    intervals: Optional[List[OpenInterval]] = None
+
+class HoursOverride(BaseModel):
+    is_open: bool
+    intervals: List[OpenInterval] = []
+    reason: Optional[str] = None
 
 class ClosedDateCreate(BaseModel):
-    date: str
+    # date se mantiene para un solo día; start_date/end_date definen un rango y
+    # start_time/end_time lo convierten en un cierre parcial de cada día
+    date: Optional[str] = None
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+    start_time: Optional[str] = None
+    end_time: Optional[str] = None
+    reason: Optional[str] = None
 
 class ClosedDate(BaseModel):
+    closure_id: str
     user_id: str
     date: str
+    start_date: str
+    end_date: str
+    start_time: Optional[str] = None
+    end_time: Optional[str] = None
     reason: Optional[str] = None
+    source: str = "manual"
 
 class BugReport(BaseModel):
     name: str
@@ -110,6 +315,7 @@ class AppointmentCreate(BaseModel):
     client_email: EmailStr
     date: str
     time: str
+    resource_id: Optional[str] = None
 
 class Appointment(BaseModel):
     appointment_id: str
@@ -124,51 +330,425 @@ class Appointment(BaseModel):
     status: str
     created_at: datetime
 
+class SeriesCreate(BaseModel):
+    service_id: str
+    client_name: str
+    client_phone: str
+    client_email: EmailStr
+    start_date: str
+    time: str
+    interval_weeks: int = Field(default=1, ge=1, le=52)
+    until: Optional[str] = None
+    resource_id: Optional[str] = None
+
+class WaitlistCreate(BaseModel):
+    service_id: str
+    client_name: str
+    client_phone: str
+    client_email: EmailStr
+    date: str
+    earliest_time: Optional[str] = None
+    latest_time: Optional[str] = None
+
+class BulkStatusRequest(BaseModel):
+    appointment_ids: List[str] = Field(min_length=1)
+    # La cancelación tiene sus propias rutas porque libera el horario
+    status: Literal["confirmed", "completed", "no_show"]
+
+class BulkCancelRequest(BaseModel):
+    start_date: str
+    end_date: str
+
+class RescheduleItem(BaseModel):
+    appointment_id: str
+    date: str
+    time: str
+
+class BulkRescheduleRequest(BaseModel):
+    items: List[RescheduleItem]
+
+class ProfilingRequest(BaseModel):
+    path_prefix: str = "/api/"
+    count: int = Field(default=1, ge=1, le=PROFILING_MAX_REQUESTS)
+
 class DashboardStats(BaseModel):
     total_appointments: int
     pending_appointments: int
     total_services: int
     trial_days_left: int
 
-def create_access_token(data: dict):
-    to_encode = data.copy()
+def create_access_token(user: dict):
+    # El token lleva el fin del acceso (acc) y la versión de tokens del usuario (tv)
+    # para autorizar la mayoría de los pedidos sin leer la base
+    access_until = get_access_until(user)
     expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    to_encode = {
+        "sub": user['user_id'],
+        "exp": expire,
+        "acc": access_until.timestamp() if access_until else None,
+        "sa": bool(user.get('subscription_active')),
+        "tv": user.get('token_version', 0)
+    }
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def lru_put(cache: OrderedDict, key, value, max_size: int):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
+def decode_token(token: str) -> dict:
+    key = hashlib.sha256(token.encode()).hexdigest()
+    cached = verified_token_cache.get(key)
+    if cached and cached['exp'] > time.time():
+        verified_token_cache.move_to_end(key)
+        return cached
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Token inválido")
-        user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="Usuario no encontrado")
-        return user
     except JWTError:
         raise HTTPException(status_code=401, detail="Token inválido")
+    if payload.get("sub") is None:
+        raise HTTPException(status_code=401, detail="Token inválido")
+    lru_put(verified_token_cache, key, payload, TOKEN_CACHE_SIZE)
+    return payload
+
+async def get_token_version(user_id: str) -> Optional[int]:
+    cached = token_version_cache.get(user_id)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    user = await db.users.find_one({"user_id": user_id}, {"_id": 0, "token_version": 1})
+    # Con la proyección un usuario sin token_version vuelve como {}; sólo None indica que no existe
+    if user is None:
+        return None
+    version = user.get('token_version', 0)
+    lru_put(token_version_cache, user_id, (version, time.monotonic() + TOKEN_VERSION_TTL_SECONDS), TOKEN_CACHE_SIZE)
+    return version
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    payload = decode_token(credentials.credentials)
+    user = await db.users.find_one({"user_id": payload['sub']}, {"_id": 0})
+    if not user:
+        raise HTTPException(status_code=401, detail="Usuario no encontrado")
+    if payload.get('tv', 0) != user.get('token_version', 0):
+        raise HTTPException(status_code=401, detail="Token inválido")
+    return user
+
+async def get_admin_user(current_user: dict = Depends(get_current_user)):
+    if current_user['email'].lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail="Acceso restringido")
+    return current_user
+
+async def get_current_claims(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    # Autoriza con los datos del token; solo consulta la base para validar la
+    # versión de tokens cuando vence su caché
+    payload = decode_token(credentials.credentials)
+    if "acc" not in payload:
+        # Tokens emitidos antes de incluir el acceso en los claims
+        return await get_current_user(credentials)
+    version = await get_token_version(payload['sub'])
+    if version is None:
+        raise HTTPException(status_code=401, detail="Usuario no encontrado")
+    if payload.get('tv', 0) != version:
+        raise HTTPException(status_code=401, detail="Token inválido")
+    access_until = payload['acc']
+    return {
+        "user_id": payload['sub'],
+        "subscription_active": payload.get('sa', False),
+        "access_until": datetime.fromtimestamp(access_until, tz=timezone.utc) if access_until is not None else None,
+        "from_token": True
+    }
+
+def normalize_search_text(value: str) -> str:
+    # Minúsculas y sin acentos para que "José" y "jose" coincidan
+    decomposed = unicodedata.normalize("NFKD", value or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower().strip()
+
+def client_search_terms(name: str, phone: str, email: str) -> List[str]:
+    # Prefijos indexables: cada palabra del nombre, el nombre completo, el email y
+    # los dígitos del teléfono
+    normalized_name = " ".join(normalize_search_text(name).split())
+    terms = set(normalized_name.split())
+    terms.add(normalized_name)
+    terms.add(normalize_search_text(email))
+    digits = re.sub(r"\D", "", phone or "")
+    if digits:
+        terms.add(digits)
+    terms.discard("")
+    return sorted(terms)
+
+def parse_datetime(value) -> Optional[datetime]:
+    if value is None or isinstance(value, datetime):
+        return value
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def compute_access_until(user: dict) -> Optional[datetime]:
+    # None significa acceso sin vencimiento (suscripción activa sin fecha de fin)
+    if user.get('subscription_active'):
+        return parse_datetime(user.get('subscription_ends'))
+    return parse_datetime(user['trial_ends'])
+
+def get_access_until(user: dict) -> Optional[datetime]:
+    # Los usuarios nuevos tienen access_until precalculado; los antiguos se calculan al vuelo
+    if 'access_until' in user:
+        return user['access_until']
+    return compute_access_until(user)
+
+def has_access(user: dict) -> bool:
+    access_until = get_access_until(user)
+    return access_until is None or datetime.now(timezone.utc) <= access_until
 
 async def check_subscription(user: dict):
-    trial_ends = user['trial_ends']
-    if isinstance(trial_ends, str):
-        trial_ends = datetime.fromisoformat(trial_ends)
-    
-    if user['subscription_active']:
-        if user.get('subscription_ends'):
-            sub_ends = user['subscription_ends']
-            if isinstance(sub_ends, str):
-                sub_ends = datetime.fromisoformat(sub_ends)
-            if datetime.now(timezone.utc) > sub_ends:
-                raise HTTPException(status_code=403, detail="Suscripción expirada")
-    else:
-        if datetime.now(timezone.utc) > trial_ends:
-            raise HTTPException(status_code=403, detail="Prueba gratuita expirada")
+    if not has_access(user) and user.get('from_token'):
+        # El token puede ser anterior a un pago; se confirma contra la base
+        user = await db.users.find_one({"user_id": user['user_id']}, {"_id": 0}) or user
+    if not has_access(user):
+        if user['subscription_active']:
+            raise HTTPException(status_code=403, detail="Suscripción expirada")
+        raise HTTPException(status_code=403, detail="Prueba gratuita expirada")
+
+async def run_in_transaction(callback):
+    # Sin replica set (p. ej. Mongo local standalone) se ejecuta sin transacción
+    if not mongo_features["transactions"]:
+        return await callback(None)
+    async with await get_mongo_client().start_session() as session:
+        return await session.with_transaction(callback)
+
+def outbox_email(recipient: str, subject: str, html: str) -> dict:
+    return {
+        "message_id": str(uuid.uuid4()),
+        "kind": "email",
+        "recipient": recipient,
+        "subject": subject,
+        "html": html,
+        "status": "pending",
+        "attempts": 0,
+        "available_at": datetime.now(timezone.utc),
+        "created_at": datetime.now(timezone.utc)
+    }
+
+async def dispatch_outbox_batch(limit: int = 50) -> int:
+    sent = 0
+    for _ in range(limit):
+        now = datetime.now(timezone.utc)
+        # El lease evita que dos workers envíen el mismo mensaje
+        message = await db.outbox.find_one_and_update(
+            {"status": "pending", "available_at": {"$lte": now}},
+            {"$set": {"available_at": now + timedelta(seconds=OUTBOX_LEASE_SECONDS)}, "$inc": {"attempts": 1}},
+            sort=[("available_at", 1)],
+            return_document=True,
+            projection={"_id": 0}
+        )
+        if not message:
+            break
+        try:
+            if not RESEND_API_KEY:
+                logger.warning("RESEND_API_KEY no configurada, email no enviado")
+            else:
+                await asyncio.to_thread(get_resend().Emails.send, {
+                    "from": "Turnitos <onboarding@resend.dev>",
+                    "to": [message['recipient']],
+                    "subject": message['subject'],
+                    "html": message['html']
+                })
+            await db.outbox.update_one({"message_id": message['message_id']}, {"$set": {"status": "sent"}})
+            sent += 1
+        except Exception as e:
+            logger.error("Error enviando email del outbox: %s", e)
+            if message['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+                await db.outbox.update_one({"message_id": message['message_id']}, {"$set": {"status": "failed"}})
+    return sent
+
+async def outbox_dispatcher():
+    while True:
+        try:
+            await dispatch_outbox_batch()
+        except Exception as e:
+            logger.error("Error procesando outbox: %s", e)
+        outbox_wakeup.clear()
+        try:
+            await asyncio.wait_for(outbox_wakeup.wait(), timeout=OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+def compute_remind_at(date: str, time: str, tz_name: str) -> Optional[datetime]:
+    if not REMINDER_HOURS_BEFORE:
+        return None
+    starts_at = local_to_utc(tz_name, date, time_to_minutes(time))
+    remind_at = starts_at - timedelta(hours=REMINDER_HOURS_BEFORE)
+    return remind_at if remind_at > datetime.now(timezone.utc) else None
+
+def with_reminder(appointment: dict, tz_name: str) -> dict:
+    # El campo solo existe mientras el recordatorio está pendiente, así el índice
+    # parcial sobre remind_at contiene únicamente la cola de envíos futuros
+    remind_at = None
+    if appointment.get('client_email'):
+        remind_at = compute_remind_at(appointment['date'], appointment['time'], tz_name)
+    if remind_at:
+        appointment['remind_at'] = remind_at
+    return appointment
+
+def merge_updates(*updates: dict) -> dict:
+    merged: dict = {}
+    for update in updates:
+        for operator, fields in update.items():
+            merged.setdefault(operator, {}).update(fields)
+    return merged
+
+def reminder_update(date: str, time: str, client_email: Optional[str], tz_name: str) -> dict:
+    remind_at = compute_remind_at(date, time, tz_name) if client_email else None
+    if remind_at:
+        return {"$set": {"remind_at": remind_at}}
+    return {"$unset": {"remind_at": ""}}
+
+async def dispatch_reminder_batch(limit: int = REMINDER_BATCH_SIZE) -> int:
+    # Toma un lote de recordatorios vencidos por el índice de remind_at y los
+    # reserva con un lease: si el worker muere, vuelven a vencer al expirar
+    now = datetime.now(timezone.utc)
+    due = await db.appointments.find(
+        {"remind_at": {"$lte": now}}, {"_id": 0, "appointment_id": 1, "user_id": 1},
+        comment=CROSS_TENANT_COMMENT
+    ).sort("remind_at", 1).to_list(limit)
+    if not due:
+        return 0
+    
+    lease_id = str(uuid.uuid4())
+    lease_until = now + timedelta(seconds=REMINDER_LEASE_SECONDS)
+    await db.appointments.bulk_write([
+        UpdateOne(
+            {"user_id": a['user_id'], "appointment_id": a['appointment_id'], "remind_at": {"$lte": now}},
+            {"$set": {"remind_at": lease_until, "reminder_lease": lease_id}}
+        )
+        for a in due
+    ], ordered=False)
+    claimed = await db.appointments.find(
+        {"remind_at": lease_until, "reminder_lease": lease_id},
+        {"_id": 0, "appointment_id": 1, "user_id": 1, "client_name": 1, "client_email": 1,
+         "service_name": 1, "date": 1, "time": 1},
+        comment=CROSS_TENANT_COMMENT
+    ).to_list(None)
+    if not claimed:
+        return len(due)
+    
+    users = await db.users.find(
+        {"user_id": {"$in": list({a['user_id'] for a in claimed})}},
+        {"_id": 0, "user_id": 1, "business_name": 1}
+    ).to_list(None)
+    business_names = {u['user_id']: u['business_name'] for u in users}
+    
+    operations = []
+    for appt in claimed:
+        html = f"""
+        <h2>Recordatorio de turno</h2>
+        <p>Hola {appt['client_name']},</p>
+        <p>Te recordamos tu turno:</p>
+        <ul>
+            <li><strong>Servicio:</strong> {appt['service_name']}</li>
+            <li><strong>Fecha:</strong> {appt['date']}</li>
+            <li><strong>Hora:</strong> {appt['time']}</li>
+            <li><strong>Negocio:</strong> {business_names.get(appt['user_id'], '')}</li>
+        </ul>
+        """
+        message = outbox_email(appt['client_email'], "Recordatorio de turno", html)
+        # Id determinístico: un lote reintentado tras un lease vencido no duplica el email
+        message['message_id'] = f"reminder:{appt['appointment_id']}:{appt['date']}:{appt['time']}"
+        operations.append(UpdateOne({"message_id": message['message_id']}, {"$setOnInsert": message}, upsert=True))
+    await db.outbox.bulk_write(operations, ordered=False)
+    
+    await db.appointments.bulk_write([
+        UpdateOne(
+            {"user_id": appt['user_id'], "appointment_id": appt['appointment_id'], "reminder_lease": lease_id},
+            {"$unset": {"remind_at": "", "reminder_lease": ""}, "$set": {"reminder_sent_at": now}}
+        )
+        for appt in claimed
+    ], ordered=False)
+    outbox_wakeup.set()
+    return len(due)
+
+async def dispatch_series_reminders() -> int:
+    # Las ocurrencias de series no tienen remind_at: en cada pasada se buscan las que
+    # empiezan dentro de las próximas REMINDER_HOURS_BEFORE horas y todavía no se avisaron.
+    # reminded_through guarda la última fecha avisada de cada serie
+    if not REMINDER_HOURS_BEFORE:
+        return 0
+    now = datetime.now(timezone.utc)
+    # Un día de margen a cada lado cubre la diferencia entre la fecha UTC y la local
+    first = (now - timedelta(days=1)).strftime("%Y-%m-%d")
+    last = (now + timedelta(hours=REMINDER_HOURS_BEFORE, days=1)).strftime("%Y-%m-%d")
+    # Solo las series cuyo día y hora pueden caer dentro de la ventana del recordatorio en
+    # algún huso horario; el índice {active, weekday, time} resuelve cada rango
+    time_ranges = local_weekday_time_ranges(now, now + timedelta(hours=REMINDER_HOURS_BEFORE))
+    series_list = await db.appointment_series.find({
+        "active": True,
+        "$or": [{"weekday": weekday, "time": {"$gte": since, "$lte": until}}
+                for weekday, since, until in time_ranges],
+        "client_email": {"$nin": [None, ""]},
+        "start_date": {"$lte": last},
+        "$and": [{"$or": [{"until": None}, {"until": {"$gte": first}}]}]
+    }, {"_id": 0}, comment=CROSS_TENANT_COMMENT).to_list(None)
+    if not series_list:
+        return 0
+    
+    users = await db.users.find(
+        {"user_id": {"$in": list({s['user_id'] for s in series_list})}},
+        {"_id": 0, "user_id": 1, "business_name": 1, "scheduling.timezone": 1}
+    ).to_list(None)
+    users_by_id = {u['user_id']: u for u in users}
+    
+    messages = []
+    reminded = []
+    for series in series_list:
+        user = users_by_id.get(series['user_id'], {})
+        tz_name = get_tenant_timezone(user)
+        start = time_to_minutes(series['time'])
+        due = [
+            o for o in series_occurrences(series, max(first, series.get('reminded_through') or first), last)
+            if o['date'] > (series.get('reminded_through') or "")
+            and local_to_utc(tz_name, o['date'], start) - timedelta(hours=REMINDER_HOURS_BEFORE) <= now
+            < local_to_utc(tz_name, o['date'], start)
+        ]
+        for occurrence in due:
+            html = f"""
+            <h2>Recordatorio de turno</h2>
+            <p>Hola {occurrence['client_name']},</p>
+            <p>Te recordamos tu turno:</p>
+            <ul>
+                <li><strong>Servicio:</strong> {occurrence['service_name']}</li>
+                <li><strong>Fecha:</strong> {occurrence['date']}</li>
+                <li><strong>Hora:</strong> {occurrence['time']}</li>
+                <li><strong>Negocio:</strong> {user.get('business_name', '')}</li>
+            </ul>
+            """
+            message = outbox_email(occurrence['client_email'], "Recordatorio de turno", html)
+            message['message_id'] = f"reminder:{occurrence['appointment_id']}:{occurrence['date']}:{occurrence['time']}"
+            messages.append(UpdateOne({"message_id": message['message_id']}, {"$setOnInsert": message}, upsert=True))
+        if due:
+            reminded.append(UpdateOne(
+                {"user_id": series['user_id'], "series_id": series['series_id']},
+                {"$max": {"reminded_through": due[-1]['date']}}
+            ))
+    if messages:
+        await db.outbox.bulk_write(messages, ordered=False)
+        await db.appointment_series.bulk_write(reminded, ordered=False)
+        outbox_wakeup.set()
+    return len(messages)
+
+async def reminder_dispatcher():
+    while True:
+        try:
+            # Vaciar la cola vencida antes de volver a esperar
+            while await dispatch_reminder_batch() == REMINDER_BATCH_SIZE:
+                pass
+            await dispatch_series_reminders()
+        except Exception as e:
+            logger.error("Error procesando recordatorios: %s", e)
+        await asyncio.sleep(REMINDER_POLL_SECONDS)
 
 async def send_email_async(recipient: str, subject: str, html: str):
     if not RESEND_API_KEY:
-        logging.warning("RESEND_API_KEY no configurada, email no enviado")
+        logger.warning("RESEND_API_KEY no configurada, email no enviado")
         return
     
     try:
@@ -178,10 +758,805 @@ async def send_email_async(recipient: str, subject: str, html: str):
             "subject": subject,
             "html": html
         }
-        await asyncio.to_thread(resend.Emails.send, params)
-        logging.info(f"Email enviado a {recipient}")
+        await asyncio.to_thread(get_resend().Emails.send, params)
+        logger.info("Email enviado a %s", recipient)
+    except Exception as e:
+        logger.error("Error enviando email: %s", e)
+
+async def get_service_durations(user_id: str, service_ids, session=None) -> Dict[str, int]:
+    return await scheduling_repo.get_service_durations(user_id, service_ids, session=session)
+
+async def get_series_in_window(user_id: str, window_start: str, window_end: str, weekdays=None,
+                               session=None) -> List[dict]:
+    return await scheduling_repo.find_series_in_window(user_id, window_start, window_end, weekdays,
+                                                       session=session)
+
+async def get_busy_intervals(user_id: str, dates, exclude_ids=(), session=None) -> Dict[str, List[Interval]]:
+    return await scheduling_repo.find_busy_intervals(user_id, dates, exclude_ids, session=session)
+
+async def list_series_occurrences(user_id: str, window_start: str, window_end: str) -> List[dict]:
+    # Las series no tienen un documento por fecha: se expanden sobre la ventana pedida
+    series_list = await scheduling_repo.find_series_in_window(user_id, window_start, window_end)
+    occurrences = [o for series in series_list for o in series_occurrences(series, window_start, window_end)]
+    return sorted(occurrences, key=lambda o: (o['date'], o['time']))
+
+def series_list_window() -> Tuple[str, str]:
+    # Misma ventana que la colección activa: lo que todavía no se archivó y SERIES_LIST_DAYS adelante
+    now = datetime.now(timezone.utc)
+    return (
+        (now - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d"),
+        (now + timedelta(days=SERIES_LIST_DAYS)).strftime("%Y-%m-%d")
+    )
+
+EXPORT_FIELDS = [
+    "appointment_id", "date", "time", "service_name", "service_duration",
+    "client_name", "client_phone", "client_email", "status"
+]
+
+def ics_escape(value) -> str:
+    return (str(value).replace("\\", "\\\\").replace(";", "\\;")
+            .replace(",", "\\,").replace("\n", "\\n"))
+
+def ics_fold(line: str) -> str:
+    # RFC 5545: las líneas de más de 75 octetos se continúan con un espacio inicial
+    encoded = line.encode("utf-8")
+    if len(encoded) <= 75:
+        return line + "\r\n"
+    parts = []
+    while encoded:
+        limit = 75 if not parts else 74
+        cut = min(limit, len(encoded))
+        # No cortar en medio de un carácter multibyte
+        while cut < len(encoded) and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode("utf-8"))
+        encoded = encoded[cut:]
+    return "\r\n ".join(parts) + "\r\n"
+
+def ics_event(appt: dict, business_name: str) -> str:
+    start = datetime.strptime(f"{appt['date']} {appt['time']}", "%Y-%m-%d %H:%M")
+    end = start + timedelta(minutes=appt.get('service_duration') or 30)
+    ics_status = "CANCELLED" if appt.get('status') == "cancelled" else "CONFIRMED"
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{appt['appointment_id']}@turnitos",
+        f"DTSTAMP:{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}",
+        f"DTSTART:{start.strftime('%Y%m%dT%H%M%S')}",
+        f"DTEND:{end.strftime('%Y%m%dT%H%M%S')}",
+        f"SUMMARY:{ics_escape(appt.get('service_name', ''))} - {ics_escape(appt.get('client_name', ''))}",
+        f"DESCRIPTION:{ics_escape('Tel: ' + appt.get('client_phone', ''))}",
+        f"LOCATION:{ics_escape(business_name)}",
+        f"STATUS:{ics_status}",
+        "END:VEVENT",
+    ]
+    return "".join(ics_fold(line) for line in lines)
+
+def ics_unfold(content: str) -> List[str]:
+    lines = []
+    for line in content.replace("\r\n", "\n").split("\n"):
+        if line[:1] in (" ", "\t") and lines:
+            lines[-1] += line[1:]
+        elif line:
+            lines.append(line)
+    return lines
+
+def parse_ics_closures(content: str) -> List[dict]:
+    # Eventos de día completo (DTSTART;VALUE=DATE, DTEND exclusivo) se importan como
+    # días cerrados; eventos con hora dentro de un mismo día, como cierres parciales
+    closures = []
+    event = None
+    for line in ics_unfold(content):
+        name, _, value = line.partition(":")
+        key = name.split(";")[0].upper()
+        if key == "BEGIN" and value.upper() == "VEVENT":
+            event = {}
+        elif key == "END" and value.upper() == "VEVENT" and event is not None:
+            if "DTSTART" in event:
+                closures.append(ics_event_closure(event))
+            event = None
+        elif event is not None and key in ("DTSTART", "DTEND", "SUMMARY"):
+            event[key] = value.strip()
+    return closures
+
+def ics_event_closure(event: dict) -> dict:
+    start = event["DTSTART"]
+    end = event.get("DTEND")
+    start_day = datetime.strptime(start[:8], "%Y%m%d")
+    closure = {"start_date": start_day.strftime("%Y-%m-%d"), "reason": event.get("SUMMARY")}
+    if len(start) == 8:
+        end_day = datetime.strptime(end[:8], "%Y%m%d") - timedelta(days=1) if end else start_day
+        closure["end_date"] = max(end_day, start_day).strftime("%Y-%m-%d")
+    elif end and end[:8] == start[:8]:
+        closure["end_date"] = closure["start_date"]
+        closure["start_time"] = f"{start[9:11]}:{start[11:13]}"
+        closure["end_time"] = f"{end[9:11]}:{end[11:13]}"
+    else:
+        end_day = datetime.strptime(end[:8], "%Y%m%d") if end else start_day
+        closure["end_date"] = end_day.strftime("%Y-%m-%d")
+    return closure
+
+def ics_header(calendar_name: str, tz_name: str) -> str:
+    # Los eventos usan hora local sin zona; X-WR-TIMEZONE indica cuál es
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//Turnitos//Turnos//ES",
+        "CALSCALE:GREGORIAN",
+        f"X-WR-CALNAME:{ics_escape(calendar_name)}",
+        f"X-WR-TIMEZONE:{tz_name}",
+    ]
+    return "".join(ics_fold(line) for line in lines)
+
+ICS_FOOTER = "END:VCALENDAR\r\n"
+
+# Una celda que empieza con estos caracteres es una fórmula para Excel o Sheets
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+def csv_safe(value):
+    # Los nombres y teléfonos vienen del formulario público: se neutralizan las fórmulas
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+async def stream_csv_rows(cursor):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    async for appt in cursor:
+        writer.writerow([csv_safe(appt.get(field, "")) for field in EXPORT_FIELDS])
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+async def stream_ics_events(cursor, business_name: str, tz_name: str):
+    chunk = [ics_header(business_name, tz_name)]
+    size = 0
+    async for appt in cursor:
+        event = ics_event(appt, business_name)
+        chunk.append(event)
+        size += len(event)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield "".join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(ICS_FOOTER)
+    yield "".join(chunk)
+
+async def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+async def encode_stream(chunks):
+    async for chunk in chunks:
+        yield chunk.encode("utf-8")
+
+def export_response(request: Request, chunks, media_type: str, filename: str) -> StreamingResponse:
+    headers = {
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Vary": "Accept-Encoding"
+    }
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return StreamingResponse(gzip_stream(chunks), media_type=media_type, headers=headers)
+    return StreamingResponse(encode_stream(chunks), media_type=media_type, headers=headers)
+
+def parse_date_window(start_date: str, end_date: str, max_days: int) -> Tuple[datetime, datetime]:
+    try:
+        first = datetime.strptime(start_date, "%Y-%m-%d")
+        last = datetime.strptime(end_date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Formato de fecha inválido")
+    if last < first or (last - first).days >= max_days:
+        raise HTTPException(status_code=400, detail=f"El rango debe ser de hasta {max_days} días")
+    return first, last
+
+def export_series_window(start_date: Optional[str], end_date: Optional[str]) -> Tuple[str, str]:
+    # Se valida antes de empezar a transmitir: un error dentro del generador cortaría la
+    # respuesta a la mitad. Sin fechas, las series se expanden sobre la ventana del listado
+    default_start, default_end = series_list_window()
+    window = (start_date or default_start, end_date or default_end)
+    parse_date_window(*window, SERIES_EXPAND_MAX_DAYS)
+    return window
+
+async def export_cursor(user_id: str, start_date: Optional[str], end_date: Optional[str], include_cancelled: bool,
+                        series_window: Tuple[str, str]):
+    # Primero el archivo (turnos más viejos) y después los turnos vigentes
+    query = {"user_id": user_id}
+    date_range = {}
+    if start_date:
+        date_range["$gte"] = start_date
+    if end_date:
+        date_range["$lte"] = end_date
+    if date_range:
+        query["date"] = date_range
+    if not include_cancelled:
+        query["status"] = {"$in": BOOKED_STATUSES}
+    # Las ocurrencias de series se intercalan en orden de fecha y hora
+    occurrences = await list_series_occurrences(user_id, *series_window)
+    position = 0
+    projection = {"_id": 0, **{field: 1 for field in EXPORT_FIELDS}}
+    for collection in (db.appointments_archive, db.appointments):
+        cursor = collection.find(query, projection).sort([("date", 1), ("time", 1)]).batch_size(EXPORT_BATCH_SIZE)
+        async for appt in cursor:
+            while position < len(occurrences) and (
+                (occurrences[position]['date'], occurrences[position]['time']) < (appt['date'], appt['time'])
+            ):
+                yield occurrences[position]
+                position += 1
+            yield appt
+    for occurrence in occurrences[position:]:
+        yield occurrence
+
+class SlotEventBroker:
+    """Reparte cambios de disponibilidad a las páginas públicas abiertas en este worker.
+
+    Las suscripciones se indexan por negocio y fecha, así que publicar un cambio
+    solo toca las colas interesadas y el evento se serializa una única vez.
+    """
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.subscribers: Dict[str, Dict[str, set]] = {}
+
+    def subscribe(self, user_id: str, date: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.setdefault(user_id, {}).setdefault(date, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, date: str, queue: asyncio.Queue):
+        dates = self.subscribers.get(user_id, {})
+        queues = dates.get(date)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del dates[date]
+        if not dates:
+            self.subscribers.pop(user_id, None)
+
+    def publish(self, user_id: str, date: Optional[str], event: dict):
+        dates = self.subscribers.get(user_id)
+        if not dates:
+            return
+        targets = [date] if date else list(dates)
+        for target in targets:
+            queues = dates.get(target)
+            if not queues:
+                continue
+            message = f"data: {json.dumps({**event, 'date': target})}\n\n"
+            for queue in queues:
+                try:
+                    queue.put_nowait(message)
+                except asyncio.QueueFull:
+                    # Cliente lento: se descartan sus eventos pendientes y se le pide recargar
+                    while not queue.empty():
+                        queue.get_nowait()
+                    queue.put_nowait(f"data: {json.dumps({'type': 'changed', 'date': target})}\n\n")
+
+slot_events = SlotEventBroker(SLOT_STREAM_QUEUE_SIZE)
+
+def publish_slot_change(user_id: str, date: Optional[str], change: str, time: Optional[str] = None,
+                        duration: Optional[int] = None, resource_id: Optional[str] = None):
+    event = {"type": change}
+    if time is not None:
+        start = time_to_minutes(time)
+        event.update({
+            "start": time,
+            "end": minutes_to_time(start + (duration or 30)),
+            "resource_id": resource_id
+        })
+    slot_events.publish(user_id, date, event)
+    if mongo_features["slot_channel"]:
+        run_detached(share_slot_event(user_id, date, event))
+
+async def share_slot_event(user_id: str, date: Optional[str], event: dict):
+    try:
+        await db.slot_events.insert_one({
+            "worker_id": WORKER_ID,
+            "user_id": user_id,
+            "date": date,
+            "event": event,
+            "created_at": datetime.now(timezone.utc)
+        })
     except Exception as e:
-        logging.error(f"Error enviando email: {str(e)}")
+        logger.warning("No se pudo compartir el cambio de disponibilidad: %s", e)
+
+async def ensure_slot_events_collection():
+    try:
+        await db.create_collection("slot_events", capped=True, size=SLOT_EVENTS_CAP_BYTES)
+    except (CollectionInvalid, OperationFailure):
+        # Ya la creó otro worker
+        pass
+    mongo_features["slot_channel"] = True
+
+async def slot_event_relay():
+    # Reenvía a las páginas abiertas en este worker los cambios publicados por los demás.
+    # El cursor tailable sobre la colección capped espera documentos nuevos sin sondear
+    # y, a diferencia de un change stream, funciona también sin replica set
+    await ensure_slot_events_collection()
+    query = {"created_at": {"$gte": datetime.now(timezone.utc)}}
+    while True:
+        try:
+            cursor = db.slot_events.find(query, cursor_type=CursorType.TAILABLE_AWAIT, comment=CROSS_TENANT_COMMENT)
+            while cursor.alive:
+                async for doc in cursor:
+                    query = {"_id": {"$gt": doc['_id']}}
+                    if doc['worker_id'] != WORKER_ID:
+                        slot_events.publish(doc['user_id'], doc['date'], doc['event'])
+                await asyncio.sleep(1)
+        except Exception as e:
+            logger.error("Error leyendo cambios de disponibilidad: %s", e)
+        # Un cursor muerto (colección vacía o reiniciada) se vuelve a abrir
+        await asyncio.sleep(1)
+
+CLIENT_FIELDS = {"_id": 0, "client_name": 1, "client_phone": 1, "client_email": 1, "service_price": 1, "date": 1}
+
+def client_key(email: Optional[str], phone: Optional[str]) -> str:
+    email = normalize_search_text(email or "")
+    if email:
+        return email
+    return "tel:" + re.sub(r"\D", "", phone or "")
+
+# Estados que cuentan como visita del cliente: un ausente no vino
+VISIT_STATUSES = ACTIVE_STATUSES + ["completed"]
+
+async def record_client_bookings(user_id: str, appointments: List[dict]):
+    # Un upsert por cliente con los totales acumulados del lote. last_visit es la
+    # última visita ya ocurrida: los turnos futuros la actualizan al pasar su fecha
+    # (roll_client_visits)
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    operations = []
+    for appt in appointments:
+        key = client_key(appt.get('client_email'), appt.get('client_phone'))
+        update = {
+            "$set": {
+                "client_name": appt.get('client_name'),
+                "client_phone": appt.get('client_phone'),
+                "client_email": appt.get('client_email'),
+                "updated_at": datetime.now(timezone.utc)
+            },
+            "$inc": {"booking_count": 1, "total_spend": appt.get('service_price') or 0},
+            "$min": {"first_visit": appt['date']}
+        }
+        if appt['date'] <= today:
+            update["$max"] = {"last_visit": appt['date']}
+        operations.append(UpdateOne({"user_id": user_id, "client_key": key}, update, upsert=True))
+    if operations:
+        await db.clients.bulk_write(operations, ordered=False)
+
+async def record_client_no_shows(user_id: str, appointments: List[dict]):
+    operations = [
+        UpdateOne(
+            {"user_id": user_id, "client_key": client_key(appt.get('client_email'), appt.get('client_phone'))},
+            {"$inc": {"no_show_count": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}}
+        )
+        for appt in appointments
+    ]
+    if operations:
+        await db.clients.bulk_write(operations, ordered=False)
+
+async def refresh_client_visits(user_id: str, appointments: List[dict]):
+    # Una cancelación o una ausencia puede haber sido la primera o la última visita
+    # del cliente: se recalculan desde sus turnos
+    keys = list({client_key(a.get('client_email'), a.get('client_phone')) for a in appointments})
+    if not keys:
+        return
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    match = {"user_id": user_id, "client_key": {"$in": keys}, "status": {"$in": VISIT_STATUSES}}
+    visits = await db.appointments.aggregate([
+        {"$match": match},
+        {"$unionWith": {"coll": "appointments_archive", "pipeline": [{"$match": match}]}},
+        {"$group": {
+            "_id": "$client_key",
+            "first_visit": {"$min": "$date"},
+            "last_visit": {"$max": {"$cond": [{"$lte": ["$date", today]}, "$date", None]}}
+        }}
+    ]).to_list(None)
+    found = {v['_id']: v for v in visits}
+    await db.clients.bulk_write([
+        UpdateOne(
+            {"user_id": user_id, "client_key": key},
+            {"$set": {"first_visit": found.get(key, {}).get('first_visit'),
+                      "last_visit": found.get(key, {}).get('last_visit')}}
+        )
+        for key in keys
+    ], ordered=False)
+
+async def roll_client_visits(start_date: str, end_date: str):
+    # Los turnos que pasaron a ser visitas ocurridas adelantan last_visit de su cliente
+    match = {"date": {"$gte": start_date, "$lte": end_date}, "status": {"$in": VISIT_STATUSES},
+             "client_key": {"$exists": True}}
+    await db.appointments.aggregate([
+        {"$match": match},
+        {"$group": {"_id": {"user_id": "$user_id", "client_key": "$client_key"}, "last_visit": {"$max": "$date"}}},
+        {"$project": {"_id": 0, "user_id": "$_id.user_id", "client_key": "$_id.client_key", "last_visit": 1}},
+        {"$merge": {
+            "into": "clients",
+            "on": ["user_id", "client_key"],
+            "whenMatched": [{"$set": {"last_visit": {"$max": ["$last_visit", "$$new.last_visit"]}}}],
+            "whenNotMatched": "discard"
+        }}
+    ], comment=CROSS_TENANT_COMMENT).to_list(None)
+
+async def record_client_cancellations(user_id: str, appointments: List[dict]):
+    operations = [
+        UpdateOne(
+            {"user_id": user_id, "client_key": client_key(appt.get('client_email'), appt.get('client_phone'))},
+            {
+                "$inc": {
+                    "booking_count": -1,
+                    "cancelled_count": 1,
+                    "total_spend": -(appt.get('service_price') or 0)
+                },
+                "$set": {"updated_at": datetime.now(timezone.utc)}
+            }
+        )
+        for appt in appointments
+    ]
+    if operations:
+        await db.clients.bulk_write(operations, ordered=False)
+        await refresh_client_visits(user_id, appointments)
+
+async def rebuild_clients(user_id: str):
+    # Reconstruye los agregados del negocio desde los turnos (para datos previos al campo),
+    # con la misma clave y las mismas reglas de visitas que el camino incremental
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    is_visit = {"$in": ["$status", VISIT_STATUSES]}
+    await db.appointments.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$unionWith": {"coll": "appointments_archive", "pipeline": [{"$match": {"user_id": user_id}}]}},
+        {"$sort": {"date": 1}},
+        {"$group": {
+            # Turnos anteriores al backfill de client_key
+            "_id": {"$ifNull": ["$client_key", {"$toLower": "$client_email"}]},
+            "client_name": {"$last": "$client_name"},
+            "client_phone": {"$last": "$client_phone"},
+            "client_email": {"$last": "$client_email"},
+            "booking_count": {"$sum": {"$cond": [{"$eq": ["$status", "cancelled"]}, 0, 1]}},
+            "cancelled_count": {"$sum": {"$cond": [{"$eq": ["$status", "cancelled"]}, 1, 0]}},
+            "no_show_count": {"$sum": {"$cond": [{"$eq": ["$status", "no_show"]}, 1, 0]}},
+            "total_spend": {"$sum": {"$cond": [
+                {"$eq": ["$status", "cancelled"]}, 0, {"$ifNull": ["$service_price", 0]}
+            ]}},
+            "first_visit": {"$min": {"$cond": [is_visit, "$date", None]}},
+            "last_visit": {"$max": {"$cond": [{"$and": [is_visit, {"$lte": ["$date", today]}]}, "$date", None]}}
+        }},
+        {"$project": {
+            "_id": 0,
+            "user_id": user_id,
+            "client_key": "$_id",
+            "client_name": 1, "client_phone": 1, "client_email": 1,
+            "booking_count": 1, "cancelled_count": 1, "no_show_count": 1, "total_spend": 1,
+            "first_visit": 1, "last_visit": 1,
+            "updated_at": "$$NOW"
+        }},
+        {"$merge": {"into": "clients", "on": ["user_id", "client_key"], "whenMatched": "replace"}}
+    ]).to_list(None)
+
+async def record_daily_stats(user_id: str, appointments: List[dict], sign: int = 1, cancelled: bool = False):
+    # Rollup diario por negocio: contadores, facturación, minutos reservados y turnos por hora
+    operations = []
+    for appt in appointments:
+        inc = {
+            "appointments": sign,
+            "revenue": sign * (appt.get('service_price') or 0),
+            "booked_minutes": sign * (appt.get('service_duration') or 30),
+            f"by_hour.{appt['time'][:2]}": sign
+        }
+        if cancelled:
+            inc["cancelled"] = 1
+        operations.append(UpdateOne(
+            {"user_id": user_id, "date": appt['date']},
+            {"$inc": inc},
+            upsert=True
+        ))
+    if operations:
+        await db.daily_stats.bulk_write(operations, ordered=False)
+
+async def track_bookings(user_id: str, appointments: List[dict]):
+    await asyncio.gather(
+        record_client_bookings(user_id, appointments),
+        record_daily_stats(user_id, appointments)
+    )
+
+async def track_cancellations(user_id: str, appointments: List[dict]):
+    await asyncio.gather(
+        record_client_cancellations(user_id, appointments),
+        record_daily_stats(user_id, appointments, sign=-1, cancelled=True)
+    )
+
+async def rebuild_daily_stats(start_date: str, end_date: str, user_id: Optional[str] = None):
+    # Recalcula los rollups del rango desde los turnos y reemplaza los documentos
+    match = {"date": {"$gte": start_date, "$lte": end_date}}
+    if user_id:
+        match["user_id"] = user_id
+    active = {"$ne": ["$status", "cancelled"]}
+    # Sin user_id es el backfill de todos los negocios
+    options = {} if user_id else {"comment": CROSS_TENANT_COMMENT}
+    await db.appointments.aggregate([
+        {"$match": match},
+        {"$unionWith": {"coll": "appointments_archive", "pipeline": [{"$match": match}]}},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "date": "$date", "hour": {"$substrCP": ["$time", 0, 2]}},
+            "appointments": {"$sum": {"$cond": [active, 1, 0]}},
+            "cancelled": {"$sum": {"$cond": [active, 0, 1]}},
+            "revenue": {"$sum": {"$cond": [active, {"$ifNull": ["$service_price", 0]}, 0]}},
+            "booked_minutes": {"$sum": {"$cond": [active, {"$ifNull": ["$service_duration", 30]}, 0]}}
+        }},
+        {"$group": {
+            "_id": {"user_id": "$_id.user_id", "date": "$_id.date"},
+            "appointments": {"$sum": "$appointments"},
+            "cancelled": {"$sum": "$cancelled"},
+            "revenue": {"$sum": "$revenue"},
+            "booked_minutes": {"$sum": "$booked_minutes"},
+            "by_hour": {"$push": {"k": "$_id.hour", "v": "$appointments"}}
+        }},
+        {"$project": {
+            "_id": 0,
+            "user_id": "$_id.user_id",
+            "date": "$_id.date",
+            "appointments": 1, "cancelled": 1, "revenue": 1, "booked_minutes": 1,
+            "by_hour": {"$arrayToObject": "$by_hour"}
+        }},
+        {"$merge": {"into": "daily_stats", "on": ["user_id", "date"], "whenMatched": "replace"}}
+    ], **options).to_list(None)
+
+def analytics_period(date: str, granularity: str) -> str:
+    if granularity == "month":
+        return date[:7]
+    if granularity == "week":
+        year, week, _ = datetime.strptime(date, "%Y-%m-%d").isocalendar()
+        return f"{year}-W{week:02d}"
+    return date
+
+async def bump_appointments_version(user_id: str):
+    # La versión de turnos del negocio invalida feeds de calendario y ETags
+    await db.users.update_one({"user_id": user_id}, {"$inc": {"appointments_version": 1}})
+
+def apply_feed_changes(events: dict, appointments, today: str):
+    # Mismo criterio que la carga inicial: entran los turnos de BOOKED_STATUSES desde hoy
+    for appt in appointments:
+        if appt.get('status') not in BOOKED_STATUSES or appt['date'] < today:
+            events.pop(appt['appointment_id'], None)
+        else:
+            events[appt['appointment_id']] = (appt['date'], appt['time'], appt)
+
+def render_feed(events: dict, business_name: str, tz_name: str) -> str:
+    ordered = sorted(events.values(), key=lambda e: (e[0], e[1]))
+    return ics_header(business_name, tz_name) + "".join(ics_event(e[2], business_name) for e in ordered) + ICS_FOOTER
+
+async def get_calendar_feed(user: dict) -> str:
+    user_id = user['user_id']
+    version = user.get('appointments_version', 0)
+    tz_name = get_tenant_timezone(user)
+    # "Hoy" es el del negocio: en UTC el feed descartaría los turnos de la noche local antes de tiempo
+    today, _ = local_now(tz_name)
+    projection = {"_id": 0, **{field: 1 for field in EXPORT_FIELDS}}
+    
+    cached = calendar_feed_cache.get(user_id)
+    if cached and cached['version'] == version and cached['today'] == today:
+        calendar_feed_cache.move_to_end(user_id)
+        return cached['body']
+    
+    synced_at = datetime.now(timezone.utc)
+    if cached:
+        # Solo se leen los turnos modificados desde la última sincronización
+        events = cached['events']
+        changed = await db.appointments.find({
+            "user_id": user_id,
+            "updated_at": {"$gte": cached['synced_at'] - CALENDAR_FEED_SYNC_MARGIN}
+        }, projection).to_list(None)
+        apply_feed_changes(events, changed, today)
+        if cached['today'] != today:
+            for appointment_id in [k for k, e in events.items() if e[0] < today]:
+                del events[appointment_id]
+    else:
+        events = {}
+        upcoming = await db.appointments.find({
+            "user_id": user_id,
+            "date": {"$gte": today},
+            "status": {"$in": BOOKED_STATUSES}
+        }, projection).to_list(None)
+        apply_feed_changes(events, upcoming, today)
+    
+    # Las series se vuelven a expandir en cada regeneración: crearlas o cancelarlas cambia la versión
+    last_day = (datetime.strptime(today, "%Y-%m-%d") + timedelta(days=SERIES_LIST_DAYS)).strftime("%Y-%m-%d")
+    series_events = {
+        o['appointment_id']: (o['date'], o['time'], o)
+        for o in await list_series_occurrences(user_id, today, last_day)
+    }
+    body = render_feed({**events, **series_events}, user['business_name'], tz_name)
+    calendar_feed_cache[user_id] = {
+        "version": version,
+        "today": today,
+        "synced_at": synced_at,
+        "events": events,
+        "body": body
+    }
+    calendar_feed_cache.move_to_end(user_id)
+    while len(calendar_feed_cache) > CALENDAR_FEED_CACHE_SIZE:
+        calendar_feed_cache.popitem(last=False)
+    return body
+
+def get_scheduling_settings(user: dict, service: Optional[dict] = None) -> dict:
+    settings = SchedulingSettings(**user.get('scheduling', {})).model_dump()
+    if service:
+        for key in ("slot_interval", "buffer_minutes"):
+            if service.get(key) is not None:
+                settings[key] = service[key]
+    return settings
+
+def get_tenant_timezone(user: dict) -> str:
+    return user.get('scheduling', {}).get('timezone') or DEFAULT_TIMEZONE
+
+async def find_tenant_timezone(user_id: str) -> str:
+    # Para rutas que solo tienen los claims del token
+    user = await db.users.find_one({"user_id": user_id}, {"_id": 0, "scheduling.timezone": 1})
+    return get_tenant_timezone(user or {})
+
+async def bump_schedule_version(user_id: str):
+    # Invalida las grillas de horarios precalculadas del negocio en todos los workers
+    await db.users.update_one({"user_id": user_id}, {"$inc": {"schedule_version": 1}})
+
+async def get_active_resource_ids(user_id: str, service: dict, session=None) -> List[str]:
+    if not service.get('resource_ids'):
+        return []
+    return await scheduling_repo.get_active_resource_ids(user_id, service['resource_ids'], session=session)
+
+async def get_hours_template(user: dict) -> dict:
+    # Plantilla semanal y excepciones por fecha del negocio, cacheadas por schedule_version
+    key = (user['user_id'], user.get('schedule_version', 0))
+    if key in hours_cache:
+        hours_cache.move_to_end(key)
+        return hours_cache[key]
+    from_date = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%d")
+    template = build_hours_template(
+        await scheduling_repo.find_business_hours(user['user_id']),
+        await scheduling_repo.find_hours_overrides(user['user_id'], from_date)
+    )
+    lru_put(hours_cache, key, template, HOURS_CACHE_SIZE)
+    return template
+
+async def get_slot_grid(user: dict, service_id: str, open_intervals) -> Optional[dict]:
+    # Los candidatos de cada (franjas de atención, servicio) solo cambian al modificar
+    # horarios, servicios o la configuración, que incrementan schedule_version
+    key = (user['user_id'], user.get('schedule_version', 0), tuple(open_intervals), service_id)
+    if key in slot_grid_cache:
+        slot_grid_cache.move_to_end(key)
+        return slot_grid_cache[key]
+    
+    service = await scheduling_repo.get_service(user['user_id'], service_id)
+    if not service:
+        return None
+    
+    settings = get_scheduling_settings(user, service)
+    duration = service.get('duration_minutes', 30)
+    grid = build_slot_grid(open_intervals, duration, settings['slot_interval'])
+    resource_ids = await get_active_resource_ids(user['user_id'], service)
+    # Un servicio cuyos recursos fueron todos desactivados no tiene disponibilidad
+    if service.get('resource_ids') and not resource_ids:
+        grid = []
+    entry = {"grid": grid, "duration": duration, "settings": settings, "resource_ids": resource_ids}
+    
+    slot_grid_cache[key] = entry
+    while len(slot_grid_cache) > SLOT_GRID_CACHE_SIZE:
+        slot_grid_cache.popitem(last=False)
+    return entry
+
+def normalize_hours(is_open: bool, open_time: Optional[str], close_time: Optional[str],
+                    intervals: Optional[List[OpenInterval]]) -> dict:
+    # Valida las franjas y devuelve los campos que se guardan; open_time/close_time
+    # quedan como apertura y cierre del día para los clientes que no leen las franjas
+    if not is_open:
+        return {"is_open": False, "open_time": None, "close_time": None, "intervals": []}
+    if not intervals:
+        # Un día que se reabre llega con las franjas vacías y solo la apertura y el cierre
+        intervals = [OpenInterval(open_time=open_time, close_time=close_time)] if open_time and close_time else []
+    elif open_time and close_time:
+        # Un cliente que solo edita open_time/close_time reenvía las franjas que cargó: la
+        # apertura y el cierre editados mueven el inicio de la primera y el fin de la última
+        intervals = sorted(intervals, key=lambda i: i.open_time)
+        intervals = [OpenInterval(open_time=open_time, close_time=intervals[0].close_time), *intervals[1:]]
+        intervals[-1] = OpenInterval(open_time=intervals[-1].open_time, close_time=close_time)
+    try:
+        parsed = sorted((time_to_minutes(i.open_time), time_to_minutes(i.close_time)) for i in intervals)
+    except ValueError:
+        raise ValueError("Formato de hora inválido")
+    if not parsed:
+        raise ValueError("Un día abierto necesita al menos una franja horaria")
+    if any(start >= end for start, end in parsed):
+        raise ValueError("La hora de cierre debe ser posterior a la de apertura")
+    if any(parsed[i][1] > parsed[i + 1][0] for i in range(len(parsed) - 1)):
+        raise ValueError("Las franjas horarias no pueden superponerse")
+    return {
+        "is_open": True,
+        "open_time": minutes_to_time(parsed[0][0]),
+        "close_time": minutes_to_time(parsed[-1][1]),
+        "intervals": [{"open_time": minutes_to_time(start), "close_time": minutes_to_time(end)}
+                      for start, end in parsed]
+    }
+
+def normalize_closure(data: ClosedDateCreate) -> dict:
+    # Valida el cierre y devuelve los campos que se guardan; lanza ValueError con el motivo
+    start_date = data.start_date or data.date
+    if not start_date:
+        raise ValueError("Falta la fecha del cierre")
+    end_date = data.end_date or start_date
+    try:
+        first = datetime.strptime(start_date, "%Y-%m-%d")
+        last = datetime.strptime(end_date, "%Y-%m-%d")
+        start_minutes = time_to_minutes(data.start_time) if data.start_time else None
+        end_minutes = time_to_minutes(data.end_time) if data.end_time else None
+    except ValueError:
+        raise ValueError("Formato de fecha u hora inválido")
+    if last < first:
+        raise ValueError("La fecha de fin debe ser posterior a la de inicio")
+    if (last - first).days >= CLOSURE_MAX_DAYS:
+        raise ValueError(f"El cierre puede abarcar hasta {CLOSURE_MAX_DAYS} días")
+    if (start_minutes is None) != (end_minutes is None):
+        raise ValueError("El cierre parcial necesita hora de inicio y de fin")
+    if start_minutes is not None and start_minutes >= end_minutes:
+        raise ValueError("La hora de fin debe ser posterior a la de inicio")
+    return {
+        "date": start_date,
+        "start_date": start_date,
+        "end_date": end_date,
+        "start_time": data.start_time,
+        "end_time": data.end_time,
+        "reason": data.reason
+    }
+
+def closure_filter(user_id: str, closure: dict) -> dict:
+    return {"user_id": user_id, **{k: closure[k] for k in ("start_date", "end_date", "start_time", "end_time")}}
+
+async def get_closure_index(user: dict) -> dict:
+    # Todos los cierres del negocio en una consulta, indexados en memoria por
+    # schedule_version, que se incrementa al crear, importar o borrar cierres
+    key = (user['user_id'], user.get('schedule_version', 0))
+    if key in closure_cache:
+        closure_cache.move_to_end(key)
+        return closure_cache[key]
+    index = build_closure_index(await scheduling_repo.find_closures(user['user_id']))
+    lru_put(closure_cache, key, index, CLOSURE_CACHE_SIZE)
+    return index
+
+def booking_window_error(date: str, start: int, settings: dict) -> Optional[str]:
+    # La fecha y hora pedidas están en la hora local del negocio
+    now = datetime.now(timezone.utc)
+    earliest = now + timedelta(minutes=settings['min_lead_minutes'])
+    if local_to_utc(settings['timezone'], date, start) < earliest:
+        return "El horario ya no está disponible para reservar"
+    max_days = settings.get('max_advance_days')
+    today, _ = local_now(settings['timezone'], now)
+    last_day = (datetime.strptime(today, "%Y-%m-%d") + timedelta(days=max_days or 0)).strftime("%Y-%m-%d")
+    if max_days and date > last_day:
+        return f"Solo se puede reservar con hasta {max_days} días de anticipación"
+    return None
+
+def schedule_rule_error(closures: dict, hours_template: dict, date: str, start: int, end: int) -> Optional[str]:
+    # Cierres y horario de atención: las reglas de la reserva pública que también
+    # respetan las operaciones en lote del dueño
+    closed_all_day, closed_windows = closure_on(closures, date)
+    if closed_all_day:
+        return "El negocio está cerrado ese día"
+    if overlaps_any(closed_windows, start, end):
+        return "El horario coincide con un cierre del negocio"
+    if not within_open(open_intervals_on(hours_template, date), start, end):
+        return "El horario está fuera del horario de atención"
+    return None
+
+async def find_schedule_user(user_id: str) -> dict:
+    # Campos del negocio que usan las reglas de agenda, para rutas que solo tienen los claims
+    user = await db.users.find_one(
+        {"user_id": user_id}, {"_id": 0, "user_id": 1, "schedule_version": 1, "scheduling": 1}
+    )
+    return user or {"user_id": user_id}
 
 @api_router.post("/auth/register")
 async def register(user_data: UserRegister):
@@ -190,7 +1565,7 @@ async def register(user_data: UserRegister):
         raise HTTPException(status_code=400, detail="El email ya está registrado")
     
     user_id = str(uuid.uuid4())
-    hashed_password = pwd_context.hash(user_data.password)
+    hashed_password = get_pwd_context().hash(user_data.password)
     trial_ends = datetime.now(timezone.utc) + timedelta(days=7)
     
     user = {
@@ -201,6 +1576,8 @@ async def register(user_data: UserRegister):
         "trial_ends": trial_ends.isoformat(),
         "subscription_active": False,
         "subscription_ends": None,
+        "access_until": trial_ends,
+        "token_version": 0,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
@@ -212,10 +1589,11 @@ async def register(user_data: UserRegister):
             "day_of_week": day,
             "is_open": day < 5,
             "open_time": "09:00" if day < 5 else None,
-            "close_time": "18:00" if day < 5 else None
+            "close_time": "18:00" if day < 5 else None,
+            "intervals": [{"open_time": "09:00", "close_time": "18:00"}] if day < 5 else []
         })
     
-    token = create_access_token({"sub": user_id})
+    token = create_access_token(user)
     
     return {
         "token": token,
@@ -230,10 +1608,10 @@ async def register(user_data: UserRegister):
 @api_router.post("/auth/login")
 async def login(credentials: UserLogin):
     user = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user or not pwd_context.verify(credentials.password, user['password_hash']):
+    if not user or not get_pwd_context().verify(credentials.password, user['password_hash']):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
     
-    token = create_access_token({"sub": user['user_id']})
+    token = create_access_token(user)
     
     return {
         "token": token,
@@ -246,11 +1624,26 @@ async def login(credentials: UserLogin):
         }
     }
 
+@api_router.post("/auth/refresh")
+async def refresh_token(current_user: dict = Depends(get_current_user)):
+    return {"token": create_access_token(current_user)}
+
+@api_router.post("/auth/logout-all")
+async def logout_all(current_user: dict = Depends(get_current_user)):
+    # Invalida todos los tokens emitidos hasta ahora para el usuario
+    await db.users.update_one({"user_id": current_user['user_id']}, {"$inc": {"token_version": 1}})
+    token_version_cache.pop(current_user['user_id'], None)
+    return {"message": "Sesiones cerradas"}
+
 @api_router.get("/dashboard/stats")
 async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
     await check_subscription(current_user)
     
-    total_appointments = await db.appointments.count_documents({"user_id": current_user['user_id']})
+    total_appointments = (
+        await db.appointments.count_documents({"user_id": current_user['user_id']})
+        + await db.appointments_archive.count_documents({"user_id": current_user['user_id']})
+    )
+    # Cubierto por el índice parcial de turnos pendientes (COUNT_SCAN sin leer documentos)
     pending_appointments = await db.appointments.count_documents({
         "user_id": current_user['user_id'],
         "status": "pending"
@@ -260,10 +1653,7 @@ async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
         "active": True
     })
     
-    trial_ends = current_user['trial_ends']
-    if isinstance(trial_ends, str):
-        trial_ends = datetime.fromisoformat(trial_ends)
-    
+    trial_ends = parse_datetime(current_user['trial_ends'])
     trial_days_left = max(0, (trial_ends - datetime.now(timezone.utc)).days)
     
     return {
@@ -273,15 +1663,23 @@ async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
         "trial_days_left": trial_days_left
     }
 
+async def validate_resource_ids(user_id: str, resource_ids: List[str]):
+    if not resource_ids:
+        return
+    count = await db.resources.count_documents({"user_id": user_id, "resource_id": {"$in": resource_ids}})
+    if count != len(set(resource_ids)):
+        raise HTTPException(status_code=400, detail="Recurso no encontrado")
+
 @api_router.get("/services", response_model=List[Service])
-async def get_services(current_user: dict = Depends(get_current_user)):
+async def get_services(current_user: dict = Depends(get_current_claims)):
     await check_subscription(current_user)
     services = await db.services.find({"user_id": current_user['user_id']}, {"_id": 0}).to_list(1000)
     return services
 
 @api_router.post("/services", response_model=Service)
-async def create_service(service_data: ServiceCreate, current_user: dict = Depends(get_current_user)):
+async def create_service(service_data: ServiceCreate, current_user: dict = Depends(get_current_claims)):
     await check_subscription(current_user)
+    await validate_resource_ids(current_user['user_id'], service_data.resource_ids)
     
     service = {
         "service_id": str(uuid.uuid4()),
@@ -290,6 +1688,9 @@ async def create_service(service_data: ServiceCreate, current_user: dict = Depen
         "description": service_data.description,
         "duration_minutes": service_data.duration_minutes,
         "price": service_data.price,
+        "slot_interval": service_data.slot_interval,
+        "buffer_minutes": service_data.buffer_minutes,
+        "resource_ids": service_data.resource_ids,
         "active": True
     }
     
@@ -297,8 +1698,9 @@ async def create_service(service_data: ServiceCreate, current_user: dict = Depen
     return service
 
 @api_router.put("/services/{service_id}", response_model=Service)
-async def update_service(service_id: str, service_data: ServiceCreate, current_user: dict = Depends(get_current_user)):
+async def update_service(service_id: str, service_data: ServiceCreate, current_user: dict = Depends(get_current_claims)):
     await check_subscription(current_user)
+    await validate_resource_ids(current_user['user_id'], service_data.resource_ids)
     
     result = await db.services.find_one_and_update(
         {"service_id": service_id, "user_id": current_user['user_id']},
@@ -310,10 +1712,11 @@ async def update_service(service_id: str, service_data: ServiceCreate, current_u
     if not result:
         raise HTTPException(status_code=404, detail="Servicio no encontrado")
     
+    await bump_schedule_version(current_user['user_id'])
     return result
 
 @api_router.delete("/services/{service_id}")
-async def delete_service(service_id: str, current_user: dict = Depends(get_current_user)):
+async def delete_service(service_id: str, current_user: dict = Depends(get_current_claims)):
     await check_subscription(current_user)
     
     result = await db.services.update_one(
@@ -324,181 +1727,858 @@ async def delete_service(service_id: str, current_user: dict = Depends(get_curre
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Servicio no encontrado")
     
+    await bump_schedule_version(current_user['user_id'])
     return {"message": "Servicio desactivado"}
 
-@api_router.get("/business-hours")
-async def get_business_hours(current_user: dict = Depends(get_current_user)):
+@api_router.get("/resources", response_model=List[Resource])
+async def get_resources(current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    return await db.resources.find({"user_id": current_user['user_id']}, {"_id": 0}).to_list(1000)
+
+@api_router.post("/resources", response_model=Resource)
+async def create_resource(resource_data: ResourceCreate, current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    
+    resource = {
+        "resource_id": str(uuid.uuid4()),
+        "user_id": current_user['user_id'],
+        "name": resource_data.name,
+        "kind": resource_data.kind,
+        "active": True
+    }
+    
+    await db.resources.insert_one(resource)
+    return {k: v for k, v in resource.items() if k != '_id'}
+
+@api_router.put("/resources/{resource_id}", response_model=Resource)
+async def update_resource(resource_id: str, resource_data: ResourceCreate, current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    
+    result = await db.resources.find_one_and_update(
+        {"resource_id": resource_id, "user_id": current_user['user_id']},
+        {"$set": resource_data.model_dump()},
+        return_document=True,
+        projection={"_id": 0}
+    )
+    
+    if not result:
+        raise HTTPException(status_code=404, detail="Recurso no encontrado")
+    
+    return result
+
+@api_router.delete("/resources/{resource_id}")
+async def delete_resource(resource_id: str, current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    
+    result = await db.resources.update_one(
+        {"resource_id": resource_id, "user_id": current_user['user_id']},
+        {"$set": {"active": False}}
+    )
+    
+    if result.modified_count == 0:
+        raise HTTPException(status_code=404, detail="Recurso no encontrado")
+    
+    await bump_schedule_version(current_user['user_id'])
+    return {"message": "Recurso desactivado"}
+
+@api_router.get("/business-hours")
+async def get_business_hours(current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    hours = await db.business_hours.find({"user_id": current_user['user_id']}, {"_id": 0}).to_list(7)
+    return sorted(hours, key=lambda x: x['day_of_week'])
+
+@api_router.put("/business-hours")
+async def update_business_hours(hours_list: List[BusinessHoursUpdate], current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    
+    # Usar bulk_write para optimizar las actualizaciones
+    operations = []
+    for hours in hours_list:
+        try:
+            fields = normalize_hours(hours.is_open, hours.open_time, hours.close_time, hours.intervals)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        operations.append(UpdateOne(
+            {"user_id": current_user['user_id'], "day_of_week": hours.day_of_week},
+            {"$set": fields}
+        ))
+    
+    if operations:
+        await db.business_hours.bulk_write(operations)
+        await bump_schedule_version(current_user['user_id'])
+    
+    return {"message": "Horarios actualizados"}
+
+@api_router.get("/business-hours/overrides")
+async def get_hours_overrides(current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    overrides = await db.business_hours_overrides.find(
+        {"user_id": current_user['user_id'], "date": {"$gte": today}}, {"_id": 0}
+    ).sort("date", 1).to_list(1000)
+    return overrides
+
+@api_router.put("/business-hours/overrides/{date}")
+async def set_hours_override(date: str, override: HoursOverride, current_user: dict = Depends(get_current_claims)):
+    # Reemplaza el horario de la plantilla semanal para una fecha puntual
+    await check_subscription(current_user)
+    try:
+        datetime.strptime(date, "%Y-%m-%d")
+        fields = normalize_hours(override.is_open, None, None, override.intervals)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    await db.business_hours_overrides.update_one(
+        {"user_id": current_user['user_id'], "date": date},
+        {"$set": {**fields, "reason": override.reason}},
+        upsert=True
+    )
+    await bump_schedule_version(current_user['user_id'])
+    publish_slot_change(current_user['user_id'], date, "changed")
+    return {"message": "Horario del día actualizado"}
+
+@api_router.delete("/business-hours/overrides/{date}")
+async def delete_hours_override(date: str, current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    result = await db.business_hours_overrides.delete_one({"user_id": current_user['user_id'], "date": date})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Horario no encontrado")
+    await bump_schedule_version(current_user['user_id'])
+    publish_slot_change(current_user['user_id'], date, "changed")
+    return {"message": "Horario del día eliminado"}
+
+@api_router.get("/settings/scheduling", response_model=SchedulingSettings)
+async def get_scheduling_config(current_user: dict = Depends(get_current_user)):
+    await check_subscription(current_user)
+    return get_scheduling_settings(current_user)
+
+@api_router.put("/settings/scheduling", response_model=SchedulingSettings)
+async def update_scheduling_config(settings: SchedulingSettings, current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    await db.users.update_one(
+        {"user_id": current_user['user_id']},
+        {"$set": {"scheduling": settings.model_dump()}, "$inc": {"schedule_version": 1}}
+    )
+    return settings
+
+@api_router.get("/closed-dates")
+async def get_closed_dates(current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    closed_dates = await db.closed_dates.find(
+        {"user_id": current_user['user_id']}, {"_id": 0}
+    ).sort("start_date", 1).to_list(1000)
+    return closed_dates
+
+@api_router.post("/closed-dates")
+async def create_closed_date(closed_date: ClosedDateCreate, current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    
+    try:
+        closure = normalize_closure(closed_date)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    existing = await db.closed_dates.find_one(closure_filter(current_user['user_id'], closure))
+    
+    if existing:
+        raise HTTPException(status_code=400, detail="Esta fecha ya está marcada como cerrada")
+    
+    closure = {
+        "closure_id": str(uuid.uuid4()),
+        "user_id": current_user['user_id'],
+        **closure,
+        "source": "manual"
+    }
+    await db.closed_dates.insert_one(closure)
+    await bump_schedule_version(current_user['user_id'])
+    
+    return {"message": "Día cerrado agregado", "closure_id": closure['closure_id']}
+
+@api_router.post("/closed-dates/import")
+async def import_closed_dates(file: UploadFile = File(...), current_user: dict = Depends(get_current_claims)):
+    # Calendario de feriados en ICS o lista JSON de cierres; los ya cargados se ignoran
+    await check_subscription(current_user)
+    user_id = current_user['user_id']
+    
+    content = (await file.read()).decode("utf-8-sig")
+    try:
+        if content.lstrip().startswith("["):
+            items = [ClosedDateCreate(**item) for item in json.loads(content)]
+        else:
+            items = [ClosedDateCreate(**item) for item in parse_ics_closures(content)]
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Archivo inválido: {str(e)}")
+    if len(items) > CLOSURE_IMPORT_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Máximo {CLOSURE_IMPORT_MAX_ITEMS} cierres por archivo")
+    
+    closures = []
+    errors = []
+    for position, item in enumerate(items, start=1):
+        try:
+            closures.append(normalize_closure(item))
+        except ValueError as e:
+            errors.append({"item": position, "error": str(e)})
+    if errors:
+        raise HTTPException(status_code=400, detail={"message": "El archivo tiene errores", "errors": errors})
+    
+    imported = 0
+    if closures:
+        result = await db.closed_dates.bulk_write([
+            UpdateOne(
+                closure_filter(user_id, closure),
+                {"$setOnInsert": {"closure_id": str(uuid.uuid4()), **closure, "source": "import"}},
+                upsert=True
+            )
+            for closure in closures
+        ], ordered=False)
+        imported = result.upserted_count
+    if imported:
+        await bump_schedule_version(user_id)
+    
+    return {"message": "Cierres importados", "imported": imported, "skipped": len(closures) - imported}
+
+@api_router.delete("/closed-dates/{date}")
+async def delete_closed_date(date: str, current_user: dict = Depends(get_current_claims)):
+    # Acepta el closure_id o, como antes, la fecha de inicio del cierre
+    await check_subscription(current_user)
+    
+    result = await db.closed_dates.delete_many({
+        "user_id": current_user['user_id'],
+        "$or": [{"closure_id": date}, {"date": date}]
+    })
+    
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Fecha no encontrada")
+    
+    await bump_schedule_version(current_user['user_id'])
+    return {"message": "Día cerrado eliminado"}
+
+@api_router.get("/appointments")
+async def get_appointments(
+    status_filter: Optional[str] = Query(None, alias="status"),
+    current_user: dict = Depends(get_current_claims)
+):
+    await check_subscription(current_user)
+    if status_filter is not None and status_filter not in BOOKED_STATUSES:
+        raise HTTPException(status_code=400, detail="Estado inválido")
+    appointments = await db.appointments.find({
+        "user_id": current_user['user_id'],
+        "status": status_filter if status_filter else {"$in": BOOKED_STATUSES}
+    }, {"_id": 0, "client_search": 0}).to_list(1000)
+    if status_filter in (None, "confirmed"):
+        appointments += await list_series_occurrences(current_user['user_id'], *series_list_window())
+    return sorted(appointments, key=lambda x: (x['date'], x['time']), reverse=True)
+
+@api_router.get("/appointments/archive")
+async def get_archived_appointments(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 50,
+    current_user: dict = Depends(get_current_claims)
+):
+    # Historial de turnos pasados y cancelados que ya salieron de la colección activa
+    await check_subscription(current_user)
+    query = {"user_id": current_user['user_id']}
+    date_range = {}
+    if start_date:
+        date_range["$gte"] = start_date
+    if end_date:
+        date_range["$lte"] = end_date
+    if date_range:
+        query["date"] = date_range
+    limit = max(1, min(limit, ARCHIVE_MAX_LIMIT))
+    
+    results = await db.appointments_archive.find(
+        query, {"_id": 0, "client_search": 0}
+    ).sort([("date", -1), ("time", -1)]).skip(max(0, skip)).limit(limit + 1).to_list(limit + 1)
+    
+    return {"results": results[:limit], "has_more": len(results) > limit}
+
+@api_router.get("/appointments/export.csv")
+async def export_appointments_csv(
+    request: Request,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    include_cancelled: bool = False,
+    current_user: dict = Depends(get_current_claims)
+):
+    await check_subscription(current_user)
+    series_window = export_series_window(start_date, end_date)
+    cursor = export_cursor(current_user['user_id'], start_date, end_date, include_cancelled, series_window)
+    return export_response(request, stream_csv_rows(cursor), "text/csv; charset=utf-8", "turnos.csv")
+
+@api_router.get("/appointments/export.ics")
+async def export_appointments_ics(
+    request: Request,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    include_cancelled: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    await check_subscription(current_user)
+    series_window = export_series_window(start_date, end_date)
+    cursor = export_cursor(current_user['user_id'], start_date, end_date, include_cancelled, series_window)
+    chunks = stream_ics_events(cursor, current_user['business_name'], get_tenant_timezone(current_user))
+    return export_response(request, chunks, "text/calendar; charset=utf-8", "turnos.ics")
+
+@api_router.get("/appointments/search")
+async def search_appointments(q: str, skip: int = 0, limit: int = 20, include_archived: bool = True,
+                              current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    
+    # Los teléfonos se buscan solo por sus dígitos
+    if re.fullmatch(r"[\d\s\-()+.]+", q.strip()):
+        terms = [re.sub(r"\D", "", q)]
+    else:
+        terms = normalize_search_text(q).split()
+    terms = [t for t in terms if t]
+    if not terms:
+        return {"results": [], "has_more": False}
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    
+    # Regex anclados al inicio: Mongo los resuelve como rango sobre el índice multikey
+    match = {
+        "user_id": current_user['user_id'],
+        "client_search": {"$all": [re.compile("^" + re.escape(t)) for t in terms]}
+    }
+    pipeline = [{"$match": match}]
+    if include_archived:
+        # El historial archivado entra en el mismo orden, así skip/limit paginan sobre ambas colecciones
+        pipeline.append({"$unionWith": {"coll": "appointments_archive", "pipeline": [
+            {"$match": match}, {"$addFields": {"archived": True}}
+        ]}})
+    pipeline += [
+        {"$sort": {"date": -1, "time": -1, "appointment_id": 1}},
+        {"$skip": max(0, skip)},
+        {"$limit": limit + 1},
+        {"$project": {"_id": 0, "client_search": 0}}
+    ]
+    results = await db.appointments.aggregate(pipeline).to_list(limit + 1)
+    
+    return {"results": results[:limit], "has_more": len(results) > limit}
+
+@api_router.post("/appointments/admin")
+async def create_appointment_admin(appt_data: AppointmentCreate, current_user: dict = Depends(get_current_user)):
+    await check_subscription(current_user)
+    
+    service = await db.services.find_one(
+        {"service_id": appt_data.service_id, "user_id": current_user['user_id']}, {"_id": 0}
+    )
+    if not service:
+        raise HTTPException(status_code=404, detail="Servicio no encontrado")
+    
+    service_duration = service.get('duration_minutes', 30)
+    buffer = get_scheduling_settings(current_user, service)['buffer_minutes']
+    try:
+        datetime.strptime(appt_data.date, "%Y-%m-%d")
+        proposed_start = time_to_minutes(appt_data.time)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Formato de fecha u hora inválido")
+    
+    async def book(session):
+        # Mismo candado del día que la reserva pública: la verificación y el alta
+        # se confirman juntas y una reserva concurrente de esa fecha se reintenta
+        busy, resource_ids = await scheduling_repo.lock_booking_window(
+            current_user['user_id'], [appt_data.date], service.get('resource_ids'), session=session
+        )
+        available, resource_id = assign_resource(busy[appt_data.date], resource_ids, appt_data.resource_id,
+                                                 proposed_start - buffer, proposed_start + service_duration + buffer)
+        if not available:
+            raise HTTPException(status_code=400, detail="Este horario se solapa con otro turno existente")
+        
+        appointment = {
+            "appointment_id": str(uuid.uuid4()),
+            "user_id": current_user['user_id'],
+            "service_id": appt_data.service_id,
+            "service_name": service['name'],
+            "service_duration": service_duration,
+            "service_price": service.get('price', 0),
+            "resource_id": resource_id,
+            "client_name": appt_data.client_name,
+            "client_phone": appt_data.client_phone,
+            "client_email": appt_data.client_email,
+            "client_search": client_search_terms(appt_data.client_name, appt_data.client_phone, appt_data.client_email),
+            "client_key": client_key(appt_data.client_email, appt_data.client_phone),
+            "date": appt_data.date,
+            "time": appt_data.time,
+            "status": "confirmed",
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "updated_at": datetime.now(timezone.utc)
+        }
+        await scheduling_repo.insert_appointment(with_reminder(appointment, get_tenant_timezone(current_user)),
+                                                 session=session)
+        return appointment
+    
+    appointment = await run_in_transaction(book)
+    await bump_appointments_version(current_user['user_id'])
+    publish_slot_change(current_user['user_id'], appt_data.date, "booked", appt_data.time, service_duration,
+                        appointment['resource_id'])
+    await track_bookings(current_user['user_id'], [appointment])
+    # Return appointment without MongoDB's _id field
+    return {k: v for k, v in appointment.items() if k != '_id'}
+
+@api_router.get("/appointments/series")
+async def get_appointment_series(current_user: dict = Depends(get_current_claims)):
     await check_subscription(current_user)
-    hours = await db.business_hours.find({"user_id": current_user['user_id']}, {"_id": 0}).to_list(7)
-    return sorted(hours, key=lambda x: x['day_of_week'])
+    return await db.appointment_series.find(
+        {"user_id": current_user['user_id'], "active": True}, {"_id": 0}
+    ).to_list(1000)
 
-@api_router.put("/business-hours")
-async def update_business_hours(hours_list: List[BusinessHoursUpdate], current_user: dict = Depends(get_current_user)):
+@api_router.post("/appointments/series")
+async def create_appointment_series(series_data: SeriesCreate, current_user: dict = Depends(get_current_user)):
     await check_subscription(current_user)
+    user_id = current_user['user_id']
     
-    # Usar bulk_write para optimizar las actualizaciones
-    from pymongo import UpdateOne
+    service = await db.services.find_one({"service_id": series_data.service_id, "user_id": user_id}, {"_id": 0})
+    if not service:
+        raise HTTPException(status_code=404, detail="Servicio no encontrado")
     
-    operations = [
-        UpdateOne(
-            {"user_id": current_user['user_id'], "day_of_week": hours.day_of_week},
-            {"$set": {
-                "is_open": hours.is_open,
-                "open_time": hours.open_time,
-                "close_time": hours.close_time
-            }}
-        )
-        for hours in hours_list
-    ]
+    try:
+        start_date = datetime.strptime(series_data.start_date, "%Y-%m-%d")
+        proposed_start = time_to_minutes(series_data.time)
+        if series_data.until:
+            datetime.strptime(series_data.until, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Formato de fecha u hora inválido")
+    
+    series = {
+        "series_id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "service_id": service['service_id'],
+        "service_name": service['name'],
+        "service_duration": service.get('duration_minutes', 30),
+        "client_name": series_data.client_name,
+        "client_phone": series_data.client_phone,
+        "client_email": series_data.client_email,
+        "start_date": series_data.start_date,
+        "time": series_data.time,
+        "weekday": start_date.weekday(),
+        "interval_weeks": series_data.interval_weeks,
+        "until": series_data.until,
+        "exceptions": [],
+        "active": True,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
     
-    if operations:
-        await db.business_hours.bulk_write(operations)
+    # Validar toda la serie contra turnos y otras series con una consulta por colección
+    horizon = (start_date + timedelta(days=SERIES_HORIZON_DAYS)).strftime("%Y-%m-%d")
+    occurrences = expand_series(series, series_data.start_date, min(series_data.until or horizon, horizon))
+    if not occurrences:
+        raise HTTPException(status_code=400, detail="La serie no tiene fechas")
+    
+    # Las mismas reglas que una reserva suelta: cierres y horario de atención de cada fecha
+    closures = await get_closure_index(current_user)
+    hours_template = await get_hours_template(current_user)
+    rule_errors = {}
+    for date in occurrences:
+        rule_error = schedule_rule_error(closures, hours_template, date, proposed_start,
+                                         proposed_start + series['service_duration'])
+        if rule_error:
+            rule_errors[date] = rule_error
+    if rule_errors:
+        raise HTTPException(status_code=400, detail={
+            "message": next(iter(rule_errors.values())),
+            "dates": list(rule_errors)[:50]
+        })
     
-    return {"message": "Horarios actualizados"}
+    buffer = get_scheduling_settings(current_user, service)['buffer_minutes']
+    start, end = proposed_start - buffer, proposed_start + series['service_duration'] + buffer
+    
+    async def book(session):
+        # Candado de cada fecha de la serie: una reserva suelta concurrente de cualquiera
+        # de esas fechas entra en conflicto con esta transacción y una de las dos se reintenta
+        busy, resource_ids = await scheduling_repo.lock_booking_window(
+            user_id, occurrences, service.get('resource_ids'), session=session
+        )
+        candidates = [series_data.resource_id] if series_data.resource_id else resource_ids
+        if series_data.resource_id and series_data.resource_id not in resource_ids:
+            raise HTTPException(status_code=400, detail="Recurso no disponible para este servicio")
+        
+        resource_id = None
+        if resource_ids:
+            # El mismo recurso debe estar libre en todas las fechas de la serie
+            resource_id = next((r for r in candidates if all(
+                not overlaps_any(resource_intervals(busy[d], r), start, end) for d in occurrences
+            )), None)
+            conflicts = [] if resource_id else occurrences
+        else:
+            conflicts = [d for d in occurrences if overlaps_any(busy[d], start, end)]
+        if conflicts:
+            raise HTTPException(status_code=400, detail={
+                "message": "La serie se solapa con otros turnos",
+                "dates": conflicts[:50]
+            })
+        
+        await scheduling_repo.insert_series({**series, "resource_id": resource_id}, session=session)
+        return resource_id
+    
+    resource_id = await run_in_transaction(book)
+    series["resource_id"] = resource_id
+    await bump_appointments_version(user_id)
+    for occurrence in occurrences:
+        publish_slot_change(user_id, occurrence, "booked", series['time'], series['service_duration'], resource_id)
+    return {k: v for k, v in series.items() if k != '_id'}
 
-@api_router.get("/closed-dates")
-async def get_closed_dates(current_user: dict = Depends(get_current_user)):
+@api_router.get("/appointments/series/{series_id}/occurrences")
+async def get_series_occurrences(series_id: str, start_date: str, end_date: str, current_user: dict = Depends(get_current_claims)):
     await check_subscription(current_user)
-    closed_dates = await db.closed_dates.find({"user_id": current_user['user_id']}, {"_id": 0}).to_list(1000)
-    return closed_dates
+    parse_date_window(start_date, end_date, SERIES_EXPAND_MAX_DAYS)
+    series = await db.appointment_series.find_one(
+        {"series_id": series_id, "user_id": current_user['user_id']}, {"_id": 0}
+    )
+    if not series:
+        raise HTTPException(status_code=404, detail="Serie no encontrada")
+    return {"dates": expand_series(series, start_date, end_date)}
 
-@api_router.post("/closed-dates")
-async def create_closed_date(closed_date: ClosedDateCreate, current_user: dict = Depends(get_current_user)):
+@api_router.delete("/appointments/series/{series_id}/occurrences/{date}")
+async def cancel_series_occurrence(series_id: str, date: str, current_user: dict = Depends(get_current_claims)):
     await check_subscription(current_user)
     
-    existing = await db.closed_dates.find_one({
-        "user_id": current_user['user_id'],
-        "date": closed_date.date
-    })
+    series = await db.appointment_series.find_one(
+        {"series_id": series_id, "user_id": current_user['user_id'], "active": True}, {"_id": 0}
+    )
+    if not series:
+        raise HTTPException(status_code=404, detail="Serie no encontrada")
+    try:
+        is_occurrence = date in expand_series(series, date, date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Formato de fecha inválido")
+    if not is_occurrence:
+        raise HTTPException(status_code=400, detail="La fecha no corresponde a un turno de la serie")
+    
+    await db.appointment_series.update_one(
+        {"series_id": series_id, "user_id": current_user['user_id']},
+        {"$addToSet": {"exceptions": date}}
+    )
+    await bump_appointments_version(current_user['user_id'])
+    publish_slot_change(current_user['user_id'], date, "released", series['time'], series['service_duration'],
+                        series.get('resource_id'))
+    start = time_to_minutes(series['time'])
+    schedule_waitlist_match(current_user['user_id'], [(date, start, start + series['service_duration'])])
+    return {"message": "Turno de la serie cancelado"}
+
+@api_router.delete("/appointments/series/{series_id}")
+async def cancel_appointment_series(series_id: str, current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
     
-    if existing:
-        raise HTTPException(status_code=400, detail="Esta fecha ya está marcada como cerrada")
+    result = await db.appointment_series.update_one(
+        {"series_id": series_id, "user_id": current_user['user_id'], "active": True},
+        {"$set": {"active": False}}
+    )
     
-    await db.closed_dates.insert_one({
-        "user_id": current_user['user_id'],
-        "date": closed_date.date
-    })
+    if result.modified_count == 0:
+        raise HTTPException(status_code=404, detail="Serie no encontrada")
     
-    return {"message": "Día cerrado agregado"}
+    await bump_appointments_version(current_user['user_id'])
+    publish_slot_change(current_user['user_id'], None, "changed")
+    return {"message": "Serie cancelada"}
 
-@api_router.delete("/closed-dates/{date}")
-async def delete_closed_date(date: str, current_user: dict = Depends(get_current_user)):
+@api_router.post("/appointments/bulk/status")
+async def bulk_update_status(bulk_data: BulkStatusRequest, current_user: dict = Depends(get_current_claims)):
     await check_subscription(current_user)
+    user_id = current_user['user_id']
     
-    result = await db.closed_dates.delete_one({
-        "user_id": current_user['user_id'],
-        "date": date
-    })
+    ids = list(dict.fromkeys(bulk_data.appointment_ids))
+    if len(ids) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Máximo {BULK_MAX_ITEMS} turnos por operación")
     
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Fecha no encontrada")
+    # Solo cambian los turnos que están en un estado de origen válido para la transición
+    query = {
+        "user_id": user_id,
+        "appointment_id": {"$in": ids},
+        "status": {"$in": STATUS_TRANSITIONS[bulk_data.status]}
+    }
+    if bulk_data.status != "confirmed":
+        # Un turno se marca como atendido o ausente recién cuando ya empezó
+        # Los claims del token no traen la configuración del negocio
+        today, minutes = local_now(await find_tenant_timezone(user_id))
+        query["$or"] = [
+            {"date": {"$lt": today}},
+            {"date": today, "time": {"$lte": minutes_to_time(minutes)}}
+        ]
+    updated = await db.appointments.find(
+        query, {**CLIENT_FIELDS, "appointment_id": 1}
+    ).to_list(None)
+    changes = {"status": bulk_data.status, "updated_at": datetime.now(timezone.utc)}
+    update = {"$set": changes}
+    if bulk_data.status != "confirmed":
+        update["$unset"] = {"remind_at": ""}
+    result = await db.appointments.update_many(
+        {**query, "appointment_id": {"$in": [a['appointment_id'] for a in updated]}}, update
+    )
     
-    return {"message": "Día cerrado eliminado"}
+    if result.modified_count:
+        await bump_appointments_version(user_id)
+        if bulk_data.status == "no_show":
+            await record_client_no_shows(user_id, updated)
+            await refresh_client_visits(user_id, updated)
+    
+    updated_ids = {a['appointment_id'] for a in updated}
+    return {
+        "message": "Turnos actualizados",
+        "updated": result.modified_count,
+        "skipped": [i for i in ids if i not in updated_ids]
+    }
 
-@api_router.get("/appointments")
-async def get_appointments(current_user: dict = Depends(get_current_user)):
+@api_router.post("/appointments/bulk/cancel")
+async def bulk_cancel_appointments(bulk_data: BulkCancelRequest, current_user: dict = Depends(get_current_claims)):
     await check_subscription(current_user)
-    appointments = await db.appointments.find({
-        "user_id": current_user['user_id'],
-        "status": {"$ne": "cancelled"}
-    }, {"_id": 0}).to_list(1000)
-    return sorted(appointments, key=lambda x: (x['date'], x['time']), reverse=True)
+    
+    if bulk_data.end_date < bulk_data.start_date:
+        raise HTTPException(status_code=400, detail="La fecha de fin debe ser posterior a la de inicio")
+    parse_date_window(bulk_data.start_date, bulk_data.end_date, SERIES_EXPAND_MAX_DAYS)
+    user_id = current_user['user_id']
+    
+    query = {
+        "user_id": user_id,
+        "date": {"$gte": bulk_data.start_date, "$lte": bulk_data.end_date},
+        "status": {"$in": ACTIVE_STATUSES}
+    }
+    cancelled = await db.appointments.find(
+        query, {**CLIENT_FIELDS, "time": 1, "service_duration": 1}
+    ).to_list(None)
+    result = await db.appointments.update_many(
+        query,
+        {"$set": {"status": "cancelled", "updated_at": datetime.now(timezone.utc)}, "$unset": {"remind_at": ""}}
+    )
+    # Las ocurrencias de series del rango no tienen documento: se cancelan como
+    # excepciones de su serie, igual que al cancelar una sola fecha
+    occurrences = await list_series_occurrences(user_id, bulk_data.start_date, bulk_data.end_date)
+    by_series: Dict[str, List[str]] = {}
+    for occurrence in occurrences:
+        by_series.setdefault(occurrence['series_id'], []).append(occurrence['date'])
+    if by_series:
+        await db.appointment_series.bulk_write([
+            UpdateOne({"user_id": user_id, "series_id": series_id}, {"$addToSet": {"exceptions": {"$each": dates}}})
+            for series_id, dates in by_series.items()
+        ], ordered=False)
+    
+    if result.modified_count or occurrences:
+        await bump_appointments_version(user_id)
+        if cancelled:
+            await track_cancellations(user_id, cancelled)
+        for date in {a['date'] for a in cancelled + occurrences}:
+            publish_slot_change(user_id, date, "changed")
+        schedule_waitlist_match(user_id, [
+            (a['date'], time_to_minutes(a['time']), time_to_minutes(a['time']) + (a.get('service_duration') or 30))
+            for a in cancelled + occurrences
+        ])
+    
+    return {"message": "Turnos cancelados", "cancelled": result.modified_count + len(occurrences)}
 
-@api_router.post("/appointments/admin")
-async def create_appointment_admin(appt_data: AppointmentCreate, current_user: dict = Depends(get_current_user)):
+@api_router.post("/appointments/bulk/reschedule")
+async def bulk_reschedule_appointments(bulk_data: BulkRescheduleRequest, current_user: dict = Depends(get_current_claims)):
     await check_subscription(current_user)
+    user_id = current_user['user_id']
     
-    service = await db.services.find_one({"service_id": appt_data.service_id}, {"_id": 0})
-    if not service:
-        raise HTTPException(status_code=404, detail="Servicio no encontrado")
-    
-    # Verificar disponibilidad considerando la duración del servicio
-    service_duration = service.get('duration_minutes', 30)
-    proposed_start = datetime.strptime(appt_data.time, "%H:%M")
-    proposed_end = proposed_start + timedelta(minutes=service_duration)
+    if len(bulk_data.items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Máximo {BULK_MAX_ITEMS} turnos por operación")
     
-    # Obtener todos los turnos del día
-    existing_appointments = await db.appointments.find({
-        "user_id": current_user['user_id'],
-        "date": appt_data.date,
-        "status": {"$ne": "cancelled"}
-    }, {"_id": 0}).to_list(100)
-    
-    # Verificar solapamiento
-    for existing in existing_appointments:
-        existing_service = await db.services.find_one({"service_id": existing["service_id"]}, {"_id": 0})
-        if existing_service:
-            existing_duration = existing_service.get('duration_minutes', 30)
-            existing_start = datetime.strptime(existing["time"], "%H:%M")
-            existing_end = existing_start + timedelta(minutes=existing_duration)
-            
-            # Verificar solapamiento
-            if (existing_start <= proposed_start < existing_end or
-                existing_start < proposed_end <= existing_end or
-                (proposed_start <= existing_start and proposed_end >= existing_end)):
-                raise HTTPException(status_code=400, detail="Este horario se solapa con otro turno existente")
-    
-    appointment = {
-        "appointment_id": str(uuid.uuid4()),
-        "user_id": current_user['user_id'],
-        "service_id": appt_data.service_id,
-        "service_name": service['name'],
-        "service_duration": service_duration,
-        "client_name": appt_data.client_name,
-        "client_phone": appt_data.client_phone,
-        "client_email": appt_data.client_email,
-        "date": appt_data.date,
-        "time": appt_data.time,
-        "status": "confirmed",
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
+    ids = [item.appointment_id for item in bulk_data.items]
+    if len(set(ids)) != len(ids):
+        raise HTTPException(status_code=400, detail="Hay turnos repetidos en la operación")
+    try:
+        for item in bulk_data.items:
+            datetime.strptime(item.date, "%Y-%m-%d")
+            time_to_minutes(item.time)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Formato de fecha u hora inválido")
+    
+    appointments = await db.appointments.find(
+        {"user_id": user_id, "appointment_id": {"$in": ids}, "status": {"$in": ACTIVE_STATUSES}},
+        {"_id": 0, "appointment_id": 1, "service_id": 1, "service_duration": 1, "service_price": 1,
+         "resource_id": 1, "date": 1, "time": 1, "client_email": 1}
+    ).to_list(None)
+    by_id = {a['appointment_id']: a for a in appointments}
+    missing = [i for i in ids if i not in by_id]
+    if missing:
+        raise HTTPException(status_code=404, detail={"message": "Turnos no encontrados", "appointment_ids": missing})
+    
+    services = await db.services.find(
+        {"user_id": user_id, "service_id": {"$in": list({a['service_id'] for a in appointments})}}, {"_id": 0}
+    ).to_list(None)
+    services_by_id = {s['service_id']: s for s in services}
+    user = await find_schedule_user(user_id)
+    closures = await get_closure_index(user)
+    hours_template = await get_hours_template(user)
+    
+    # Los turnos que se mueven dejan libre su horario actual
+    busy = await get_busy_intervals(user_id, [item.date for item in bulk_data.items], exclude_ids=set(ids))
+    errors = []
+    for item in bulk_data.items:
+        appt = by_id[item.appointment_id]
+        service = services_by_id.get(appt['service_id'], {})
+        duration = appt.get('service_duration') or service.get('duration_minutes', 30)
+        buffer = get_scheduling_settings(user, service)['buffer_minutes']
+        start = time_to_minutes(item.time)
+        rule_error = schedule_rule_error(closures, hours_template, item.date, start, start + duration)
+        if rule_error:
+            errors.append({"appointment_id": item.appointment_id, "error": rule_error})
+        # El margen entre turnos se aplica alrededor del nuevo horario, como en una reserva individual
+        busy[item.date].append((start - buffer, start + duration + buffer, item.appointment_id, appt.get('resource_id')))
+    if errors:
+        raise HTTPException(status_code=400, detail={"message": "Hay turnos fuera del horario permitido", "errors": errors})
+    
+    moved = set(ids)
+    conflicts = []
+    for date, intervals in busy.items():
+        for first, second in find_conflicts(intervals):
+            if first in moved or second in moved:
+                conflicts.append({"date": date, "appointment_ids": [first, second]})
+    if conflicts:
+        raise HTTPException(status_code=400, detail={"message": "Hay turnos que se solapan", "conflicts": conflicts})
+    
+    tz_name = get_tenant_timezone(user)
+    operations = [
+        UpdateOne(
+            {"appointment_id": item.appointment_id, "user_id": user_id},
+            merge_updates(
+                {"$set": {"date": item.date, "time": item.time, "updated_at": datetime.now(timezone.utc)}},
+                reminder_update(item.date, item.time, by_id[item.appointment_id].get('client_email'), tz_name)
+            )
+        )
+        for item in bulk_data.items
+    ]
+    if operations:
+        await db.appointments.bulk_write(operations, ordered=False)
+        await bump_appointments_version(user_id)
+        # Cambian tanto las fechas de origen como las de destino
+        for date in {a['date'] for a in appointments} | {item.date for item in bulk_data.items}:
+            publish_slot_change(user_id, date, "changed")
+        moved_to = [{**by_id[item.appointment_id], "date": item.date, "time": item.time} for item in bulk_data.items]
+        await record_daily_stats(user_id, appointments, sign=-1)
+        await record_daily_stats(user_id, moved_to)
+    
+    return {"message": "Turnos reprogramados", "rescheduled": len(operations)}
+
+@api_router.post("/appointments/bulk/import")
+async def import_appointments(file: UploadFile = File(...), current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    user_id = current_user['user_id']
+    
+    content = (await file.read()).decode("utf-8-sig")
+    rows = list(csv.DictReader(io.StringIO(content)))
+    if len(rows) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Máximo {BULK_MAX_ITEMS} turnos por operación")
+    
+    services = await db.services.find({"user_id": user_id, "active": True}, {"_id": 0}).to_list(None)
+    services_by_id = {s['service_id']: s for s in services}
+    services_by_name = {s['name'].strip().lower(): s for s in services}
+    
+    errors = []
+    appointments = []
+    # La fila 1 es el encabezado del CSV
+    for line, row in enumerate(rows, start=2):
+        row = {k.strip(): (v or "").strip() for k, v in row.items() if k}
+        service = services_by_id.get(row.get('service_id')) or services_by_name.get(row.get('service_name', '').lower())
+        if not service:
+            errors.append({"line": line, "error": "Servicio no encontrado"})
+            continue
+        try:
+            appt_data = AppointmentCreate(service_id=service['service_id'], **{
+                k: row.get(k) for k in ("client_name", "client_phone", "client_email", "date", "time")
+            })
+            datetime.strptime(appt_data.date, "%Y-%m-%d")
+            time_to_minutes(appt_data.time)
+        except ValueError as e:
+            errors.append({"line": line, "error": str(e)})
+            continue
+        
+        appointments.append({
+            "appointment_id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "service_id": service['service_id'],
+            "service_name": service['name'],
+            "service_duration": service.get('duration_minutes', 30),
+            "service_price": service.get('price', 0),
+            "client_name": appt_data.client_name,
+            "client_phone": appt_data.client_phone,
+            "client_email": appt_data.client_email,
+            "client_search": client_search_terms(appt_data.client_name, appt_data.client_phone,
+                                                 appt_data.client_email),
+            "client_key": client_key(appt_data.client_email, appt_data.client_phone),
+            "date": appt_data.date,
+            "time": appt_data.time,
+            "status": "confirmed",
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "updated_at": datetime.now(timezone.utc),
+            "_line": line
+        })
     
-    await db.appointments.insert_one(appointment)
-    # Return appointment without MongoDB's _id field
-    return {k: v for k, v in appointment.items() if k != '_id'}
+    if errors:
+        raise HTTPException(status_code=400, detail={"message": "El archivo tiene errores", "errors": errors})
+    
+    user = await find_schedule_user(user_id)
+    closures = await get_closure_index(user)
+    hours_template = await get_hours_template(user)
+    busy = await get_busy_intervals(user_id, [a['date'] for a in appointments])
+    lines = {}
+    for appt in appointments:
+        start = time_to_minutes(appt['time'])
+        end = start + appt['service_duration']
+        buffer = get_scheduling_settings(user, services_by_id[appt['service_id']])['buffer_minutes']
+        lines[appt['appointment_id']] = appt.pop('_line')
+        rule_error = schedule_rule_error(closures, hours_template, appt['date'], start, end)
+        if rule_error:
+            errors.append({"line": lines[appt['appointment_id']], "error": rule_error})
+        busy[appt['date']].append((start - buffer, end + buffer, appt['appointment_id'], None))
+    if errors:
+        raise HTTPException(status_code=400, detail={"message": "Hay turnos fuera del horario permitido", "errors": errors})
+    
+    for date, intervals in busy.items():
+        for first, second in find_conflicts(intervals):
+            line = lines.get(second) or lines.get(first)
+            if line:
+                errors.append({"line": line, "error": f"Se solapa con otro turno el {date}"})
+    if errors:
+        raise HTTPException(status_code=400, detail={"message": "Hay turnos que se solapan", "errors": errors})
+    
+    if appointments:
+        tz_name = get_tenant_timezone(user)
+        await db.appointments.bulk_write([InsertOne(with_reminder(a, tz_name)) for a in appointments], ordered=False)
+        await bump_appointments_version(user_id)
+        for date in {a['date'] for a in appointments}:
+            publish_slot_change(user_id, date, "changed")
+        await track_bookings(user_id, appointments)
+    
+    return {"message": "Turnos importados", "imported": len(appointments)}
 
 @api_router.delete("/appointments/{appointment_id}")
-async def cancel_appointment(appointment_id: str, current_user: dict = Depends(get_current_user)):
+async def cancel_appointment(appointment_id: str, current_user: dict = Depends(get_current_claims)):
     await check_subscription(current_user)
     
-    result = await db.appointments.update_one(
-        {"appointment_id": appointment_id, "user_id": current_user['user_id']},
-        {"$set": {"status": "cancelled"}}
+    appointment = await db.appointments.find_one_and_update(
+        {"appointment_id": appointment_id, "user_id": current_user['user_id'], "status": {"$in": ACTIVE_STATUSES}},
+        {"$set": {"status": "cancelled", "updated_at": datetime.now(timezone.utc)}, "$unset": {"remind_at": ""}},
+        projection={**CLIENT_FIELDS, "time": 1, "service_duration": 1, "resource_id": 1}
     )
     
-    if result.modified_count == 0:
+    if not appointment:
         raise HTTPException(status_code=404, detail="Turno no encontrado")
     
+    await bump_appointments_version(current_user['user_id'])
+    await track_cancellations(current_user['user_id'], [appointment])
+    publish_slot_change(current_user['user_id'], appointment['date'], "released", appointment['time'],
+                        appointment.get('service_duration'), appointment.get('resource_id'))
+    start = time_to_minutes(appointment['time'])
+    schedule_waitlist_match(current_user['user_id'], [
+        (appointment['date'], start, start + appointment.get('service_duration', 30))
+    ])
+    
     return {"message": "Turno cancelado"}
 
 @api_router.get("/public/{slug}/info")
 async def get_public_info(slug: str):
-    # Intentar primero por custom_slug, luego por user_id
-    user = await db.users.find_one({"custom_slug": slug}, {"_id": 0, "password_hash": 0})
-    if not user:
-        user = await db.users.find_one({"user_id": slug}, {"_id": 0, "password_hash": 0})
-    
+    user = await find_user_by_slug(slug, {"_id": 0, "password_hash": 0})
     if not user:
         raise HTTPException(status_code=404, detail="Negocio no encontrado")
     
     # Verificar si el usuario tiene acceso activo
-    trial_ends = user['trial_ends']
-    if isinstance(trial_ends, str):
-        trial_ends = datetime.fromisoformat(trial_ends)
-    
-    # Si la suscripción está activa, verificar si no ha expirado
-    if user.get('subscription_active'):
-        sub_ends = user.get('subscription_ends')
-        if sub_ends:
-            if isinstance(sub_ends, str):
-                sub_ends = datetime.fromisoformat(sub_ends)
-            if datetime.now(timezone.utc) > sub_ends:
-                # Suscripción expirada
-                raise HTTPException(status_code=403, detail="La suscripción de este negocio ha expirado")
-    else:
-        # No tiene suscripción, verificar trial
-        if datetime.now(timezone.utc) > trial_ends:
-            raise HTTPException(status_code=403, detail="El período de prueba de este negocio ha expirado")
+    if not has_access(user):
+        if user.get('subscription_active'):
+            raise HTTPException(status_code=403, detail="La suscripción de este negocio ha expirado")
+        raise HTTPException(status_code=403, detail="El período de prueba de este negocio ha expirado")
     
     user_id = user['user_id']
     services = await db.services.find({"user_id": user_id, "active": True}, {"_id": 0}).to_list(1000)
@@ -510,223 +2590,497 @@ async def get_public_info(slug: str):
         "business_hours": sorted(hours, key=lambda x: x['day_of_week'])
     }
 
-@api_router.get("/public/{slug}/available-slots")
-async def get_available_slots(slug: str, service_id: str, date: str):
-    # Obtener user_id desde slug
-    user = await db.users.find_one({"custom_slug": slug}, {"_id": 0})
-    if not user:
-        user = await db.users.find_one({"user_id": slug}, {"_id": 0})
+async def find_user_by_slug(slug: str, projection: Optional[dict] = None) -> Optional[dict]:
+    # Intentar primero por custom_slug, luego por user_id
+    projection = projection or {"_id": 0}
+    user = await db.users.find_one({"custom_slug": slug}, projection)
     if not user:
-        raise HTTPException(status_code=404, detail="Negocio no encontrado")
-    
+        user = await db.users.find_one({"user_id": slug}, projection)
+    return user
+
+async def compute_available_slots(user: dict, service_id: str, date: str) -> dict:
     user_id = user['user_id']
-    service = await db.services.find_one({"service_id": service_id, "user_id": user_id}, {"_id": 0})
-    if not service:
+    date_obj = datetime.strptime(date, "%Y-%m-%d")
+    open_intervals = open_intervals_on(await get_hours_template(user), date)
+    slot_grid = await get_slot_grid(user, service_id, open_intervals)
+    if not slot_grid:
         raise HTTPException(status_code=404, detail="Servicio no encontrado")
     
     # Verificar si la fecha está en días cerrados
-    is_closed = await db.closed_dates.find_one({
-        "user_id": user_id,
-        "date": date
-    })
-    
-    if is_closed:
+    closed_all_day, closed_windows = closure_on(await get_closure_index(user), date)
+    if closed_all_day:
         return {"slots": [], "message": "Día cerrado"}
     
-    date_obj = datetime.strptime(date, "%Y-%m-%d")
-    day_of_week = date_obj.weekday()
-    
-    business_hours = await db.business_hours.find_one({
-        "user_id": user_id,
-        "day_of_week": day_of_week
-    }, {"_id": 0})
+    if not slot_grid['grid']:
+        return {"slots": []}
     
-    if not business_hours or not business_hours['is_open']:
+    # Respetar la anticipación mínima y máxima configurada
+    settings = slot_grid['settings']
+    today, minutes_now = local_now(settings['timezone'])
+    max_days = settings['max_advance_days']
+    if date < today or (max_days and (date_obj - datetime.strptime(today, "%Y-%m-%d")).days > max_days):
         return {"slots": []}
+    # La anticipación mínima se mide desde la hora local actual y puede pasar al día siguiente
+    not_before = 0
+    if settings['min_lead_minutes']:
+        earliest = datetime.now(timezone.utc) + timedelta(minutes=settings['min_lead_minutes'])
+        earliest_date, earliest_minutes = local_now(settings['timezone'], earliest)
+        if date < earliest_date:
+            return {"slots": []}
+        if date == earliest_date:
+            not_before = earliest_minutes
+    elif date == today:
+        not_before = minutes_now
     
     # Obtener TODOS los turnos del día (no cancelados) con su duración
-    existing_appointments = await db.appointments.find({
-        "user_id": user_id,
-        "date": date,
-        "status": {"$ne": "cancelled"}
-    }, {"_id": 0}).to_list(100)
-    
-    # Construir lista de rangos ocupados
-    occupied_ranges = []
-    for appt in existing_appointments:
-        # Obtener la duración del servicio del turno
-        appt_service = await db.services.find_one({"service_id": appt["service_id"]}, {"_id": 0})
-        if appt_service:
-            duration = appt_service.get("duration_minutes", 30)
-            start_time = datetime.strptime(appt["time"], "%H:%M")
-            end_time = start_time + timedelta(minutes=duration)
-            occupied_ranges.append({
-                "start": start_time,
-                "end": end_time
-            })
-    
-    open_time = business_hours['open_time']
-    close_time = business_hours['close_time']
-    service_duration = service.get('duration_minutes', 30)
+    occupied_ranges = (await get_busy_intervals(user_id, [date]))[date]
+    # Los cierres parciales bloquean el horario en todos los recursos
+    occupied_ranges += [(start, end, "closed", None) for start, end in closed_windows]
+    
+    # duration y buffer_minutes permiten a la página aplicar los eventos en vivo sin reconsultar
+    result = {"duration": slot_grid['duration'], "buffer_minutes": settings['buffer_minutes']}
+    if slot_grid['resource_ids']:
+        free = free_resources_by_start(slot_grid['grid'], slot_grid['duration'], occupied_ranges,
+                                       slot_grid['resource_ids'], settings['buffer_minutes'], not_before)
+        result["resources"] = {minutes_to_time(start): ids for start, ids in free.items()}
+    else:
+        free = available_starts(slot_grid['grid'], slot_grid['duration'], occupied_ranges,
+                                [], settings['buffer_minutes'], not_before)
+    result["slots"] = [minutes_to_time(start) for start in free]
+    return result
+
+async def match_waitlist(user_id: str, date: str, freed_start: int, freed_end: int):
+    # Se ejecuta en segundo plano después de una cancelación: ofrece el horario
+    # liberado al primer cliente en espera (por orden de llegada) que entre en él
+    try:
+        entries = await db.waitlist.find(
+            {"user_id": user_id, "date": date, "status": "waiting"}, {"_id": 0}
+        ).sort("created_at", 1).to_list(WAITLIST_MATCH_BATCH)
+        if not entries:
+            return
+        
+        user = await db.users.find_one({"user_id": user_id}, {"_id": 0, "password_hash": 0})
+        if not user or not has_access(user):
+            return
+        
+        slots_by_service = {}
+        for entry in entries:
+            service_id = entry['service_id']
+            if service_id not in slots_by_service:
+                try:
+                    slots = (await compute_available_slots(user, service_id, date))['slots']
+                except HTTPException:
+                    slots = []
+                slots_by_service[service_id] = [time_to_minutes(t) for t in slots]
+            
+            # Una entrada con datos inválidos (anterior a la validación) no frena a las siguientes
+            try:
+                offered = next((t for t in slots_by_service[service_id]
+                                if waitlist_fits(entry, t, freed_start, freed_end)), None)
+            except (KeyError, ValueError) as e:
+                logger.warning("Entrada de lista de espera inválida %s: %s", entry.get('waitlist_id'), e)
+                continue
+            if offered is None:
+                continue
+            
+            booking_url = f"{os.environ.get('FRONTEND_URL', '')}/book/{user.get('custom_slug', user_id)}"
+            html = f"""
+            <h2>¡Se liberó un turno!</h2>
+            <p>Hola {entry['client_name']},</p>
+            <p>Hay un horario disponible para <strong>{entry['service_name']}</strong> en {user['business_name']}:</p>
+            <ul>
+                <li><strong>Fecha:</strong> {date}</li>
+                <li><strong>Hora:</strong> {minutes_to_time(offered)}</li>
+            </ul>
+            <p>Reservalo antes que otro cliente: <a href="{booking_url}">{booking_url}</a></p>
+            """
+            
+            async def claim(session):
+                # La entrada pasa a notificada y el aviso entra al outbox en la misma
+                # transacción: si el proceso se corta, no queda una sin la otra
+                claimed = await db.waitlist.update_one(
+                    {"waitlist_id": entry['waitlist_id'], "user_id": user_id, "status": "waiting"},
+                    {"$set": {
+                        "status": "notified",
+                        "offered_time": minutes_to_time(offered),
+                        "notified_at": datetime.now(timezone.utc).isoformat()
+                    }},
+                    session=session
+                )
+                if not claimed.modified_count:
+                    return False
+                await db.outbox.insert_many([
+                    outbox_email(entry['client_email'], "Se liberó un turno", html)
+                ], session=session)
+                return True
+            
+            if not await run_in_transaction(claim):
+                continue
+            outbox_wakeup.set()
+            return
+    except Exception as e:
+        logger.error("Error procesando lista de espera: %s", e)
+
+def schedule_waitlist_match(user_id: str, freed: List[Tuple[str, int, int]]):
+    # Un matcher por fecha con la ventana que cubre todos los horarios liberados
+    windows: Dict[str, Tuple[int, int]] = {}
+    for date, start, end in freed:
+        current = windows.get(date)
+        windows[date] = (min(start, current[0]), max(end, current[1])) if current else (start, end)
+    for date, (start, end) in windows.items():
+        run_detached(match_waitlist(user_id, date, start, end))
+
+@api_router.get("/public/{slug}/available-slots")
+async def get_available_slots(slug: str, service_id: str, date: str):
+    user = await find_user_by_slug(slug)
+    if not user:
+        raise HTTPException(status_code=404, detail="Negocio no encontrado")
     
-    slots = []
-    current_time = datetime.strptime(open_time, "%H:%M")
-    end_time = datetime.strptime(close_time, "%H:%M")
+    return await compute_available_slots(user, service_id, date)
+
+@api_router.get("/public/{slug}/slots/stream")
+async def stream_slot_changes(slug: str, date: str, request: Request):
+    user = await find_user_by_slug(slug, {"_id": 0, "user_id": 1})
+    if not user:
+        raise HTTPException(status_code=404, detail="Negocio no encontrado")
     
-    # Generar slots cada 15 minutos para mayor flexibilidad
-    slot_interval = 15
+    user_id = user['user_id']
+    queue = slot_events.subscribe(user_id, date)
+    
+    async def events():
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    yield await asyncio.wait_for(queue.get(), timeout=SLOT_STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            slot_events.unsubscribe(user_id, date, queue)
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@api_router.post("/public/{slug}/appointments")
+async def create_public_appointment(slug: str, appt_data: AppointmentCreate):
+    user = await find_user_by_slug(slug)
+    if not user:
+        raise HTTPException(status_code=404, detail="Negocio no encontrado")
     
-    while current_time < end_time:
-        # Calcular el rango que ocuparía este turno
-        proposed_start = current_time
-        proposed_end = current_time + timedelta(minutes=service_duration)
+    user_id = user['user_id']
+    closures = await get_closure_index(user)
+    hours_template = await get_hours_template(user)
+    
+    async def book(session):
+        # Lecturas, verificación de disponibilidad, alta del turno y mensajes del
+        # outbox se confirman juntos; with_transaction reintenta ante conflictos
+        service = await db.services.find_one(
+            {"service_id": appt_data.service_id, "user_id": user_id}, {"_id": 0}, session=session
+        )
+        if not service:
+            raise HTTPException(status_code=404, detail="Servicio no encontrado")
         
-        # Verificar que el turno termine antes del cierre
-        if proposed_end > end_time:
-            break
+        # Verificar disponibilidad considerando la duración del servicio
+        service_duration = service.get('duration_minutes', 30)
+        settings = get_scheduling_settings(user, service)
+        proposed_start = time_to_minutes(appt_data.time)
+        window_error = booking_window_error(appt_data.date, proposed_start, settings)
+        if window_error:
+            raise HTTPException(status_code=400, detail=window_error)
+        rule_error = schedule_rule_error(closures, hours_template, appt_data.date,
+                                         proposed_start, proposed_start + service_duration)
+        if rule_error:
+            raise HTTPException(status_code=400, detail=rule_error)
+        
+        buffer = settings['buffer_minutes']
+        busy, resource_ids = await scheduling_repo.lock_booking_window(
+            user_id, [appt_data.date], service.get('resource_ids'), session=session
+        )
+        available, resource_id = assign_resource(busy[appt_data.date], resource_ids, appt_data.resource_id,
+                                                 proposed_start - buffer, proposed_start + service_duration + buffer)
+        if not available:
+            raise HTTPException(status_code=400, detail="Este horario ya está reservado o se solapa con otro turno")
+        
+        appointment = {
+            "appointment_id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "service_id": appt_data.service_id,
+            "service_name": service['name'],
+            "service_duration": service_duration,  # Guardar duración para futuras consultas
+            "service_price": service.get('price', 0),
+            "resource_id": resource_id,
+            "client_name": appt_data.client_name,
+            "client_phone": appt_data.client_phone,
+            "client_email": appt_data.client_email,
+            "client_search": client_search_terms(appt_data.client_name, appt_data.client_phone, appt_data.client_email),
+            "client_key": client_key(appt_data.client_email, appt_data.client_phone),
+            "date": appt_data.date,
+            "time": appt_data.time,
+            "status": "pending",
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "updated_at": datetime.now(timezone.utc)
+        }
         
-        # Verificar si este slot se superpone con algún turno existente
-        is_available = True
-        for occupied in occupied_ranges:
-            # Hay conflicto si:
-            # - El inicio propuesto está entre un turno ocupado
-            # - El fin propuesto está entre un turno ocupado
-            # - El turno propuesto envuelve completamente un turno ocupado
-            if (occupied["start"] <= proposed_start < occupied["end"] or
-                occupied["start"] < proposed_end <= occupied["end"] or
-                (proposed_start <= occupied["start"] and proposed_end >= occupied["end"])):
-                is_available = False
-                break
+        await scheduling_repo.insert_appointment(with_reminder(appointment, settings['timezone']), session=session)
         
-        if is_available:
-            slots.append(current_time.strftime("%H:%M"))
+        client_html = f"""
+        <h2>¡Turno Confirmado!</h2>
+        <p>Hola {appt_data.client_name},</p>
+        <p>Tu turno ha sido confirmado:</p>
+        <ul>
+            <li><strong>Servicio:</strong> {service['name']}</li>
+            <li><strong>Duración:</strong> {service_duration} minutos</li>
+            <li><strong>Fecha:</strong> {appt_data.date}</li>
+            <li><strong>Hora:</strong> {appt_data.time}</li>
+            <li><strong>Negocio:</strong> {user['business_name']}</li>
+        </ul>
+        <p>Gracias por tu reserva.</p>
+        """
+        
+        owner_html = f"""
+        <h2>Nuevo Turno Reservado</h2>
+        <p>Se ha registrado un nuevo turno:</p>
+        <ul>
+            <li><strong>Cliente:</strong> {appt_data.client_name}</li>
+            <li><strong>Teléfono:</strong> {appt_data.client_phone}</li>
+            <li><strong>Servicio:</strong> {service['name']}</li>
+            <li><strong>Duración:</strong> {service_duration} minutos</li>
+            <li><strong>Fecha:</strong> {appt_data.date}</li>
+            <li><strong>Hora:</strong> {appt_data.time}</li>
+        </ul>
+        """
         
-        current_time += timedelta(minutes=slot_interval)
+        await db.outbox.insert_many([
+            outbox_email(appt_data.client_email, "Confirmación de turno", client_html),
+            outbox_email(user['email'], "Nuevo turno reservado", owner_html)
+        ], session=session)
+        return appointment
+    
+    appointment = await run_in_transaction(book)
     
-    return {"slots": slots}
+    await bump_appointments_version(user_id)
+    publish_slot_change(user_id, appt_data.date, "booked", appt_data.time,
+                        appointment['service_duration'], appointment['resource_id'])
+    await track_bookings(user_id, [appointment])
+    outbox_wakeup.set()
+    
+    # Return appointment without MongoDB's _id field
+    return {k: v for k, v in appointment.items() if k != '_id'}
 
-@api_router.post("/public/{slug}/appointments")
-async def create_public_appointment(slug: str, appt_data: AppointmentCreate):
-    # Obtener user_id desde slug
-    user = await db.users.find_one({"custom_slug": slug}, {"_id": 0})
+@api_router.get("/calendar/feed-url")
+async def get_calendar_feed_url(current_user: dict = Depends(get_current_user)):
+    await check_subscription(current_user)
+    token = current_user.get('calendar_token')
+    if not token:
+        token = secrets.token_urlsafe(24)
+        await db.users.update_one({"user_id": current_user['user_id']}, {"$set": {"calendar_token": token}})
+    return {"feed_url": f"{os.environ.get('BACKEND_URL', '')}/api/calendar/{token}.ics"}
+
+@api_router.post("/calendar/feed-url/rotate")
+async def rotate_calendar_feed_url(current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    token = secrets.token_urlsafe(24)
+    await db.users.update_one({"user_id": current_user['user_id']}, {"$set": {"calendar_token": token}})
+    return {"feed_url": f"{os.environ.get('BACKEND_URL', '')}/api/calendar/{token}.ics"}
+
+@api_router.get("/calendar/{token}.ics")
+async def get_calendar_feed_ics(token: str, request: Request):
+    user = await db.users.find_one(
+        {"calendar_token": token},
+        {"_id": 0, "user_id": 1, "business_name": 1, "appointments_version": 1, "scheduling.timezone": 1,
+         "trial_ends": 1, "subscription_active": 1, "subscription_ends": 1, "access_until": 1}
+    )
     if not user:
-        user = await db.users.find_one({"user_id": slug}, {"_id": 0})
+        raise HTTPException(status_code=404, detail="Calendario no encontrado")
+    if not has_access(user):
+        raise HTTPException(status_code=403, detail="La suscripción de este negocio ha expirado")
+    
+    today, _ = local_now(get_tenant_timezone(user))
+    etag = f'"{user["user_id"]}-{user.get("appointments_version", 0)}-{today}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=300"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    body = await get_calendar_feed(user)
+    return Response(content=body, media_type="text/calendar; charset=utf-8", headers=headers)
+
+@api_router.post("/public/{slug}/waitlist")
+async def join_waitlist(slug: str, waitlist_data: WaitlistCreate):
+    user = await find_user_by_slug(slug)
     if not user:
         raise HTTPException(status_code=404, detail="Negocio no encontrado")
     
-    user_id = user['user_id']
-    service = await db.services.find_one({"service_id": appt_data.service_id}, {"_id": 0})
+    service = await db.services.find_one(
+        {"service_id": waitlist_data.service_id, "user_id": user['user_id'], "active": True}, {"_id": 0}
+    )
     if not service:
         raise HTTPException(status_code=404, detail="Servicio no encontrado")
     
-    # Verificar disponibilidad considerando la duración del servicio
-    service_duration = service.get('duration_minutes', 30)
-    proposed_start = datetime.strptime(appt_data.time, "%H:%M")
-    proposed_end = proposed_start + timedelta(minutes=service_duration)
-    
-    # Obtener todos los turnos del día
-    existing_appointments = await db.appointments.find({
-        "user_id": user_id,
-        "date": appt_data.date,
-        "status": {"$ne": "cancelled"}
-    }, {"_id": 0}).to_list(100)
-    
-    # Verificar solapamiento
-    for existing in existing_appointments:
-        existing_service = await db.services.find_one({"service_id": existing["service_id"]}, {"_id": 0})
-        if existing_service:
-            existing_duration = existing_service.get('duration_minutes', 30)
-            existing_start = datetime.strptime(existing["time"], "%H:%M")
-            existing_end = existing_start + timedelta(minutes=existing_duration)
-            
-            # Verificar solapamiento
-            if (existing_start <= proposed_start < existing_end or
-                existing_start < proposed_end <= existing_end or
-                (proposed_start <= existing_start and proposed_end >= existing_end)):
-                raise HTTPException(status_code=400, detail="Este horario ya está reservado o se solapa con otro turno")
-    
-    appointment = {
-        "appointment_id": str(uuid.uuid4()),
-        "user_id": user_id,
-        "service_id": appt_data.service_id,
+    try:
+        datetime.strptime(waitlist_data.date, "%Y-%m-%d")
+        earliest = time_to_minutes(waitlist_data.earliest_time) if waitlist_data.earliest_time else None
+        latest = time_to_minutes(waitlist_data.latest_time) if waitlist_data.latest_time else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Formato de fecha u hora inválido")
+    if earliest is not None and latest is not None and earliest >= latest:
+        raise HTTPException(status_code=400, detail="La hora máxima debe ser posterior a la mínima")
+    today, _ = local_now(get_tenant_timezone(user))
+    if waitlist_data.date < today:
+        raise HTTPException(status_code=400, detail="La fecha ya pasó")
+    
+    entry = {
+        "waitlist_id": str(uuid.uuid4()),
+        "user_id": user['user_id'],
+        "service_id": service['service_id'],
         "service_name": service['name'],
-        "service_duration": service_duration,  # Guardar duración para futuras consultas
-        "client_name": appt_data.client_name,
-        "client_phone": appt_data.client_phone,
-        "client_email": appt_data.client_email,
-        "date": appt_data.date,
-        "time": appt_data.time,
-        "status": "pending",
+        "service_duration": service.get('duration_minutes', 30),
+        "client_name": waitlist_data.client_name,
+        "client_phone": waitlist_data.client_phone,
+        "client_email": waitlist_data.client_email,
+        "date": waitlist_data.date,
+        "earliest_time": waitlist_data.earliest_time,
+        "latest_time": waitlist_data.latest_time,
+        "status": "waiting",
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    await db.appointments.insert_one(appointment)
-    
-    client_html = f"""
-    <h2>¡Turno Confirmado!</h2>
-    <p>Hola {appt_data.client_name},</p>
-    <p>Tu turno ha sido confirmado:</p>
-    <ul>
-        <li><strong>Servicio:</strong> {service['name']}</li>
-        <li><strong>Duración:</strong> {service_duration} minutos</li>
-        <li><strong>Fecha:</strong> {appt_data.date}</li>
-        <li><strong>Hora:</strong> {appt_data.time}</li>
-        <li><strong>Negocio:</strong> {user['business_name']}</li>
-    </ul>
-    <p>Gracias por tu reserva.</p>
-    """
+    await db.waitlist.insert_one(entry)
+    return {"message": "Te avisaremos si se libera un turno", "waitlist_id": entry['waitlist_id']}
+
+@api_router.get("/waitlist")
+async def get_waitlist(date: Optional[str] = None, current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    query = {"user_id": current_user['user_id'], "status": {"$in": ["waiting", "notified"]}}
+    if date:
+        query["date"] = date
+    return await db.waitlist.find(query, {"_id": 0}).sort([("date", 1), ("created_at", 1)]).to_list(1000)
+
+@api_router.delete("/waitlist/{waitlist_id}")
+async def delete_waitlist_entry(waitlist_id: str, current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
     
-    owner_html = f"""
-    <h2>Nuevo Turno Reservado</h2>
-    <p>Se ha registrado un nuevo turno:</p>
-    <ul>
-        <li><strong>Cliente:</strong> {appt_data.client_name}</li>
-        <li><strong>Teléfono:</strong> {appt_data.client_phone}</li>
-        <li><strong>Servicio:</strong> {service['name']}</li>
-        <li><strong>Duración:</strong> {service_duration} minutos</li>
-        <li><strong>Fecha:</strong> {appt_data.date}</li>
-        <li><strong>Hora:</strong> {appt_data.time}</li>
-    </ul>
-    """
+    result = await db.waitlist.update_one(
+        {"waitlist_id": waitlist_id, "user_id": current_user['user_id']},
+        {"$set": {"status": "removed"}}
+    )
     
-    asyncio.create_task(send_email_async(appt_data.client_email, "Confirmación de turno", client_html))
-    asyncio.create_task(send_email_async(user['email'], "Nuevo turno reservado", owner_html))
+    if result.modified_count == 0:
+        raise HTTPException(status_code=404, detail="Entrada no encontrada")
     
-    # Return appointment without MongoDB's _id field
-    return {k: v for k, v in appointment.items() if k != '_id'}
+    return {"message": "Entrada eliminada"}
+
+@api_router.get("/clients")
+async def get_clients(sort: str = "last_visit", skip: int = 0, limit: int = 50, current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    
+    sort_fields = {"last_visit": "last_visit", "visits": "booking_count", "spend": "total_spend"}
+    if sort not in sort_fields:
+        raise HTTPException(status_code=400, detail="Orden inválido")
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    
+    clients = await db.clients.find(
+        {"user_id": current_user['user_id']}, {"_id": 0}
+    ).sort(sort_fields[sort], DESCENDING).skip(max(0, skip)).limit(limit).to_list(limit)
+    return clients
+
+@api_router.get("/clients/{key}")
+async def get_client(key: str, current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    client_doc = await db.clients.find_one(
+        {"user_id": current_user['user_id'], "client_key": key.lower()}, {"_id": 0}
+    )
+    if not client_doc:
+        raise HTTPException(status_code=404, detail="Cliente no encontrado")
+    return client_doc
+
+@api_router.post("/clients/rebuild")
+async def rebuild_clients_endpoint(current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    await rebuild_clients(current_user['user_id'])
+    return {"message": "Clientes recalculados"}
+
+@api_router.get("/analytics")
+async def get_analytics(start_date: str, end_date: str, granularity: str = "day", current_user: dict = Depends(get_current_claims)):
+    await check_subscription(current_user)
+    user_id = current_user['user_id']
+    
+    if granularity not in ("day", "week", "month"):
+        raise HTTPException(status_code=400, detail="Granularidad inválida")
+    first, last = parse_date_window(start_date, end_date, ANALYTICS_MAX_DAYS)
+    
+    rollups = await db.daily_stats.find(
+        {"user_id": user_id, "date": {"$gte": start_date, "$lte": end_date}}, {"_id": 0}
+    ).to_list(None)
+    hours_template = build_hours_template(
+        await db.business_hours.find({"user_id": user_id}, {"_id": 0}).to_list(7),
+        await db.business_hours_overrides.find(
+            {"user_id": user_id, "date": {"$gte": start_date, "$lte": end_date}}, {"_id": 0}
+        ).to_list(None)
+    )
+    closures = build_closure_index(await db.closed_dates.find(
+        {"user_id": user_id, "start_date": {"$lte": end_date}, "end_date": {"$gte": start_date}}, {"_id": 0}
+    ).to_list(None))
+    capacity = max(1, await db.resources.count_documents({"user_id": user_id, "active": True}))
+    
+    by_date = {r['date']: r for r in rollups}
+    
+    buckets: Dict[str, dict] = {}
+    busiest: Dict[str, int] = {}
+    current = first
+    while current <= last:
+        date = current.strftime("%Y-%m-%d")
+        period = analytics_period(date, granularity)
+        bucket = buckets.setdefault(period, {
+            "period": period, "appointments": 0, "cancelled": 0, "revenue": 0,
+            "booked_minutes": 0, "open_minutes": 0
+        })
+        rollup = by_date.get(date, {})
+        for field in ("appointments", "cancelled", "revenue", "booked_minutes"):
+            bucket[field] += rollup.get(field, 0)
+        closed_all_day, closed_windows = closure_on(closures, date)
+        if not closed_all_day:
+            # Minutos abiertos de todas las franjas, descontando los cierres parciales
+            closed_windows = merge_intervals(closed_windows)
+            open_minutes = 0
+            for open_start, open_end in open_intervals_on(hours_template, date):
+                open_minutes += open_end - open_start
+                for start, end in closed_windows:
+                    open_minutes -= max(0, min(end, open_end) - max(start, open_start))
+            bucket["open_minutes"] += open_minutes * capacity
+        for hour, count in rollup.get('by_hour', {}).items():
+            busiest[hour] = busiest.get(hour, 0) + count
+        current += timedelta(days=1)
+    
+    for bucket in buckets.values():
+        bucket["occupancy"] = round(100 * bucket["booked_minutes"] / bucket["open_minutes"], 1) if bucket["open_minutes"] else 0
+    
+    return {
+        "buckets": list(buckets.values()),
+        "busiest_hours": [
+            {"hour": f"{hour}:00", "appointments": count}
+            for hour, count in sorted(busiest.items(), key=lambda x: x[1], reverse=True) if count > 0
+        ][:5]
+    }
 
 @api_router.get("/subscription/status")
 async def get_subscription_status(current_user: dict = Depends(get_current_user)):
-    trial_ends = current_user['trial_ends']
-    if isinstance(trial_ends, str):
-        trial_ends = datetime.fromisoformat(trial_ends)
-    
-    trial_days_left = max(0, (trial_ends - datetime.now(timezone.utc)).days)
+    now = datetime.now(timezone.utc)
+    trial_ends = parse_datetime(current_user['trial_ends'])
+    trial_days_left = max(0, (trial_ends - now).days)
     
-    # Verificar si la suscripción expiró
-    if current_user['subscription_active']:
-        sub_ends = current_user.get('subscription_ends')
-        if sub_ends:
-            if isinstance(sub_ends, str):
-                sub_ends = datetime.fromisoformat(sub_ends)
-            if datetime.now(timezone.utc) > sub_ends:
-                # Suscripción expirada, desactivarla
-                await db.users.update_one(
-                    {"user_id": current_user['user_id']},
-                    {"$set": {"subscription_active": False}}
-                )
-                current_user['subscription_active'] = False
+    # El barrido periódico desactiva las suscripciones vencidas; acá solo se refleja el estado
+    subscription_active = current_user['subscription_active'] and has_access(current_user)
     
     # Calcular días restantes de suscripción
     subscription_days_left = 0
-    if current_user['subscription_active'] and current_user.get('subscription_ends'):
-        sub_ends = current_user['subscription_ends']
-        if isinstance(sub_ends, str):
-            sub_ends = datetime.fromisoformat(sub_ends)
-        subscription_days_left = max(0, (sub_ends - datetime.now(timezone.utc)).days)
+    if subscription_active and current_user.get('subscription_ends'):
+        sub_ends = parse_datetime(current_user['subscription_ends'])
+        subscription_days_left = max(0, (sub_ends - now).days)
     
     return {
-        "subscription_active": current_user['subscription_active'],
+        "subscription_active": subscription_active,
         "trial_days_left": trial_days_left,
         "subscription_ends": current_user.get('subscription_ends'),
         "subscription_price": SUBSCRIPTION_PRICE,
@@ -753,7 +3107,7 @@ async def report_bug(bug_report: BugReport, current_user: dict = Depends(get_cur
         """
         
         if RESEND_API_KEY:
-            await asyncio.to_thread(resend.Emails.send, {
+            await asyncio.to_thread(get_resend().Emails.send, {
                 "from": "Turnitos <onboarding@resend.dev>",
                 "to": ["sitelab.webdev@gmail.com"],
                 "reply_to": bug_report.email,
@@ -762,10 +3116,10 @@ async def report_bug(bug_report: BugReport, current_user: dict = Depends(get_cur
             })
             return {"message": "Reporte enviado exitosamente"}
         else:
-            logging.warning("RESEND_API_KEY no configurada, no se puede enviar el reporte")
+            logger.warning("RESEND_API_KEY no configurada, no se puede enviar el reporte")
             raise HTTPException(status_code=500, detail="Servicio de email no configurado")
     except Exception as e:
-        logging.error(f"Error enviando reporte: {str(e)}")
+        logger.error("Error enviando reporte: %s", e)
         raise HTTPException(status_code=500, detail="Error al enviar el reporte")
 
 @api_router.get("/user/custom-slug")
@@ -773,7 +3127,7 @@ async def get_custom_slug(current_user: dict = Depends(get_current_user)):
     return {"custom_slug": current_user.get('custom_slug', current_user['user_id'])}
 
 @api_router.put("/user/custom-slug")
-async def update_custom_slug(slug_data: CustomSlugUpdate, current_user: dict = Depends(get_current_user)):
+async def update_custom_slug(slug_data: CustomSlugUpdate, current_user: dict = Depends(get_current_claims)):
     slug = slug_data.custom_slug.lower().strip()
     
     # Validaciones
@@ -801,6 +3155,7 @@ async def update_custom_slug(slug_data: CustomSlugUpdate, current_user: dict = D
 
 @api_router.post("/subscription/create-payment")
 async def create_payment(current_user: dict = Depends(get_current_user)):
+    sdk = get_mercadopago_sdk()
     if not sdk:
         raise HTTPException(status_code=500, detail="MercadoPago no configurado")
     
@@ -836,14 +3191,18 @@ async def create_payment(current_user: dict = Depends(get_current_user)):
             "preference_id": preference["id"]
         }
     except Exception as e:
-        logging.error(f"Error creando preference: {str(e)}")
+        logger.error("Error creando preference: %s", e)
         raise HTTPException(status_code=500, detail=f"Error al crear link de pago: {str(e)}")
 
 @api_router.post("/webhooks/mercadopago")
 async def mercadopago_webhook(request: Request):
     try:
         body = await request.json()
-        logging.info(f"Webhook recibido: {body}")
+        # Sólo los identificadores: el cuerpo completo puede traer datos del pagador
+        webhook_logger.info(
+            "Webhook recibido: type=%s action=%s id=%s",
+            body.get("type"), body.get("action"), body.get("data", {}).get("id")
+        )
         
         if body.get("type") == "payment":
             payment_id = body.get("data", {}).get("id")
@@ -851,14 +3210,18 @@ async def mercadopago_webhook(request: Request):
             if not payment_id:
                 return {"status": "no payment id"}
             
+            sdk = get_mercadopago_sdk()
             if not sdk:
-                logging.error("SDK de MercadoPago no configurado")
+                logger.error("SDK de MercadoPago no configurado")
                 return {"status": "sdk not configured"}
             
             payment_info = sdk.payment().get(payment_id)
             payment = payment_info["response"]
             
-            logging.info(f"Pago recibido: {payment}")
+            webhook_logger.info(
+                "Pago recibido: id=%s status=%s user=%s",
+                payment_id, payment.get("status"), payment.get("external_reference")
+            )
             
             if payment["status"] == "approved":
                 user_id = payment.get("external_reference")
@@ -872,6 +3235,7 @@ async def mercadopago_webhook(request: Request):
                             "$set": {
                                 "subscription_active": True,
                                 "subscription_ends": subscription_ends.isoformat(),
+                                "access_until": subscription_ends,
                                 "last_payment_id": payment_id,
                                 "last_payment_date": datetime.now(timezone.utc).isoformat(),
                                 "last_payment_amount": payment["transaction_amount"]
@@ -898,15 +3262,16 @@ async def mercadopago_webhook(request: Request):
                             confirmation_html
                         ))
                     
-                    logging.info(f"Suscripción activada para user {user_id}")
+                    logger.info("Suscripción activada para user %s", user_id)
         
         return {"status": "ok"}
     except Exception as e:
-        logging.error(f"Error procesando webhook: {str(e)}")
+        logger.error("Error procesando webhook: %s", e)
         return {"status": "error", "message": str(e)}
 
 @api_router.get("/subscription/check-payment/{payment_id}")
-async def check_payment_status(payment_id: str, current_user: dict = Depends(get_current_user)):
+async def check_payment_status(payment_id: str, current_user: dict = Depends(get_current_claims)):
+    sdk = get_mercadopago_sdk()
     if not sdk:
         raise HTTPException(status_code=500, detail="MercadoPago no configurado")
     
@@ -922,22 +3287,350 @@ async def check_payment_status(payment_id: str, current_user: dict = Depends(get
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al verificar pago: {str(e)}")
 
-app.include_router(api_router)
+async def get_profiling_config() -> Optional[dict]:
+    # Todos los workers comparten el pedido de perfilado guardado en la base
+    if profiling_state["expires"] <= time.monotonic():
+        profiling_state["config"] = await db.profiling.find_one({"key": "config"}, {"_id": 0})
+        profiling_state["expires"] = time.monotonic() + PROFILING_POLL_SECONDS
+    return profiling_state["config"]
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+async def claim_profiling_slot(path: str) -> bool:
+    config = await get_profiling_config()
+    if not config or config.get('remaining', 0) <= 0 or not path.startswith(config['path_prefix']):
+        return False
+    # El descuento atómico reparte los N pedidos entre todos los workers
+    config = await db.profiling.find_one_and_update(
+        {"key": "config", "remaining": {"$gt": 0}},
+        {"$inc": {"remaining": -1}},
+        projection={"_id": 0},
+        return_document=True
+    )
+    profiling_state["config"] = config
+    return config is not None
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+async def correlate_request(request: Request, call_next):
+    token = correlation_id.set(new_correlation_id(request.headers.get("x-request-id")))
+    try:
+        response = await call_next(request)
+        response.headers["X-Request-ID"] = correlation_id.get()
+        return response
+    finally:
+        correlation_id.reset(token)
+
+async def observe_request(request: Request, call_next):
+    path = request.url.path
+    trace = new_trace(request.method, path)
+    token = request_trace.set(trace)
+    profiler = None
+    status_code = 500
+    started = time.perf_counter()
+    try:
+        # Mientras otro pedido se perfila no se consume el cupo: quedaría para el siguiente
+        if not path.startswith("/api/admin/") and not profiler_active() and await claim_profiling_slot(path):
+            profiler = start_profiler()
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        duration_ms = (time.perf_counter() - started) * 1000
+        request_trace.reset(token)
+        if profiler:
+            await db.profiles.insert_one({
+                "profile_id": str(uuid.uuid4()),
+                "method": request.method,
+                "path": path,
+                "correlation_id": correlation_id.get(),
+                "status_code": status_code,
+                "duration_ms": round(duration_ms, 2),
+                "db_ms": round(trace["db_ms"], 2),
+                "db_calls": trace["db_calls"],
+                "hot_spots": profile_hot_spots(profiler),
+                "created_at": datetime.now(timezone.utc)
+            })
+        if duration_ms >= SLOW_REQUEST_MS:
+            log_slow_operation(
+                "request",
+                method=request.method,
+                path=path,
+                status_code=status_code,
+                duration_ms=round(duration_ms, 2),
+                db_calls=len(trace["db_calls"]),
+                db_ms=round(trace["db_ms"], 2)
+            )
+
+@api_router.post("/admin/profiling")
+async def start_profiling(profiling: ProfilingRequest, current_user: dict = Depends(get_admin_user)):
+    # Perfila los próximos `count` pedidos cuya ruta empiece con path_prefix
+    config = {
+        "key": "config",
+        "path_prefix": profiling.path_prefix,
+        "remaining": profiling.count,
+        "armed_by": current_user['email'],
+        "armed_at": datetime.now(timezone.utc)
+    }
+    await db.profiling.update_one({"key": "config"}, {"$set": config}, upsert=True)
+    profiling_state["config"] = config
+    profiling_state["expires"] = time.monotonic() + PROFILING_POLL_SECONDS
+    return {"message": "Perfilado activado", "path_prefix": profiling.path_prefix, "count": profiling.count}
+
+@api_router.delete("/admin/profiling")
+async def stop_profiling(current_user: dict = Depends(get_admin_user)):
+    await db.profiling.update_one({"key": "config"}, {"$set": {"remaining": 0}})
+    profiling_state["expires"] = 0.0
+    return {"message": "Perfilado desactivado"}
+
+@api_router.get("/admin/profiles")
+async def get_profiles(limit: int = 20, current_user: dict = Depends(get_admin_user)):
+    limit = max(1, min(limit, PROFILING_MAX_REQUESTS))
+    return await db.profiles.find(
+        {}, {"_id": 0, "hot_spots": 0, "db_calls": 0}
+    ).sort("created_at", -1).limit(limit).to_list(limit)
+
+@api_router.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, current_user: dict = Depends(get_admin_user)):
+    profile = await db.profiles.find_one({"profile_id": profile_id}, {"_id": 0})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    return profile
+
+async def backfill_access_until():
+    # Precalcular access_until para usuarios creados antes de existir el campo
+    cursor = db.users.find(
+        {"access_until": {"$exists": False}},
+        {"_id": 0, "user_id": 1, "trial_ends": 1, "subscription_active": 1, "subscription_ends": 1}
+    )
+    operations = []
+    async for user in cursor:
+        operations.append(UpdateOne(
+            {"user_id": user['user_id']},
+            {"$set": {"access_until": compute_access_until(user)}}
+        ))
+        if len(operations) >= 500:
+            await db.users.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        await db.users.bulk_write(operations, ordered=False)
+
+async def backfill_token_version():
+    # Usuarios creados antes de invalidar sesiones por versión de token
+    await db.users.update_many(
+        {"token_version": {"$exists": False}}, {"$set": {"token_version": 0}}, comment=CROSS_TENANT_COMMENT
+    )
+
+async def backfill_client_search():
+    # Completar los términos de búsqueda y la clave de cliente de turnos creados
+    # antes de existir esos campos
+    for collection in (db.appointments, db.appointments_archive):
+        cursor = collection.find(
+            {"$or": [{"client_search": {"$exists": False}}, {"client_key": {"$exists": False}}]},
+            {"_id": 0, "appointment_id": 1, "user_id": 1, "date": 1,
+             "client_name": 1, "client_phone": 1, "client_email": 1},
+            comment=CROSS_TENANT_COMMENT
+        )
+        operations = []
+        async for appt in cursor:
+            operations.append(UpdateOne(
+                {"user_id": appt['user_id'], "date": appt['date'], "appointment_id": appt['appointment_id']},
+                {"$set": {
+                    "client_search": client_search_terms(
+                        appt.get('client_name', ''), appt.get('client_phone', ''), appt.get('client_email', '')
+                    ),
+                    "client_key": client_key(appt.get('client_email'), appt.get('client_phone'))
+                }}
+            ))
+            if len(operations) >= 500:
+                await collection.bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            await collection.bulk_write(operations, ordered=False)
+
+async def backfill_closure_ranges():
+    # Los días cerrados anteriores a los rangos solo tenían date
+    await db.closed_dates.update_many(
+        {"start_date": {"$exists": False}},
+        [{"$set": {"start_date": "$date", "end_date": "$date", "closure_id": {"$toString": "$_id"},
+                   "source": "manual"}}],
+        comment=CROSS_TENANT_COMMENT
+    )
+
+async def daily_stats_backfill():
+    # Reconciliación nocturna: corrige desvíos de los contadores incrementales
+    while True:
+        try:
+            end = datetime.now(timezone.utc)
+            start = end - timedelta(days=ROLLUP_BACKFILL_DAYS)
+            await rebuild_daily_stats(start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))
+            await roll_client_visits(start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))
+        except Exception as e:
+            logger.error("Error recalculando estadísticas diarias: %s", e)
+        await asyncio.sleep(ROLLUP_BACKFILL_INTERVAL_SECONDS)
+
+async def archive_appointments_batch(limit: int = ARCHIVE_BATCH_SIZE) -> int:
+    # Copia el lote al archivo y recién después lo borra de la colección activa;
+    # si el proceso se corta en el medio, el reintento reescribe las mismas copias
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d")
+    query = {"$or": [
+        {"date": {"$lt": cutoff}},
+        {"date": {"$lt": today}, "status": "cancelled"}
+    ]}
+    batch = await db.appointments.find(query, {"_id": 0}, comment=CROSS_TENANT_COMMENT).limit(limit).to_list(limit)
+    if not batch:
+        return 0
+    
+    now = datetime.now(timezone.utc)
+    await db.appointments_archive.bulk_write([
+        ReplaceOne(
+            {"user_id": appt['user_id'], "date": appt['date'], "appointment_id": appt['appointment_id']},
+            {**appt, "archived_at": now},
+            upsert=True
+        )
+        for appt in batch
+    ], ordered=False)
+    await db.appointments.bulk_write([
+        DeleteOne({"user_id": appt['user_id'], "appointment_id": appt['appointment_id']}) for appt in batch
+    ], ordered=False)
+    return len(batch)
+
+async def appointment_archiver():
+    while True:
+        try:
+            while await archive_appointments_batch() == ARCHIVE_BATCH_SIZE:
+                pass
+        except Exception as e:
+            logger.error("Error archivando turnos: %s", e)
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+async def sweep_expired_subscriptions():
+    result = await db.users.update_many(
+        {"subscription_active": True, "access_until": {"$lte": datetime.now(timezone.utc)}},
+        {"$set": {"subscription_active": False}}
+    )
+    if result.modified_count:
+        logger.info("Suscripciones vencidas desactivadas: %s", result.modified_count)
+
+async def subscription_sweeper():
+    while True:
+        try:
+            await sweep_expired_subscriptions()
+        except Exception as e:
+            logger.error("Error en barrido de suscripciones: %s", e)
+        await asyncio.sleep(SUBSCRIPTION_SWEEP_INTERVAL_SECONDS)
+
+async def detect_mongo_features():
+    hello = await get_mongo_client().admin.command("hello")
+    mongo_features["transactions"] = "setName" in hello or hello.get("msg") == "isdbgrid"
+
+async def create_indexes():
+    await db.appointments.create_index([("user_id", 1), ("date", 1), ("time", 1)])
+    await db.appointments.create_index([("user_id", 1), ("updated_at", 1)])
+    await db.users.create_index("calendar_token", unique=True, sparse=True)
+    await db.resources.create_index([("user_id", 1), ("resource_id", 1)])
+    await db.appointment_series.create_index([("user_id", 1), ("active", 1), ("weekday", 1), ("start_date", 1)])
+    # Recorrido de recordatorios de series entre negocios por día de la semana y hora
+    await db.appointment_series.create_index([("active", 1), ("weekday", 1), ("time", 1)])
+    await db.appointments.create_index([("user_id", 1), ("client_search", 1), ("date", -1)])
+    await db.clients.create_index([("user_id", 1), ("client_key", 1)], unique=True)
+    await db.appointments.create_index([("user_id", 1), ("client_key", 1)])
+    await db.appointments_archive.create_index([("user_id", 1), ("client_key", 1)])
+    await db.appointments_archive.create_index([("user_id", 1), ("client_search", 1), ("date", -1)])
+    for field in ("last_visit", "booking_count", "total_spend"):
+        await db.clients.create_index([("user_id", 1), (field, -1)])
+    await db.booking_locks.create_index([("user_id", 1), ("date", 1)], unique=True)
+    await db.outbox.create_index([("status", 1), ("available_at", 1)])
+    await db.outbox.create_index("message_id", unique=True)
+    # Solo los turnos con recordatorio pendiente entran al índice
+    await db.appointments.create_index(
+        [("remind_at", 1)],
+        partialFilterExpression={"remind_at": {"$exists": True}}
+    )
+    await db.daily_stats.create_index([("user_id", 1), ("date", 1)], unique=True)
+    await db.closed_dates.create_index([("user_id", 1), ("start_date", 1), ("end_date", 1)])
+    await db.business_hours_overrides.create_index([("user_id", 1), ("date", 1)], unique=True)
+    await db.profiling.create_index("key", unique=True)
+    await db.profiles.create_index("profile_id", unique=True)
+    await db.profiles.create_index("created_at", expireAfterSeconds=PROFILE_RETENTION_SECONDS)
+    await db.appointments.create_index([("date", 1), ("status", 1)])
+    # Cada índice parcial contiene solo los turnos en ese estado, así la cola de
+    # pendientes de un negocio grande no recorre su historial
+    for state, (name, keys) in STATUS_INDEXES.items():
+        await db.appointments.create_index(keys, name=name, partialFilterExpression={"status": state})
+    await db.appointments.create_index([("user_id", 1), ("appointment_id", 1)])
+    # Los índices únicos de una colección particionada deben empezar por la shard key
+    await db.appointments_archive.create_index([("user_id", 1), ("date", 1), ("appointment_id", 1)], unique=True)
+    await db.appointments_archive.create_index([("user_id", 1), ("date", -1), ("time", -1)])
+    await db.waitlist.create_index([("user_id", 1), ("date", 1), ("status", 1), ("created_at", 1)])
+    await db.users.create_index(
+        [("subscription_active", 1), ("access_until", 1)],
+        partialFilterExpression={"subscription_active": True}
+    )
+
+async def prepare_database():
+    # Corre en segundo plano para que el worker acepte pedidos sin esperar índices ni backfills
+    try:
+        await detect_mongo_features()
+        await create_indexes()
+        await backfill_access_until()
+        await backfill_token_version()
+        await backfill_client_search()
+        await backfill_closure_ranges()
+    except Exception as e:
+        logger.error("Error preparando la base de datos: %s", e)
+
+def start_logging():
+    # Se instala al arrancar el worker y no al importar: importar el módulo (pruebas,
+    # herramientas) no reemplaza los handlers del proceso ni levanta el thread del listener.
+    # LOG_SAMPLE_RATE: fracción de los INFO que se conservan de los loggers en LOG_SAMPLED_LOGGERS
+    if "log_listener" in _lazy_clients:
+        return
+    _lazy_clients["log_listener"] = configure_logging(
+        level=os.environ.get('LOG_LEVEL', 'INFO'),
+        json_output=os.environ.get('LOG_FORMAT', 'json') == 'json',
+        sample_rate=float(os.environ.get('LOG_SAMPLE_RATE', '1.0')),
+        sampled_loggers=os.environ.get('LOG_SAMPLED_LOGGERS', 'uvicorn.access,turnitos.webhooks').split(',')
+    )
+
+def stop_logging():
+    # Vacía la cola antes de que el proceso termine
+    listener = _lazy_clients.pop("log_listener", None)
+    if listener:
+        listener.stop()
+
+async def startup_background_jobs():
+    background_tasks.append(asyncio.create_task(prepare_database()))
+    background_tasks.append(asyncio.create_task(subscription_sweeper()))
+    background_tasks.append(asyncio.create_task(daily_stats_backfill()))
+    background_tasks.append(asyncio.create_task(outbox_dispatcher()))
+    background_tasks.append(asyncio.create_task(reminder_dispatcher()))
+    background_tasks.append(asyncio.create_task(appointment_archiver()))
+    background_tasks.append(asyncio.create_task(slot_event_relay()))
 
-@app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    for task in background_tasks:
+        task.cancel()
+    if "mongo" in _lazy_clients:
+        _lazy_clients.pop("mongo").close()
+
+def create_app() -> FastAPI:
+    app = FastAPI(title="Turnitos API")
+    app.include_router(api_router)
+    
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    
+    app.middleware("http")(observe_request)
+    # Registrado último para quedar por fuera: el id ya existe cuando corre observe_request
+    app.middleware("http")(correlate_request)
+    
+    app.add_event_handler("startup", start_logging)
+    app.add_event_handler("startup", startup_background_jobs)
+    app.add_event_handler("shutdown", shutdown_db_client)
+    app.add_event_handler("shutdown", stop_logging)
+    return app
+
+app = create_app()
\ No newline at end of file
@@ -1,6 +1,6 @@
 import React, { useEffect, useState } from 'react';
 import { toast } from 'sonner';
-import { Plus, Trash2, Calendar as CalendarIcon } from 'lucide-react';
+import { Plus, Trash2, Check, UserX, Calendar as CalendarIcon } from 'lucide-react';
 import { Button } from '../components/ui/button';
 import { Card, CardContent, CardHeader, CardTitle } from '../components/ui/card';
 import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogTrigger } from '../components/ui/dialog';
@@ -56,10 +56,15 @@ const Appointments = () => {
     }
   };
 
-  const handleCancel = async (appointmentId) => {
+  const handleCancel = async (appt) => {
     if (!window.confirm('¿Cancelar este turno?')) return;
     try {
-      await api.delete(`/appointments/${appointmentId}`);
+      // Los turnos de una serie se cancelan como excepción de la serie
+      await api.delete(
+        appt.series_id
+          ? `/appointments/series/${appt.series_id}/occurrences/${appt.date}`
+          : `/appointments/${appt.appointment_id}`
+      );
       toast.success('Turno cancelado');
       loadData();
     } catch (error) {
@@ -67,6 +72,23 @@ const Appointments = () => {
     }
   };
 
+  const handleStatus = async (appointmentId, status) => {
+    try {
+      const { data } = await api.post('/appointments/bulk/status', {
+        appointment_ids: [appointmentId],
+        status,
+      });
+      if (data.updated) {
+        toast.success('Turno actualizado');
+      } else {
+        toast.error('El turno no puede pasar a ese estado todavía');
+      }
+      loadData();
+    } catch (error) {
+      toast.error('Error al actualizar turno');
+    }
+  };
+
   const resetForm = () => {
     setFormData({
       service_id: '',
@@ -82,11 +104,20 @@ const Appointments = () => {
     const variants = {
       pending: 'bg-yellow-100 text-yellow-800 border-yellow-300',
       confirmed: 'bg-green-100 text-green-800 border-green-300',
+      completed: 'bg-blue-100 text-blue-800 border-blue-300',
+      no_show: 'bg-zinc-100 text-zinc-800 border-zinc-300',
       cancelled: 'bg-red-100 text-red-800 border-red-300',
     };
+    const labels = {
+      pending: 'Pendiente',
+      confirmed: 'Confirmado',
+      completed: 'Atendido',
+      no_show: 'No asistió',
+      cancelled: 'Cancelado',
+    };
     return (
       <Badge className={variants[status] || variants.pending} data-testid={`status-badge-${status}`}>
-        {status === 'pending' ? 'Pendiente' : status === 'confirmed' ? 'Confirmado' : 'Cancelado'}
+        {labels[status] || labels.pending}
       </Badge>
     );
   };
@@ -248,17 +279,52 @@ const Appointments = () => {
                       </p>
                     </div>
                   </div>
-                  {appt.status !== 'cancelled' && (
-                    <Button
-                      variant="ghost"
-                      size="icon"
-                      onClick={() => handleCancel(appt.appointment_id)}
-                      data-testid={`cancel-appointment-${appt.appointment_id}`}
-                      className="text-red-600 hover:text-red-700 hover:bg-red-50"
-                    >
-                      <Trash2 size={18} />
-                    </Button>
-                  )}
+                  <div className="flex gap-1">
+                    {appt.status === 'pending' && (
+                      <Button
+                        variant="ghost"
+                        size="icon"
+                        onClick={() => handleStatus(appt.appointment_id, 'confirmed')}
+                        data-testid={`confirm-appointment-${appt.appointment_id}`}
+                        className="text-green-600 hover:text-green-700 hover:bg-green-50"
+                      >
+                        <Check size={18} />
+                      </Button>
+                    )}
+                    {appt.status === 'confirmed' && !appt.series_id && (
+                      <>
+                        <Button
+                          variant="ghost"
+                          size="icon"
+                          onClick={() => handleStatus(appt.appointment_id, 'completed')}
+                          data-testid={`complete-appointment-${appt.appointment_id}`}
+                          className="text-blue-600 hover:text-blue-700 hover:bg-blue-50"
+                        >
+                          <Check size={18} />
+                        </Button>
+                        <Button
+                          variant="ghost"
+                          size="icon"
+                          onClick={() => handleStatus(appt.appointment_id, 'no_show')}
+                          data-testid={`no-show-appointment-${appt.appointment_id}`}
+                          className="text-zinc-600 hover:text-zinc-700 hover:bg-zinc-50"
+                        >
+                          <UserX size={18} />
+                        </Button>
+                      </>
+                    )}
+                    {(appt.status === 'pending' || appt.status === 'confirmed') && (
+                      <Button
+                        variant="ghost"
+                        size="icon"
+                        onClick={() => handleCancel(appt)}
+                        data-testid={`cancel-appointment-${appt.appointment_id}`}
+                        className="text-red-600 hover:text-red-700 hover:bg-red-50"
+                      >
+                        <Trash2 size={18} />
+                      </Button>
+                    )}
+                  </div>
                 </div>
               </CardContent>
             </Card>
@@ -5,7 +5,7 @@ import { Card, CardContent, CardHeader, CardTitle } from '../components/ui/card'
 import { Switch } from '../components/ui/switch';
 import { Input } from '../components/ui/input';
 import { Label } from '../components/ui/label';
-import { Clock, Calendar, Trash2 } from 'lucide-react';
+import { Clock, Calendar, Trash2, Plus } from 'lucide-react';
 import api from '../utils/api';
 
 const DAYS = [
@@ -18,6 +18,31 @@ const DAYS = [
   { id: 6, name: 'Domingo', short: 'Dom' },
 ];
 
+const DEFAULT_INTERVAL = { open_time: '09:00', close_time: '18:00' };
+
+const toMinutes = (value) => {
+  const [h, m] = value.split(':').map(Number);
+  return h * 60 + m;
+};
+
+const toTime = (minutes) => {
+  const clamped = Math.min(minutes, 23 * 60 + 59);
+  return `${String(Math.floor(clamped / 60)).padStart(2, '0')}:${String(clamped % 60).padStart(2, '0')}`;
+};
+
+// Franjas del día; los horarios guardados antes de existir las franjas solo tienen apertura y cierre
+const dayIntervals = (h) => (h.intervals && h.intervals.length
+  ? h.intervals
+  : [{ open_time: h.open_time || DEFAULT_INTERVAL.open_time, close_time: h.close_time || DEFAULT_INTERVAL.close_time }]);
+
+// open_time/close_time acompañan a las franjas como apertura y cierre del día
+const withIntervals = (h, intervals) => ({
+  ...h,
+  intervals,
+  open_time: intervals.length ? intervals[0].open_time : null,
+  close_time: intervals.length ? intervals[intervals.length - 1].close_time : null,
+});
+
 const BusinessHours = () => {
   const [hours, setHours] = useState([]);
   const [loading, setLoading] = useState(true);
@@ -49,26 +74,39 @@ const BusinessHours = () => {
     }
   };
 
+  const updateDay = (dayId, update) => {
+    setHours(hours.map(h => (h.day_of_week === dayId ? update(h) : h)));
+  };
+
   const handleToggle = (dayId, isOpen) => {
-    setHours(hours.map(h => 
-      h.day_of_week === dayId 
-        ? { ...h, is_open: isOpen, open_time: isOpen ? '09:00' : null, close_time: isOpen ? '18:00' : null }
-        : h
-    ));
+    updateDay(dayId, h => withIntervals({ ...h, is_open: isOpen }, isOpen ? [{ ...DEFAULT_INTERVAL }] : []));
   };
 
-  const handleTimeChange = (dayId, field, value) => {
-    setHours(hours.map(h => 
-      h.day_of_week === dayId ? { ...h, [field]: value } : h
-    ));
+  const handleTimeChange = (dayId, index, field, value) => {
+    updateDay(dayId, h => withIntervals(h, dayIntervals(h).map((interval, i) =>
+      i === index ? { ...interval, [field]: value } : interval
+    )));
+  };
+
+  const handleAddInterval = (dayId) => {
+    // La franja nueva arranca una hora después del cierre de la última (horario cortado)
+    updateDay(dayId, h => {
+      const intervals = dayIntervals(h);
+      const start = toMinutes(intervals[intervals.length - 1].close_time) + 60;
+      return withIntervals(h, [...intervals, { open_time: toTime(start), close_time: toTime(start + 240) }]);
+    });
+  };
+
+  const handleRemoveInterval = (dayId, index) => {
+    updateDay(dayId, h => withIntervals(h, dayIntervals(h).filter((_, i) => i !== index)));
   };
 
   const handleSave = async () => {
     try {
-      await api.put('/business-hours', hours);
+      await api.put('/business-hours', hours.map(h => withIntervals(h, h.is_open ? dayIntervals(h) : [])));
       toast.success('Horarios actualizados');
     } catch (error) {
-      toast.error('Error al actualizar horarios');
+      toast.error(error.response?.data?.detail || 'Error al actualizar horarios');
     }
   };
 
@@ -153,28 +191,53 @@ const BusinessHours = () => {
                     </div>
                     
                     {dayHours.is_open && (
-                      <div className="flex flex-col sm:flex-row sm:items-center gap-3 mt-3 pt-3 border-t border-zinc-200">
-                        <div className="flex items-center gap-2">
-                          <Label className="text-sm text-zinc-600 w-16 sm:w-20">Apertura:</Label>
-                          <Input
-                            type="time"
-                            value={dayHours.open_time || '09:00'}
-                            onChange={(e) => handleTimeChange(day.id, 'open_time', e.target.value)}
-                            data-testid={`open-time-${day.id}`}
-                            className="w-28 sm:w-32 focus:ring-[#FFD60A] focus:border-[#FFD60A]"
-                          />
-                        </div>
-                        <span className="hidden sm:inline text-zinc-400">—</span>
-                        <div className="flex items-center gap-2">
-                          <Label className="text-sm text-zinc-600 w-16 sm:w-20">Cierre:</Label>
-                          <Input
-                            type="time"
-                            value={dayHours.close_time || '18:00'}
-                            onChange={(e) => handleTimeChange(day.id, 'close_time', e.target.value)}
-                            data-testid={`close-time-${day.id}`}
-                            className="w-28 sm:w-32 focus:ring-[#FFD60A] focus:border-[#FFD60A]"
-                          />
-                        </div>
+                      <div className="mt-3 pt-3 border-t border-zinc-200 space-y-2">
+                        {dayIntervals(dayHours).map((interval, index, intervals) => (
+                          <div
+                            key={index}
+                            className="flex flex-col sm:flex-row sm:items-center gap-3"
+                            data-testid={`interval-${day.id}-${index}`}
+                          >
+                            <div className="flex items-center gap-2">
+                              <Label className="text-sm text-zinc-600 w-16 sm:w-20">Apertura:</Label>
+                              <Input
+                                type="time"
+                                value={interval.open_time}
+                                onChange={(e) => handleTimeChange(day.id, index, 'open_time', e.target.value)}
+                                data-testid={`open-time-${day.id}-${index}`}
+                                className="w-28 sm:w-32 focus:ring-[#FFD60A] focus:border-[#FFD60A]"
+                              />
+                            </div>
+                            <span className="hidden sm:inline text-zinc-400">—</span>
+                            <div className="flex items-center gap-2">
+                              <Label className="text-sm text-zinc-600 w-16 sm:w-20">Cierre:</Label>
+                              <Input
+                                type="time"
+                                value={interval.close_time}
+                                onChange={(e) => handleTimeChange(day.id, index, 'close_time', e.target.value)}
+                                data-testid={`close-time-${day.id}-${index}`}
+                                className="w-28 sm:w-32 focus:ring-[#FFD60A] focus:border-[#FFD60A]"
+                              />
+                            </div>
+                            {intervals.length > 1 && (
+                              <button
+                                onClick={() => handleRemoveInterval(day.id, index)}
+                                className="text-red-600 hover:text-red-700 p-1"
+                                data-testid={`remove-interval-${day.id}-${index}`}
+                              >
+                                <Trash2 size={16} />
+                              </button>
+                            )}
+                          </div>
+                        ))}
+                        <button
+                          onClick={() => handleAddInterval(day.id)}
+                          className="flex items-center gap-1 text-sm font-semibold text-zinc-700 hover:text-black"
+                          data-testid={`add-interval-${day.id}`}
+                        >
+                          <Plus size={14} />
+                          Agregar franja
+                        </button>
                       </div>
                     )}
                   </div>
@@ -228,7 +291,7 @@ const BusinessHours = () => {
                 ) : (
                   closedDates.map((item) => (
                     <div
-                      key={item.date}
+                      key={item.closure_id || item.date}
                       className="flex justify-between items-center p-3 bg-red-50 border border-red-200 rounded-lg"
                     >
                       <span className="text-sm font-medium">
@@ -238,9 +301,11 @@ const BusinessHours = () => {
                           month: 'long', 
                           day: 'numeric' 
                         })}
+                        {item.end_date && item.end_date !== item.date && ` al ${new Date(item.end_date + 'T00:00:00').toLocaleDateString('es-AR')}`}
+                        {item.start_time && ` (${item.start_time} a ${item.end_time})`}
                       </span>
                       <button
-                        onClick={() => handleRemoveClosedDate(item.date)}
+                        onClick={() => handleRemoveClosedDate(item.closure_id || item.date)}
                         className="text-red-600 hover:text-red-700 p-1"
                       >
                         <Trash2 size={16} />
@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { useParams } from 'react-router-dom';
 import { toast } from 'sonner';
 import { Calendar as CalendarIcon, Clock, DollarSign, CheckCircle2 } from 'lucide-react';
@@ -10,13 +10,47 @@ import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '.
 import axios from 'axios';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
+// Espera aleatoria antes de reconsultar, para que las páginas abiertas no lo hagan a la vez
+const REFETCH_JITTER_MS = 3000;
+
+const toMinutes = (value) => {
+  const [hours, minutes] = value.split(':').map(Number);
+  return hours * 60 + minutes;
+};
+
+// Quita los horarios que un turno nuevo bloquea, con las mismas reglas que el backend:
+// sin recursos el turno bloquea el horario; con recursos solo ocupa el suyo (o todos si no tiene)
+const applyBooking = (slotState, event) => {
+  const { duration, buffer_minutes: buffer, resources } = slotState;
+  const start = toMinutes(event.start);
+  const end = toMinutes(event.end);
+  const blocks = (slot) => {
+    const slotStart = toMinutes(slot);
+    return slotStart < end + buffer && start - buffer < slotStart + duration;
+  };
+  if (!resources) {
+    return { ...slotState, slots: slotState.slots.filter((slot) => !blocks(slot)) };
+  }
+  const nextResources = {};
+  slotState.slots.forEach((slot) => {
+    const free = blocks(slot)
+      ? (event.resource_id ? resources[slot].filter((id) => id !== event.resource_id) : [])
+      : resources[slot];
+    if (free.length) {
+      nextResources[slot] = free;
+    }
+  });
+  return { ...slotState, resources: nextResources, slots: Object.keys(nextResources) };
+};
 
 const PublicBooking = () => {
   const { userId } = useParams();
   const [businessInfo, setBusinessInfo] = useState(null);
   const [selectedService, setSelectedService] = useState(null);
   const [selectedDate, setSelectedDate] = useState('');
-  const [availableSlots, setAvailableSlots] = useState([]);
+  const [slotState, setSlotState] = useState({ slots: [] });
+  const availableSlots = slotState.slots;
+  const refetchTimer = useRef(null);
   const [selectedTime, setSelectedTime] = useState('');
   const [clientName, setClientName] = useState('');
   const [clientPhone, setClientPhone] = useState('');
@@ -34,6 +68,40 @@ const PublicBooking = () => {
     }
   }, [selectedService, selectedDate]);
 
+  // Recibir cambios de disponibilidad en vivo en lugar de volver a consultar
+  useEffect(() => {
+    if (!selectedService || !selectedDate || typeof EventSource === 'undefined') {
+      return undefined;
+    }
+    const source = new EventSource(
+      `${BACKEND_URL}/api/public/${userId}/slots/stream?date=${encodeURIComponent(selectedDate)}`
+    );
+    source.onmessage = (message) => {
+      const event = JSON.parse(message.data);
+      if (event.type === 'booked' && event.start) {
+        setSlotState((current) => {
+          const next = applyBooking(current, event);
+          setSelectedTime((selected) => (next.slots.includes(selected) ? selected : ''));
+          return next;
+        });
+        return;
+      }
+      // Un horario liberado puede seguir bloqueado por otras reglas (cierres, anticipación,
+      // otros turnos), así que solo el backend puede recalcularlo
+      if (!refetchTimer.current) {
+        refetchTimer.current = setTimeout(() => {
+          refetchTimer.current = null;
+          loadAvailableSlots(true);
+        }, Math.random() * REFETCH_JITTER_MS);
+      }
+    };
+    return () => {
+      source.close();
+      clearTimeout(refetchTimer.current);
+      refetchTimer.current = null;
+    };
+  }, [userId, selectedService, selectedDate]);
+
   const loadBusinessInfo = async () => {
     try {
       const response = await axios.get(`${BACKEND_URL}/api/public/${userId}/info`);
@@ -49,7 +117,7 @@ const PublicBooking = () => {
     }
   };
 
-  const loadAvailableSlots = async () => {
+  const loadAvailableSlots = async (keepSelection = false) => {
     try {
       const response = await axios.get(`${BACKEND_URL}/api/public/${userId}/available-slots`, {
         params: {
@@ -57,8 +125,12 @@ const PublicBooking = () => {
           date: selectedDate,
         },
       });
-      setAvailableSlots(response.data.slots);
-      setSelectedTime('');
+      setSlotState(response.data);
+      if (keepSelection) {
+        setSelectedTime((current) => (response.data.slots.includes(current) ? current : ''));
+      } else {
+        setSelectedTime('');
+      }
     } catch (error) {
       toast.error('Error al cargar horarios disponibles');
     }
@@ -0,0 +1,12 @@
+# Las pruebas importan los módulos de backend/ igual que uvicorn al correr desde esa carpeta
+import os
+import sys
+
+from tests.support import BACKEND_DIR
+
+sys.path.insert(0, str(BACKEND_DIR))
+
+# server.py lee la conexión al importarse. Las pruebas de integración usan TEST_MONGO_URL
+# (un replica set descartable); las demás nunca llegan a conectarse
+os.environ.setdefault("MONGO_URL", os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017"))
+os.environ.setdefault("DB_NAME", "turnitos_test")
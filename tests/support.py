@@ -0,0 +1,55 @@
+# Utilidades compartidas por las pruebas
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+requires_mongo = pytest.mark.skipif(
+    not os.environ.get("TEST_MONGO_URL"), reason="requiere MongoDB con replica set en TEST_MONGO_URL"
+)
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def seed_tenant(server, open_days=range(7)) -> dict:
+    # Negocio en prueba con un servicio de 30 minutos y atención de 09:00 a 18:00.
+    # Detecta el replica set para que las reservas usen transacciones como en producción
+    await server.detect_mongo_features()
+    user_id = str(uuid.uuid4())
+    user = {
+        "user_id": user_id,
+        "email": f"{user_id}@example.com",
+        "business_name": "Negocio de prueba",
+        "trial_ends": (datetime.now(timezone.utc) + timedelta(days=7)).isoformat(),
+        "subscription_active": False,
+        "subscription_ends": None,
+        "access_until": datetime.now(timezone.utc) + timedelta(days=7),
+        "token_version": 0,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    await server.db.users.insert_one(dict(user))
+    await server.db.business_hours.insert_many([
+        {"user_id": user_id, "day_of_week": day, "is_open": day in open_days, "open_time": "09:00",
+         "close_time": "18:00", "intervals": [{"open_time": "09:00", "close_time": "18:00"}]}
+        for day in range(7)
+    ])
+    service = {"service_id": str(uuid.uuid4()), "user_id": user_id, "name": "Corte",
+               "duration_minutes": 30, "price": 100, "active": True}
+    await server.db.services.insert_one(dict(service))
+    return {"user": user, "service": service}
+
+async def drop_tenant(server, user_id: str):
+    for name in ("users", "business_hours", "business_hours_overrides", "services", "resources", "appointments",
+                 "appointments_archive", "appointment_series", "booking_locks", "clients",
+                 "closed_dates", "daily_stats", "waitlist"):
+        await server.db[name].delete_many({"user_id": user_id})
+    # Los mensajes del outbox no guardan el negocio; todos los destinatarios de prueba son de example.com
+    await server.db.outbox.delete_many({"recipient": {"$regex": r"@example\.com$"}})
+    client = server._lazy_clients.pop("mongo", None)
+    if client:
+        client.close()
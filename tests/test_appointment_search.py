@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from tests.support import drop_tenant, requires_mongo, run, seed_tenant
+
+pytest.importorskip("fastapi")
+
+import server  # noqa: E402
+
+@requires_mongo
+def test_search_pages_across_active_and_archived_appointments():
+    async def scenario():
+        tenant = await seed_tenant(server)
+        user, service_id = tenant["user"], tenant["service"]["service_id"]
+        try:
+            today = datetime.now(timezone.utc)
+            dates = [(today + timedelta(days=offset)).strftime("%Y-%m-%d") for offset in (5, -40, -80)]
+            docs = [
+                {"appointment_id": f"turno-{i}", "user_id": user["user_id"], "service_id": service_id,
+                 "client_name": "Ana Gómez", "client_phone": "1100000000", "client_email": "ana@example.com",
+                 "client_search": server.client_search_terms("Ana Gómez", "1100000000", "ana@example.com"),
+                 "date": date, "time": "10:00", "status": "completed"}
+                for i, date in enumerate(dates)
+            ]
+            await server.db.appointments.insert_one(docs[0])
+            await server.db.appointments_archive.insert_many(docs[1:])
+
+            first = await server.search_appointments("ana", skip=0, limit=2, current_user=user)
+            second = await server.search_appointments("ana", skip=2, limit=2, current_user=user)
+            assert [a["date"] for a in first["results"]] == dates[:2]
+            assert first["has_more"] is True
+            assert [a["date"] for a in second["results"]] == dates[2:]
+            assert second["has_more"] is False
+            assert [a.get("archived", False) for a in first["results"] + second["results"]] == [False, True, True]
+
+            active_only = await server.search_appointments("ana", limit=5, include_archived=False, current_user=user)
+            assert [a["date"] for a in active_only["results"]] == dates[:1]
+        finally:
+            await drop_tenant(server, user["user_id"])
+
+    run(scenario())
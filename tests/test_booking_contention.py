@@ -0,0 +1,87 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from tests.support import drop_tenant, requires_mongo, run, seed_tenant
+
+# Reservas simultáneas del mismo día (todas compiten por el mismo candado) y el piso
+# de reservas confirmadas por segundo; ajustable para máquinas de CI más lentas
+CONTENTION_BOOKINGS = 18
+MIN_BOOKINGS_PER_SECOND = float(os.environ.get("CONTENTION_MIN_BOOKINGS_PER_SECOND", "5"))
+
+def booking_request(server, service_id: str, date: str, time_str: str, name: str):
+    return server.AppointmentCreate(
+        service_id=service_id, client_name=name, client_phone="1100000000",
+        client_email=f"{name.lower()}@example.com", date=date, time=time_str
+    )
+
+@requires_mongo
+def test_admin_and_public_booking_cannot_take_the_same_slot():
+    # Una reserva del dueño y una pública para el mismo horario compiten por el
+    # candado del día: exactamente una se confirma y la otra ve el horario ocupado
+    import server
+    from fastapi import HTTPException
+
+    async def scenario():
+        tenant = await seed_tenant(server)
+        user_id = tenant["user"]["user_id"]
+        service_id = tenant["service"]["service_id"]
+        try:
+            date = (datetime.now(timezone.utc) + timedelta(days=3)).strftime("%Y-%m-%d")
+            results = await asyncio.gather(
+                server.create_appointment_admin(
+                    booking_request(server, service_id, date, "10:00", "Owner"), current_user=tenant["user"]
+                ),
+                server.create_public_appointment(user_id, booking_request(server, service_id, date, "10:00", "Client")),
+                return_exceptions=True
+            )
+            failures = [r for r in results if isinstance(r, Exception)]
+            assert len(failures) == 1, results
+            assert isinstance(failures[0], HTTPException) and failures[0].status_code == 400
+            booked = await server.db.appointments.count_documents(
+                {"user_id": user_id, "date": date, "time": "10:00", "status": {"$in": list(server.ACTIVE_STATUSES)}}
+            )
+            assert booked == 1
+        finally:
+            await drop_tenant(server, user_id)
+
+    run(scenario())
+
+@requires_mongo
+def test_booking_throughput_under_day_lock_contention():
+    # Reservas públicas de horarios distintos del mismo día: no se pisan, pero cada
+    # transacción escribe el mismo candado y los conflictos se resuelven con reintentos
+    import server
+
+    async def scenario():
+        tenant = await seed_tenant(server)
+        user_id = tenant["user"]["user_id"]
+        service_id = tenant["service"]["service_id"]
+        assert server.mongo_features["transactions"], "TEST_MONGO_URL debe apuntar a un replica set"
+        try:
+            date = (datetime.now(timezone.utc) + timedelta(days=4)).strftime("%Y-%m-%d")
+            slots = [server.minutes_to_time(540 + 30 * i) for i in range(CONTENTION_BOOKINGS)]
+            started = time.perf_counter()
+            results = await asyncio.gather(*[
+                server.create_public_appointment(
+                    user_id, booking_request(server, service_id, date, slot, f"Client{i}")
+                )
+                for i, slot in enumerate(slots)
+            ], return_exceptions=True)
+            elapsed = time.perf_counter() - started
+
+            assert [r for r in results if isinstance(r, Exception)] == []
+            booked = await server.db.appointments.count_documents(
+                {"user_id": user_id, "date": date, "status": {"$in": list(server.ACTIVE_STATUSES)}}
+            )
+            assert booked == CONTENTION_BOOKINGS
+            throughput = CONTENTION_BOOKINGS / elapsed
+            print(f"{CONTENTION_BOOKINGS} reservas en {elapsed:.2f} s ({throughput:.1f} reservas/s)")
+            assert throughput >= MIN_BOOKINGS_PER_SECOND, (
+                f"{throughput:.1f} reservas/s, mínimo {MIN_BOOKINGS_PER_SECOND:.1f}"
+            )
+        finally:
+            await drop_tenant(server, user_id)
+
+    run(scenario())
@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from tests.support import drop_tenant, requires_mongo, run, seed_tenant
+
+pytest.importorskip("fastapi")
+
+import server  # noqa: E402
+
+@requires_mongo
+def test_bulk_cancel_includes_series_occurrences_in_range():
+    async def scenario():
+        tenant = await seed_tenant(server)
+        user, service_id = tenant["user"], tenant["service"]["service_id"]
+        try:
+            first = datetime.now(timezone.utc) + timedelta(days=2)
+            dates = [(first + timedelta(days=offset)).strftime("%Y-%m-%d") for offset in (0, 1, 7, 14)]
+            series = await server.create_appointment_series(server.SeriesCreate(
+                service_id=service_id, client_name="Serie", client_phone="1100000001",
+                client_email="serie@example.com", start_date=dates[0], time="10:00"
+            ), current_user=user)
+            await server.create_appointment_admin(server.AppointmentCreate(
+                service_id=service_id, client_name="Cliente", client_phone="1100000000",
+                client_email="cliente@example.com", date=dates[1], time="11:00"
+            ), current_user=user)
+
+            # El rango toma dos fechas de la serie y el turno suelto; la tercera fecha queda
+            result = await server.bulk_cancel_appointments(
+                server.BulkCancelRequest(start_date=dates[0], end_date=dates[2]), current_user=user
+            )
+            assert result["cancelled"] == 3
+            busy = await server.get_busy_intervals(user["user_id"], dates)
+            assert [len(busy[d]) for d in dates] == [0, 0, 0, 1]
+            stored = await server.db.appointment_series.find_one(
+                {"user_id": user["user_id"], "series_id": series["series_id"]}, {"_id": 0}
+            )
+            assert sorted(stored["exceptions"]) == [dates[0], dates[2]]
+        finally:
+            await drop_tenant(server, user["user_id"])
+
+    run(scenario())
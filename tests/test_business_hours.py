@@ -0,0 +1,55 @@
+import pytest
+
+from tests.support import drop_tenant, requires_mongo, run, seed_tenant
+
+pytest.importorskip("fastapi")
+
+import server  # noqa: E402
+
+def stored_day(day_of_week: int, is_open: bool, intervals) -> dict:
+    # Documento tal como lo devuelve GET /business-hours y la página lo reenvía en el PUT
+    return {
+        "user_id": "u1", "day_of_week": day_of_week, "is_open": is_open,
+        "open_time": intervals[0]["open_time"] if intervals else None,
+        "close_time": intervals[-1]["close_time"] if intervals else None,
+        "intervals": intervals
+    }
+
+def normalize(payload: dict) -> dict:
+    hours = server.BusinessHoursUpdate(**payload)
+    return server.normalize_hours(hours.is_open, hours.open_time, hours.close_time, hours.intervals)
+
+def test_reopening_a_closed_day_uses_open_and_close_time():
+    payload = {**stored_day(5, False, []), "is_open": True, "open_time": "09:00", "close_time": "13:00"}
+    assert normalize(payload)["intervals"] == [{"open_time": "09:00", "close_time": "13:00"}]
+
+def test_edited_open_and_close_time_move_the_outer_intervals():
+    split = [{"open_time": "09:00", "close_time": "13:00"}, {"open_time": "15:00", "close_time": "19:00"}]
+    payload = {**stored_day(0, True, split), "open_time": "10:00", "close_time": "20:00"}
+    assert normalize(payload)["intervals"] == [
+        {"open_time": "10:00", "close_time": "13:00"}, {"open_time": "15:00", "close_time": "20:00"}
+    ]
+    assert normalize(stored_day(0, True, split))["intervals"] == split
+
+@requires_mongo
+def test_put_replays_the_business_hours_page_payload():
+    async def scenario():
+        tenant = await seed_tenant(server, open_days=range(5))
+        user = tenant["user"]
+        try:
+            loaded = await server.get_business_hours(current_user=user)
+            # Lunes: se edita solo la apertura; sábado: se reabre un día cerrado
+            monday = {**loaded[0], "open_time": "10:00"}
+            saturday = {**loaded[5], "is_open": True, "open_time": "09:00", "close_time": "13:00"}
+            payload = [monday, *loaded[1:5], saturday, loaded[6]]
+            await server.update_business_hours(
+                [server.BusinessHoursUpdate(**day) for day in payload], current_user=user
+            )
+            saved = await server.get_business_hours(current_user=user)
+            assert saved[0]["intervals"] == [{"open_time": "10:00", "close_time": "18:00"}]
+            assert saved[5]["is_open"] and saved[5]["intervals"] == [{"open_time": "09:00", "close_time": "13:00"}]
+            assert not saved[6]["is_open"]
+        finally:
+            await drop_tenant(server, user["user_id"])
+
+    run(scenario())
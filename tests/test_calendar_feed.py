@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from tests.support import drop_tenant, requires_mongo, run, seed_tenant
+
+pytest.importorskip("fastapi")
+
+import server  # noqa: E402
+
+def feed_events(body: str) -> str:
+    # DTSTAMP es la hora de generación y cambia entre dos armados del mismo feed
+    return "\r\n".join(line for line in body.split("\r\n") if not line.startswith("DTSTAMP:"))
+
+@requires_mongo
+def test_incremental_feed_matches_a_cold_build():
+    async def scenario():
+        tenant = await seed_tenant(server)
+        user, service = tenant["user"], tenant["service"]
+        user_id = user["user_id"]
+        try:
+            date = (datetime.now(timezone.utc) + timedelta(days=2)).strftime("%Y-%m-%d")
+            await server.db.appointments.insert_many([
+                {"appointment_id": f"turno-{i}", "user_id": user_id, "service_id": service["service_id"],
+                 "service_name": "Corte", "service_duration": 30, "client_name": f"Cliente {i}",
+                 "client_phone": "1100000000", "date": date, "time": f"1{i}:00", "status": status,
+                 "updated_at": datetime.now(timezone.utc)}
+                for i, status in enumerate(["confirmed", "pending", "confirmed", "completed"])
+            ])
+            user = {**user, "appointments_version": 1}
+            await server.get_calendar_feed(user)
+
+            # Un turno se atiende, otro se marca ausente y otro se cancela después del primer armado
+            for appointment_id, status in (("turno-0", "completed"), ("turno-1", "no_show"), ("turno-2", "cancelled")):
+                await server.db.appointments.update_one(
+                    {"user_id": user_id, "appointment_id": appointment_id},
+                    {"$set": {"status": status, "updated_at": datetime.now(timezone.utc)}}
+                )
+            user = {**user, "appointments_version": 2}
+            incremental = await server.get_calendar_feed(user)
+            server.calendar_feed_cache.pop(user_id)
+            cold = await server.get_calendar_feed(user)
+
+            assert feed_events(incremental) == feed_events(cold)
+            assert [f"turno-{i}@turnitos" in cold for i in range(4)] == [True, True, False, True]
+        finally:
+            server.calendar_feed_cache.pop(user_id, None)
+            await drop_tenant(server, user_id)
+
+    run(scenario())
@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from tests.support import BACKEND_DIR
+
+# Presupuesto de import de server.py (milisegundos); un worker nuevo debe quedar listo
+# bastante antes del segundo. Ajustable para máquinas de CI más lentas
+IMPORT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", "800"))
+
+def import_server(code: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=BACKEND_DIR, env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+        capture_output=True, text=True, timeout=60
+    )
+
+def cumulative_ms(importtime_output: str, module: str) -> float:
+    # Formato de -X importtime: "import time: self [us] | cumulative | imported package"
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name.strip() == module:
+            return int(cumulative) / 1000
+    raise AssertionError(f"{module} no aparece en la salida de -X importtime")
+
+def test_server_import_stays_within_budget():
+    pytest.importorskip("fastapi")
+    pytest.importorskip("motor")
+    # Se toma la segunda corrida para no medir la compilación a bytecode de la primera
+    import_server("import server")
+    result = import_server("import server")
+    assert result.returncode == 0, result.stderr
+    elapsed = cumulative_ms(result.stderr, "server")
+    assert elapsed < IMPORT_BUDGET_MS, f"importar server tomó {elapsed:.0f} ms (presupuesto {IMPORT_BUDGET_MS:.0f} ms)"
+
+def test_server_import_has_no_side_effects():
+    pytest.importorskip("fastapi")
+    pytest.importorskip("motor")
+    # Ni conexiones ni threads ni handlers de logging hasta el startup del worker
+    result = import_server(
+        "import logging, threading, server;"
+        "assert not server._lazy_clients, server._lazy_clients;"
+        "assert threading.active_count() == 1, threading.enumerate();"
+        "assert not any(type(h).__name__ == 'QueueHandler' for h in logging.getLogger().handlers)"
+    )
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,82 @@
+import gc
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+import pytest
+
+from log_pipeline import JsonFormatter, configure_logging
+
+# Costo máximo por log en el thread que lo emite (microsegundos); ajustable para CI lentos
+LOG_EMIT_BUDGET_US = float(os.environ.get("LOG_EMIT_BUDGET_US", "50"))
+
+class SlowStream(io.StringIO):
+    # Simula una salida con I/O lento (pipe lleno, disco, colector remoto)
+    def write(self, text):
+        time.sleep(0.0002)
+        return super().write(text)
+
+@pytest.fixture
+def restore_logging():
+    root = logging.getLogger()
+    saved = (root.handlers[:], root.level)
+    yield
+    root.handlers, root.level = saved[0], saved[1]
+
+def test_listener_formats_records_and_keeps_tracebacks(restore_logging):
+    threads = []
+
+    class RecordingFormatter(JsonFormatter):
+        def format(self, record):
+            threads.append(threading.current_thread().name)
+            return super().format(record)
+
+    stream = io.StringIO()
+    listener = configure_logging(stream=stream)
+    listener.handlers[0].setFormatter(RecordingFormatter())
+    try:
+        raise ValueError("falló")
+    except ValueError:
+        logging.getLogger("turnitos.test").exception("Error procesando %s", "pago")
+    listener.stop()
+
+    entry = json.loads(stream.getvalue())
+    assert entry["message"] == "Error procesando pago"
+    assert "ValueError: falló" in entry["exc_info"]
+    assert threads and threading.main_thread().name not in threads
+
+def test_queued_logging_overhead_on_the_emitting_thread(restore_logging):
+    logger = logging.getLogger("turnitos.test")
+    count = 500
+
+    def emit_cost_us() -> float:
+        # Sin el recolector de basura, como timeit: una pasada completa del GC sobre el heap
+        # de toda la suite cae en cualquiera de las dos mediciones y no es costo del logging
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.perf_counter()
+            for i in range(count):
+                logger.info("Pago recibido %s", {"id": i, "status": "approved"}, extra={"payment_id": i})
+            return (time.perf_counter() - started) / count * 1e6
+        finally:
+            gc.enable()
+
+    # Referencia: un handler sincrónico que formatea y escribe en el mismo thread
+    sync_handler = logging.StreamHandler(SlowStream())
+    sync_handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers = [sync_handler]
+    root.setLevel(logging.INFO)
+    sync_us = emit_cost_us()
+
+    listener = configure_logging(stream=SlowStream())
+    queued_us = emit_cost_us()
+    listener.stop()
+
+    print(f"log sincrónico {sync_us:.1f} us/registro, encolado {queued_us:.1f} us/registro")
+    assert queued_us < LOG_EMIT_BUDGET_US
+    assert queued_us < sync_us
@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip("pymongo")
+
+from profiling import profile_hot_spots, profiler_active, start_profiler
+
+def test_only_one_profiler_per_worker():
+    first = start_profiler()
+    try:
+        assert first is not None and profiler_active()
+        # Un segundo pedido con cupo no enciende otro profiler sobre el mismo thread
+        assert start_profiler() is None
+    finally:
+        report = profile_hot_spots(first)
+    assert "function calls" in report
+    assert not profiler_active()
+    second = start_profiler()
+    assert second is not None
+    profile_hot_spots(second)
+
+def test_slow_operations_are_logged_as_structured_fields():
+    import io
+    import json
+    import logging
+
+    from log_pipeline import JsonFormatter
+    from profiling import log_slow_operation, slow_log
+
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter())
+    slow_log.addHandler(handler)
+    try:
+        log_slow_operation("db", command="find", collection="appointments", duration_ms=312.5, failed=False)
+    finally:
+        slow_log.removeHandler(handler)
+    entry = json.loads(stream.getvalue())
+    assert entry["type"] == "db" and entry["collection"] == "appointments" and entry["duration_ms"] == 312.5
+    assert entry["message"] == "Operación lenta: db"
@@ -0,0 +1,117 @@
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from scheduling import (
+    available_starts, build_slot_grid, expand_series, filter_grid, find_conflicts, free_resources_by_start,
+    local_weekday_time_ranges, resource_intervals
+)
+
+def test_available_starts_skips_busy_and_buffer():
+    grid = build_slot_grid([(540, 720)], 30, 30)
+    busy = [(600, 630, "a1", None)]
+    # El buffer de 10 minutos deja ocupado también el turno que termina a las 10:00
+    assert available_starts(grid, 30, busy, [], buffer=10) == [540, 660, 690]
+    assert available_starts(grid, 30, busy, [], not_before=660) == [660, 690]
+
+def test_available_starts_with_resources_needs_one_free_resource():
+    grid = build_slot_grid([(540, 660)], 60, 60)
+    busy = [(540, 600, "a1", "r1"), (600, 660, "a2", "r1"), (600, 660, "a3", "r2")]
+    assert available_starts(grid, 60, busy, ["r1", "r2"]) == [540]
+    # Un turno sin recurso ocupa todos
+    assert available_starts(grid, 60, busy + [(540, 600, "a4", None)], ["r1", "r2"]) == []
+
+def test_resource_sweep_matches_filtering_each_resource():
+    # El barrido conjunto da lo mismo que filtrar la grilla recurso por recurso
+    rng = random.Random(3)
+    for _ in range(500):
+        resources = [f"r{i}" for i in range(rng.randrange(1, 5))]
+        busy = []
+        for i in range(rng.randrange(15)):
+            start = rng.randrange(420, 1290, 5)
+            busy.append((start, start + rng.choice((0, 15, 30, 60)), f"a{i}", rng.choice(resources + [None, "otro"])))
+        duration, buffer, not_before = rng.choice((15, 30, 60)), rng.choice((0, 10)), rng.choice((0, 600))
+        grid = build_slot_grid([(480, 780), (840, 1260)], duration, 15)
+        expected = {}
+        for resource_id in resources:
+            for start in filter_grid(grid, duration, resource_intervals(busy, resource_id), buffer, not_before):
+                expected.setdefault(start, []).append(resource_id)
+        assert free_resources_by_start(grid, duration, busy, resources, buffer, not_before) == dict(sorted(expected.items()))
+        assert available_starts(grid, duration, busy, resources, buffer, not_before) == sorted(expected)
+
+def test_find_conflicts_by_resource():
+    intervals = [
+        (540, 600, "a1", "r1"),
+        (570, 630, "a2", "r2"),
+        (580, 640, "a3", "r1"),
+        (700, 730, "a4", None),
+        (710, 720, "a5", "r2"),
+    ]
+    assert find_conflicts(intervals) == [("a1", "a3"), ("a4", "a5")]
+    assert find_conflicts([(540, 600, "a1", None), (600, 660, "a2", None)]) == []
+
+def test_expand_series_respects_window_interval_and_exceptions():
+    series = {"start_date": "2026-01-05", "interval_weeks": 2, "until": "2026-03-02",
+              "exceptions": ["2026-02-02"]}
+    assert expand_series(series, "2026-01-10", "2026-12-31") == ["2026-01-19", "2026-02-16", "2026-03-02"]
+    assert expand_series(series, "2025-01-01", "2026-01-05") == ["2026-01-05"]
+    assert expand_series({"start_date": "2026-01-05"}, "2026-01-06", "2026-01-11") == []
+
+def test_in_memory_repository_busy_intervals():
+    pytest.importorskip("pymongo")
+    from repository import InMemorySchedulingRepository
+
+    repo = InMemorySchedulingRepository(
+        appointments=[
+            {"appointment_id": "a1", "user_id": "u1", "service_id": "s1", "date": "2026-01-05",
+             "time": "10:00", "status": "confirmed"},
+            {"appointment_id": "a2", "user_id": "u1", "service_id": "s1", "date": "2026-01-05",
+             "time": "11:00", "status": "cancelled"},
+            {"appointment_id": "a3", "user_id": "u2", "service_id": "s1", "date": "2026-01-05",
+             "time": "12:00", "status": "pending"},
+        ],
+        services=[{"service_id": "s1", "user_id": "u1", "duration_minutes": 45}],
+        series=[{"series_id": "se1", "user_id": "u1", "active": True, "start_date": "2025-12-29",
+                 "weekday": 0, "until": None, "time": "15:00", "service_duration": 30, "resource_id": "r1"}]
+    )
+    busy = asyncio.run(repo.find_busy_intervals("u1", ["2026-01-05", "2026-01-06"]))
+    assert busy == {
+        "2026-01-05": [(600, 645, "a1", None), (900, 930, "se1:2026-01-05", "r1")],
+        "2026-01-06": []
+    }
+
+def test_in_memory_repository_lock_booking_window():
+    pytest.importorskip("pymongo")
+    from repository import InMemorySchedulingRepository, SchedulingRepository
+
+    # La base es abstracta: una implementación incompleta no se puede instanciar
+    with pytest.raises(TypeError):
+        SchedulingRepository()
+
+    repo = InMemorySchedulingRepository(
+        resources=[{"resource_id": "r1", "user_id": "u1", "active": True},
+                   {"resource_id": "r2", "user_id": "u1", "active": False}]
+    )
+    appointment = {"appointment_id": "a1", "user_id": "u1", "service_id": "s1", "service_duration": 30,
+                   "resource_id": "r1", "date": "2026-01-05", "time": "10:00", "status": "confirmed"}
+    asyncio.run(repo.insert_appointment(appointment))
+    busy, resource_ids = asyncio.run(repo.lock_booking_window("u1", ["2026-01-05", "2026-01-05"], ["r1", "r2"]))
+    assert busy == {"2026-01-05": [(600, 630, "a1", "r1")]}
+    assert resource_ids == ["r1"]
+    assert repo.booking_locks == {("u1", "2026-01-05"): 1}
+    assert asyncio.run(repo.lock_booking_window("u1", ["2026-01-06"], None)) == ({"2026-01-06": []}, [])
+
+def test_local_weekday_time_ranges_cover_every_timezone():
+    now = datetime(2026, 3, 6, 22, 17, tzinfo=timezone.utc)
+    end = now + timedelta(hours=24)
+    ranges = local_weekday_time_ranges(now, end)
+    assert ranges[0] == (4, "10:17", "23:59") and ranges[-1] == (6, "00:00", "12:17")
+    # Cualquier instante de la ventana, visto desde cualquier huso, cae en algún rango
+    for zone in ("America/Argentina/Buenos_Aires", "Pacific/Kiritimati", "Etc/GMT+12", "Asia/Kolkata"):
+        for minutes in range(0, 24 * 60 + 1, 37):
+            local = (now + timedelta(minutes=minutes)).astimezone(ZoneInfo(zone))
+            assert any(weekday == local.weekday() and since <= local.strftime("%H:%M") <= until
+                       for weekday, since, until in ranges), (zone, local)
@@ -0,0 +1,52 @@
+# Benchmarks de los algoritmos de agenda: pytest tests/test_scheduling_benchmarks.py --benchmark-only
+import asyncio
+import random
+
+import pytest
+
+from scheduling import available_starts, build_slot_grid, expand_series, find_conflicts
+
+pytest.importorskip("pytest_benchmark")
+
+RESOURCES = [f"r{i}" for i in range(4)]
+
+def busy_day(count: int, seed: int = 7):
+    rng = random.Random(seed)
+    intervals = []
+    for i in range(count):
+        start = rng.randrange(480, 1200, 15)
+        intervals.append((start, start + rng.choice((15, 30, 45, 60)), f"a{i}", rng.choice(RESOURCES + [None])))
+    return intervals
+
+def test_bench_available_starts(benchmark):
+    grid = build_slot_grid([(480, 780), (840, 1260)], 30, 15)
+    busy = busy_day(60)
+    benchmark(available_starts, grid, 30, busy, RESOURCES, 5)
+
+def test_bench_find_conflicts(benchmark):
+    benchmark(find_conflicts, busy_day(2000))
+
+def test_bench_expand_series(benchmark):
+    series = {"start_date": "2020-01-06", "interval_weeks": 1, "until": None, "exceptions": ["2026-03-02"]}
+    benchmark(expand_series, series, "2026-01-01", "2027-12-31")
+
+def test_bench_in_memory_busy_intervals(benchmark):
+    pytest.importorskip("pymongo")
+    from repository import InMemorySchedulingRepository
+
+    rng = random.Random(11)
+    dates = [f"2026-03-{day:02d}" for day in range(1, 32)]
+    repo = InMemorySchedulingRepository(
+        appointments=[
+            {"appointment_id": f"a{i}", "user_id": "u1", "service_id": "s1", "date": rng.choice(dates),
+             "time": f"{rng.randrange(8, 20):02d}:{rng.choice((0, 15, 30, 45)):02d}", "service_duration": 30,
+             "status": "confirmed", "resource_id": rng.choice(RESOURCES)}
+            for i in range(5000)
+        ],
+        series=[
+            {"series_id": f"se{i}", "user_id": "u1", "active": True, "start_date": "2025-01-06",
+             "weekday": i % 7, "until": None, "time": "09:00", "service_duration": 45, "resource_id": None}
+            for i in range(50)
+        ]
+    )
+    benchmark(lambda: asyncio.run(repo.find_busy_intervals("u1", dates)))
@@ -0,0 +1,95 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from fastapi import HTTPException  # noqa: E402
+
+import server  # noqa: E402
+from tests.support import drop_tenant, requires_mongo, run, seed_tenant  # noqa: E402
+
+OWNER = {
+    "user_id": "u1", "business_name": "Negocio", "subscription_active": False,
+    "access_until": datetime.now(timezone.utc) + timedelta(days=7)
+}
+
+@pytest.mark.parametrize("start_date, end_date", [
+    ("2026-13-01", "2026-12-31"),
+    ("2026-01-01", "no-es-fecha"),
+    ("2026-02-01", "2026-01-01"),
+    ("1970-01-01", None),
+])
+def test_export_rejects_bad_or_unbounded_windows_before_streaming(start_date, end_date):
+    with pytest.raises(HTTPException) as error:
+        run(server.export_appointments_csv(None, start_date, end_date, False, current_user=OWNER))
+    assert error.value.status_code == 400
+
+def test_series_occurrences_route_rejects_bad_dates():
+    with pytest.raises(HTTPException) as error:
+        run(server.get_series_occurrences("s1", "2026-13-01", "2026-12-31", current_user=OWNER))
+    assert error.value.status_code == 400
+
+def series_request(service_id: str, start_date: str, time_str: str = "10:00"):
+    return server.SeriesCreate(
+        service_id=service_id, client_name="Serie", client_phone="1100000001",
+        client_email="serie@example.com", start_date=start_date, time=time_str
+    )
+
+def next_weekday(weekday: int, after_days: int = 2) -> datetime:
+    day = datetime.now(timezone.utc) + timedelta(days=after_days)
+    return day + timedelta(days=(weekday - day.weekday()) % 7)
+
+@requires_mongo
+def test_series_respects_business_hours_and_closures():
+    async def scenario():
+        tenant = await seed_tenant(server, open_days=range(5))
+        user, service_id = tenant["user"], tenant["service"]["service_id"]
+        try:
+            saturday = next_weekday(5).strftime("%Y-%m-%d")
+            with pytest.raises(HTTPException) as error:
+                await server.create_appointment_series(series_request(service_id, saturday), current_user=user)
+            assert error.value.status_code == 400 and saturday in error.value.detail["dates"]
+
+            monday = next_weekday(0)
+            closed = (monday + timedelta(days=14)).strftime("%Y-%m-%d")
+            await server.create_closed_date(server.ClosedDateCreate(date=closed), current_user=user)
+            user = await server.db.users.find_one({"user_id": user["user_id"]}, {"_id": 0})
+            with pytest.raises(HTTPException) as error:
+                await server.create_appointment_series(
+                    series_request(service_id, monday.strftime("%Y-%m-%d")), current_user=user
+                )
+            assert error.value.detail["dates"] == [closed]
+        finally:
+            await drop_tenant(server, user["user_id"])
+
+    run(scenario())
+
+@requires_mongo
+def test_series_and_single_booking_cannot_double_book():
+    # La reserva suelta cae en la tercera fecha de la serie: comparten el candado de ese día
+    async def scenario():
+        tenant = await seed_tenant(server)
+        user, service_id = tenant["user"], tenant["service"]["service_id"]
+        try:
+            first = datetime.now(timezone.utc) + timedelta(days=2)
+            third = (first + timedelta(days=14)).strftime("%Y-%m-%d")
+            single = server.AppointmentCreate(
+                service_id=service_id, client_name="Cliente", client_phone="1100000000",
+                client_email="cliente@example.com", date=third, time="10:00"
+            )
+            results = await asyncio.gather(
+                server.create_appointment_series(series_request(service_id, first.strftime("%Y-%m-%d")),
+                                                 current_user=user),
+                server.create_public_appointment(user["user_id"], single),
+                return_exceptions=True
+            )
+            failures = [r for r in results if isinstance(r, Exception)]
+            assert len(failures) == 1 and isinstance(failures[0], HTTPException), results
+            busy = await server.get_busy_intervals(user["user_id"], [third])
+            assert len(busy[third]) == 1
+        finally:
+            await drop_tenant(server, user["user_id"])
+
+    run(scenario())
@@ -0,0 +1,100 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from tests.support import drop_tenant, requires_mongo, run, seed_tenant
+
+def test_unscoped_filters_follow_the_documented_shard_keys():
+    pytest.importorskip("pymongo")
+    from repository import CROSS_TENANT_COMMENT, unscoped_filters
+
+    def update(query, multi=False):
+        return {"update": "appointments", "updates": [{"q": query, "u": {"$set": {"status": "cancelled"}}, "multi": multi}]}
+
+    # Escritura puntual: hace falta {user_id, appointment_id}
+    assert unscoped_filters("update", update({"user_id": "u1", "appointment_id": "a1"})) == []
+    assert unscoped_filters("update", update({"user_id": "u1", "date": "2026-01-05"})) != []
+    assert unscoped_filters("update", update({"appointment_id": "a1"})) != []
+    # Escritura múltiple y lecturas: alcanza con fijar el prefijo
+    assert unscoped_filters("update", update({"user_id": "u1", "date": "2026-01-05"}, multi=True)) == []
+    assert unscoped_filters("find", {"find": "appointments", "filter": {"user_id": {"$in": ["u1", "u2"]}}}) != []
+    assert unscoped_filters("find", {"find": "services", "filter": {"user_id": "u1", "service_id": "s1"}}) == []
+    assert unscoped_filters("insert", {"insert": "clients", "documents": [{"user_id": "u1"}]}) != []
+    assert unscoped_filters("find", {"find": "appointments", "filter": {}, "comment": CROSS_TENANT_COMMENT}) == []
+    assert unscoped_filters("find", {"find": "users", "filter": {"custom_slug": "x"}}) == []
+
+@requires_mongo
+def test_route_handlers_only_issue_tenant_scoped_queries():
+    # Corre los handlers contra un cliente que graba cada comando: ninguna consulta a una
+    # colección de negocio puede quedar fuera de su shard key (README_TURNITOS.md)
+    import server
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from pymongo import monitoring
+    from repository import unscoped_filters
+
+    class RecordingListener(monitoring.CommandListener):
+        def __init__(self):
+            self.commands = []
+
+        def started(self, event):
+            self.commands.append((event.command_name, event.command))
+
+        def succeeded(self, event):
+            pass
+
+        def failed(self, event):
+            pass
+
+    async def scenario():
+        tenant = await seed_tenant(server)
+        user, service = tenant["user"], tenant["service"]
+        user_id = user["user_id"]
+        recorder = RecordingListener()
+        server._lazy_clients.pop("mongo").close()
+        server._lazy_clients["mongo"] = AsyncIOMotorClient(
+            os.environ["MONGO_URL"], tz_aware=True, event_listeners=[recorder]
+        )
+        try:
+            date = (datetime.now(timezone.utc) + timedelta(days=3)).strftime("%Y-%m-%d")
+
+            def booking(name, time):
+                return server.AppointmentCreate(
+                    service_id=service["service_id"], client_name=name, client_phone="1100000000",
+                    client_email=f"{name.lower()}@example.com", date=date, time=time
+                )
+
+            await server.get_dashboard_stats(current_user=user)
+            await server.get_services(current_user=user)
+            await server.get_business_hours(current_user=user)
+            await server.get_available_slots(user_id, service["service_id"], date)
+            admin = await server.create_appointment_admin(booking("Dueño", "10:00"), current_user=user)
+            public = await server.create_public_appointment(user_id, booking("Cliente", "11:00"))
+            await server.create_appointment_series(server.SeriesCreate(
+                service_id=service["service_id"], client_name="Serie", client_phone="1100000001",
+                client_email="serie@example.com", start_date=date, time="15:00"
+            ), current_user=user)
+            await server.get_appointments(None, current_user=user)
+            await server.get_archived_appointments(None, None, 0, 50, current_user=user)
+            await server.search_appointments("Cliente", 0, 20, current_user=user)
+            await server.bulk_update_status(server.BulkStatusRequest(
+                appointment_ids=[public["appointment_id"]], status="confirmed"
+            ), current_user=user)
+            await server.cancel_appointment(admin["appointment_id"], current_user=user)
+            await server.get_clients("last_visit", 0, 50, current_user=user)
+            await server.get_analytics(date, date, "day", current_user=user)
+            # Tareas en segundo plano lanzadas por los handlers (clientes, lista de espera)
+            await asyncio.sleep(0.5)
+        finally:
+            await drop_tenant(server, user_id)
+
+        unscoped = [
+            (command.get(name), name, sorted(query))
+            for name, command in recorder.commands
+            for query in unscoped_filters(name, command)
+        ]
+        assert recorder.commands
+        assert unscoped == []
+
+    run(scenario())
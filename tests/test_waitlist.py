@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from tests.support import drop_tenant, requires_mongo, run, seed_tenant
+
+pytest.importorskip("fastapi")
+
+import server  # noqa: E402
+
+@requires_mongo
+def test_waitlist_offer_goes_through_the_outbox(monkeypatch):
+    async def send_directly(*args, **kwargs):
+        raise AssertionError("el aviso debe pasar por el outbox")
+    monkeypatch.setattr(server, "send_email_async", send_directly)
+
+    async def scenario():
+        tenant = await seed_tenant(server)
+        user, service = tenant["user"], tenant["service"]
+        try:
+            date = (datetime.now(timezone.utc) + timedelta(days=3)).strftime("%Y-%m-%d")
+            await server.db.waitlist.insert_one({
+                "waitlist_id": "espera-1", "user_id": user["user_id"], "service_id": service["service_id"],
+                "service_name": service["name"], "service_duration": 30, "client_name": "Ana",
+                "client_phone": "1100000000", "client_email": "espera@example.com", "date": date,
+                "earliest_time": "10:00", "latest_time": None, "status": "waiting",
+                "created_at": datetime.now(timezone.utc).isoformat()
+            })
+
+            await server.match_waitlist(user["user_id"], date, 600, 630)
+
+            entry = await server.db.waitlist.find_one({"user_id": user["user_id"], "waitlist_id": "espera-1"})
+            assert (entry["status"], entry["offered_time"]) == ("notified", "10:00")
+            messages = await server.db.outbox.find({"recipient": "espera@example.com"}).to_list(None)
+            assert [(m["subject"], m["status"]) for m in messages] == [("Se liberó un turno", "pending")]
+
+            # Una segunda pasada no vuelve a avisar: la entrada ya no está en espera
+            await server.match_waitlist(user["user_id"], date, 600, 630)
+            assert await server.db.outbox.count_documents({"recipient": "espera@example.com"}) == 1
+        finally:
+            await drop_tenant(server, user["user_id"])
+
+    run(scenario())